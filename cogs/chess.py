@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import re, sys, time
+import re, sys, time, random
 from itertools import count
 from collections import namedtuple
 
@@ -108,20 +108,166 @@ directions = {
 MATE_LOWER = piece['K'] - 10*piece['Q']
 MATE_UPPER = piece['K'] + 10*piece['Q']
 
-# The table size is the maximum number of elements in the transposition table.
-TABLE_SIZE = 1e7
+# Memory budget of the transposition table, in MB.
+TABLE_MB = 32
 
 # Constants for tuning search
 QS_LIMIT = 219
 EVAL_ROUGHNESS = 13
 DRAW_TEST = True
+# Late move reductions: from LMR_DEPTH on, quiet moves after the first
+# LMR_MOVES are searched a ply shallower unless they turn out to cut off.
+LMR_DEPTH = 3
+LMR_MOVES = 3
+# Futility pruning: at depth 1, quiet moves that can't come within this
+# margin of gamma aren't searched.
+FUTILITY_MARGIN = 300
+# Razoring: up to RAZOR_DEPTH, positions this far below gamma only get a
+# quiescence search when it confirms they fail low.
+RAZOR_DEPTH = 1
+RAZOR_MARGIN = 600
+# The deadline and node budget are checked every this many nodes (a power of two).
+ABORT_CHECK_NODES = 1024
+# Quiet moves remembered per ply for causing a cutoff, and how many plies deep.
+KILLER_SLOTS = 2
+MAX_KILLER_PLY = 64
 
 
 ###############################################################################
 # Chess logic
 ###############################################################################
 
-class Position(namedtuple('Position', 'board score wc bc ep kp')):
+# Attack tables. For every square of the 120 board, the squares a knight or
+# king there reaches, and the squares along each rook and bishop ray up to the
+# edge. Asking whether a square is attacked then means walking out from it
+# once, instead of generating every move of the other side.
+_ON_BOARD = [c not in ' \n' for c in initial]
+_KNIGHT_ATTACKS = [[i+d for d in directions['N'] if _ON_BOARD[i+d]] if _ON_BOARD[i] else [] for i in range(120)]
+_KING_ATTACKS = [[i+d for d in directions['K'] if _ON_BOARD[i+d]] if _ON_BOARD[i] else [] for i in range(120)]
+
+def _rays(i, dirs):
+    rays = []
+    for d in dirs:
+        ray = []
+        j = i + d
+        while _ON_BOARD[j]:
+            ray.append(j)
+            j += d
+        if ray:
+            rays.append(ray)
+    return rays
+
+_ROOK_RAYS = [_rays(i, (N, E, S, W)) if _ON_BOARD[i] else [] for i in range(120)]
+_BISHOP_RAYS = [_rays(i, (N+E, S+E, S+W, N+W)) if _ON_BOARD[i] else [] for i in range(120)]
+# Attacking pieces, and where their pawns stand relative to what they attack
+_THEIR_ATTACKERS = tuple(b'pnbrqk') + ((N+W, N+E),)
+_OUR_ATTACKERS = tuple(b'PNBRQK') + ((S+W, S+E),)
+
+
+def is_attacked(squares, i, attackers=_THEIR_ATTACKERS):
+    """ Whether the square i of a 120 byte board is attacked, by default by
+    the opponent of the side to move """
+    pawn, knight, bishop, rook, queen, king, pawn_offsets = attackers
+    for d in pawn_offsets:
+        if squares[i+d] == pawn:
+            return True
+    for j in _KNIGHT_ATTACKS[i]:
+        if squares[j] == knight:
+            return True
+    for j in _KING_ATTACKS[i]:
+        if squares[j] == king:
+            return True
+    for slider, rays in ((rook, _ROOK_RAYS[i]), (bishop, _BISHOP_RAYS[i])):
+        for ray in rays:
+            for j in ray:
+                q = squares[j]
+                if q != _EMPTY:
+                    if q == slider or q == queen:
+                        return True
+                    break
+    return False
+
+
+def least_valuable_attacker(squares, i, attackers):
+    """ The square of the cheapest piece of the given side attacking i, or None """
+    pawn, knight, bishop, rook, queen, king, pawn_offsets = attackers
+    for d in pawn_offsets:
+        if squares[i+d] == pawn:
+            return i+d
+    for j in _KNIGHT_ATTACKS[i]:
+        if squares[j] == knight:
+            return j
+    # Only the first piece along each ray can be attacking
+    queens = None
+    for slider, rays in ((bishop, _BISHOP_RAYS[i]), (rook, _ROOK_RAYS[i])):
+        for ray in rays:
+            for j in ray:
+                q = squares[j]
+                if q != _EMPTY:
+                    if q == slider:
+                        return j
+                    if q == queen and queens is None:
+                        queens = j
+                    break
+    if queens is not None:
+        return queens
+    for j in _KING_ATTACKS[i]:
+        if squares[j] == king:
+            return j
+    return None
+
+
+def static_exchange(pos, move):
+    """ Material won by a capture once every piece attacking the square has
+    joined in, cheapest first, each side free to stop when it pleases """
+    i, j = move
+    squares = bytearray(pos.squares)
+    if pos.kp and abs(j - pos.kp) < 2:
+        return piece['K']
+    if squares[i] == _PAWN and j == pos.ep:
+        squares[j+S] = _EMPTY
+        gains = [piece['P']]
+    else:
+        gains = [_PIECE_VALUE.get(squares[j], 0)]
+    on_square = _PIECE_VALUE[squares[i]]
+    squares[i] = _EMPTY
+    while True:
+        side = _THEIR_ATTACKERS if len(gains) % 2 else _OUR_ATTACKERS
+        attacker = least_valuable_attacker(squares, j, side)
+        if attacker is None:
+            break
+        gains.append(on_square - gains[-1])
+        on_square = _PIECE_VALUE[squares[attacker]]
+        squares[attacker] = _EMPTY
+    # Going back, each side only captures if that doesn't lose
+    for k in range(len(gains) - 1, 0, -1):
+        gains[k-1] = -max(-gains[k-1], gains[k])
+    return gains[0]
+
+
+class LegalityMixin:
+    """ Check and legality tests for a position with a 120 byte `squares` """
+
+    def in_check(self):
+        return is_attacked(self.squares, self.squares.find(_KING))
+
+    def is_legal(self, move):
+        """ Whether a pseudo-legal move from gen_moves keeps our king safe """
+        i, j = move
+        if self.squares[i] == _KING and abs(j - i) == 2:
+            # No castling out of or through check
+            if is_attacked(self.squares, i) or is_attacked(self.squares, (i+j)//2):
+                return False
+        # After the move the board is rotated, so our king is now theirs
+        squares = self.move(move).squares
+        king = squares.find(_KING + 32)
+        return king != -1 and not is_attacked(squares, king, _OUR_ATTACKERS)
+
+    def legal_moves(self):
+        return [move for move in self.gen_moves() if self.is_legal(move)]
+
+
+class Position(namedtuple('Position', 'board score wc bc ep kp'), LegalityMixin):
     """ A state of a chess game
     board -- a 120 char representation of the board
     score -- the board evaluation
@@ -131,6 +277,10 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
     kp - the king passant square
     """
 
+    @property
+    def squares(self):
+        return self.board.encode('ascii')
+
     def gen_moves(self):
         # For each of our pieces, iterate through each possible 'ray' of moves,
         # as defined in the 'directions' map. The rays are broken e.g. by
@@ -226,25 +376,399 @@ class Position(namedtuple('Position', 'board score wc bc ep kp')):
                 score += pst['P'][119-(j+S)]
         return score
 
+###############################################################################
+# Compact board
+###############################################################################
+
+# The same board as Position, but held as a bytearray of the 120 characters
+# so moves and rotations are done with C-level copies instead of string
+# slicing. Each position also carries a 64-bit Zobrist key, updated
+# incrementally, so hashing it doesn't touch the board at all.
+#
+# Rotating flips both the squares and the colours, so two board keys are
+# kept: one as seen by the side to move and one as seen by the opponent.
+# A rotation just swaps them. Keys are kept below 2**63 so they can be
+# returned from __hash__ unchanged, and the generator is seeded so they are
+# the same in every process.
+_zobrist_random = random.Random(0x5ADF15)
+_ZOBRIST = {ord(p): [_zobrist_random.getrandbits(63) for _ in range(120)] for p in 'PNBRQKpnbrqk'}
+_ZOBRIST_ROTATED = {p: [_ZOBRIST[ord(chr(p).swapcase())][119-i] for i in range(120)] for p in _ZOBRIST}
+_ZOBRIST_CASTLING = [_zobrist_random.getrandbits(63) for _ in range(16)]
+_ZOBRIST_EP = [0] + [_zobrist_random.getrandbits(63) for _ in range(119)]
+_ZOBRIST_KP = [0] + [_zobrist_random.getrandbits(63) for _ in range(119)]
+
+_SWAPCASE = bytes(range(256)).swapcase()
+_PST = {ord(p): table for p, table in pst.items()}
+_DIRECTIONS = {ord(p): dirs for p, dirs in directions.items()}
+_OURS = frozenset(b'PNBRQK')
+_THEIRS = frozenset(b'pnbrqk')
+_BLOCKED = frozenset(b' \nPNBRQK')
+_CRAWLERS = frozenset(b'PNK')
+_EMPTY, _PAWN, _ROOK, _QUEEN, _KING = b'.PRQK'
+# Move ordering: piece values of either colour, and the attackers from
+# cheapest to dearest
+_PIECE_VALUE = {ord(c): value for p, value in piece.items() for c in (p, p.lower())}
+_ATTACKER_RANK = {ord(p): rank for rank, p in enumerate('PNBRQK')}
+
+
+class CompactPosition(LegalityMixin):
+    """ A state of a chess game, interchangeable with Position
+    squares -- bytearray of the 120 board characters
+    score, wc, bc, ep, kp -- as in Position
+    bkey -- Zobrist key of the squares
+    rkey -- Zobrist key of the squares after a rotation
+    key -- bkey combined with castling rights, ep and kp
+    """
+    __slots__ = ('squares', 'score', 'wc', 'bc', 'ep', 'kp', 'bkey', 'rkey', 'key')
+
+    def __init__(self, board, score, wc, bc, ep, kp, bkey=None, rkey=None):
+        if isinstance(board, str):
+            board = bytearray(board, 'ascii')
+        if bkey is None:
+            bkey = rkey = 0
+            for i, p in enumerate(board):
+                if p in _ZOBRIST:
+                    bkey ^= _ZOBRIST[p][i]
+                    rkey ^= _ZOBRIST_ROTATED[p][i]
+        self.squares = board
+        self.score, self.wc, self.bc, self.ep, self.kp = score, wc, bc, ep, kp
+        self.bkey, self.rkey = bkey, rkey
+        self.key = bkey ^ _ZOBRIST_EP[ep] ^ _ZOBRIST_KP[kp] ^ _ZOBRIST_CASTLING[
+            wc[0] << 3 | wc[1] << 2 | bc[0] << 1 | bc[1]]
+
+    @classmethod
+    def from_position(cls, pos):
+        return cls(*pos)
+
+    @property
+    def board(self):
+        return self.squares.decode('ascii')
+
+    def __hash__(self):
+        return self.key
+
+    def __eq__(self, other):
+        return isinstance(other, CompactPosition) and self.key == other.key \
+            and self.squares == other.squares and self.ep == other.ep \
+            and self.kp == other.kp and self.wc == other.wc and self.bc == other.bc
+
+    def __reduce__(self):
+        return CompactPosition, (bytes(self.squares), self.score, self.wc, self.bc,
+                                 self.ep, self.kp, self.bkey, self.rkey)
+
+    def __repr__(self):
+        return 'CompactPosition(%r, %d, %r, %r, %d, %d)' % (
+            self.board, self.score, self.wc, self.bc, self.ep, self.kp)
+
+    def gen_moves(self):
+        board = self.squares
+        for i, p in enumerate(board):
+            if p not in _OURS: continue
+            for d in _DIRECTIONS[p]:
+                for j in count(i+d, d):
+                    q = board[j]
+                    # Stay inside the board, and off friendly pieces
+                    if q in _BLOCKED: break
+                    # Pawn move, double move and capture
+                    if p == _PAWN:
+                        if d in (N, N+N) and q != _EMPTY: break
+                        if d == N+N and (i < A1+N or board[i+N] != _EMPTY): break
+                        if d in (N+W, N+E) and q == _EMPTY \
+                                and j not in (self.ep, self.kp, self.kp-1, self.kp+1): break
+                    # Move it
+                    yield (i, j)
+                    # Stop crawlers from sliding, and sliding after captures
+                    if p in _CRAWLERS or q in _THEIRS: break
+                    # Castling, by sliding the rook next to the king
+                    if i == A1 and board[j+E] == _KING and self.wc[0]: yield (j+E, j+W)
+                    if i == H1 and board[j+W] == _KING and self.wc[1]: yield (j+W, j+E)
+
+    def rotate(self):
+        ''' Rotates the board, preserving enpassant '''
+        return CompactPosition(
+            self.squares[::-1].translate(_SWAPCASE), -self.score, self.bc, self.wc,
+            119-self.ep if self.ep else 0,
+            119-self.kp if self.kp else 0,
+            self.rkey, self.bkey)
+
+    def nullmove(self):
+        ''' Like rotate, but clears ep and kp '''
+        return CompactPosition(
+            self.squares[::-1].translate(_SWAPCASE), -self.score,
+            self.bc, self.wc, 0, 0, self.rkey, self.bkey)
+
+    def move(self, move):
+        i, j = move
+        board = bytearray(self.squares)
+        p, q = board[i], board[j]
+        # Copy variables and reset ep and kp
+        wc, bc, ep, kp = self.wc, self.bc, 0, 0
+        score = self.score + self.value(move)
+        bkey, rkey = self.bkey, self.rkey
+        # Actual move
+        if q != _EMPTY:
+            bkey ^= _ZOBRIST[q][j]
+            rkey ^= _ZOBRIST_ROTATED[q][j]
+        bkey ^= _ZOBRIST[p][i] ^ _ZOBRIST[p][j]
+        rkey ^= _ZOBRIST_ROTATED[p][i] ^ _ZOBRIST_ROTATED[p][j]
+        board[j] = p
+        board[i] = _EMPTY
+        # Castling rights, we move the rook or capture the opponent's
+        if i == A1: wc = (False, wc[1])
+        if i == H1: wc = (wc[0], False)
+        if j == A8: bc = (bc[0], False)
+        if j == H8: bc = (False, bc[1])
+        # Castling
+        if p == _KING:
+            wc = (False, False)
+            if abs(j-i) == 2:
+                kp = (i+j)//2
+                rook = A1 if j < i else H1
+                board[rook] = _EMPTY
+                board[kp] = _ROOK
+                bkey ^= _ZOBRIST[_ROOK][rook] ^ _ZOBRIST[_ROOK][kp]
+                rkey ^= _ZOBRIST_ROTATED[_ROOK][rook] ^ _ZOBRIST_ROTATED[_ROOK][kp]
+        # Pawn promotion, double move and en passant capture
+        if p == _PAWN:
+            if A8 <= j <= H8:
+                board[j] = _QUEEN
+                bkey ^= _ZOBRIST[_PAWN][j] ^ _ZOBRIST[_QUEEN][j]
+                rkey ^= _ZOBRIST_ROTATED[_PAWN][j] ^ _ZOBRIST_ROTATED[_QUEEN][j]
+            if j - i == 2*N:
+                ep = i + N
+            if j == self.ep:
+                board[j+S] = _EMPTY
+                bkey ^= _ZOBRIST[_PAWN + 32][j+S]
+                rkey ^= _ZOBRIST_ROTATED[_PAWN + 32][j+S]
+        # We rotate the returned position, so it's ready for the next player
+        board.reverse()
+        return CompactPosition(
+            board.translate(_SWAPCASE), -score, bc, wc,
+            119-ep if ep else 0,
+            119-kp if kp else 0,
+            rkey, bkey)
+
+    def value(self, move):
+        i, j = move
+        p, q = self.squares[i], self.squares[j]
+        # Actual move
+        score = _PST[p][j] - _PST[p][i]
+        # Capture
+        if q in _THEIRS:
+            score += _PST[q - 32][119-j]
+        # Castling check detection
+        if abs(j-self.kp) < 2:
+            score += _PST[_KING][119-j]
+        # Castling
+        if p == _KING and abs(i-j) == 2:
+            score += _PST[_ROOK][(i+j)//2]
+            score -= _PST[_ROOK][A1 if j < i else H1]
+        # Special pawn stuff
+        if p == _PAWN:
+            if A8 <= j <= H8:
+                score += _PST[_QUEEN][j] - _PST[_PAWN][j]
+            if j == self.ep:
+                score += _PST[_PAWN][119-(j+S)]
+        return score
+
 ###############################################################################
 # Search logic
 ###############################################################################
 
 # lower <= s(pos) <= upper
-Entry = namedtuple('Entry', 'lower upper')
+# Each entry is two 64-bit words, (key ^ data, data), with data packed as:
+#   bits  0-17 lower bound    bits 36-49 move (from*120 + to, 0 for none)
+#   bits 18-35 upper bound    bits 50-56 depth, bit 57 root, bits 58-63 age
+# A half-written entry no longer xors back to its key, so it reads as a miss.
+_SCORE_OFFSET = 1 << 17
+_SCORE_MASK = (1 << 18) - 1
+_MOVE_MASK = (1 << 14) - 1
+_MAX_TABLE_DEPTH = 127
+_DEPTH_ROOT_MASK = 0xFF << 50
+
+
+def table_bytes(mb):
+    """ Size of a table of mb MB, in whole buckets """
+    return max(1, int(mb * 2**20) // 32) * 32
+
+
+class TranspositionTable:
+    """ Fixed-size hash table of search bounds and best moves.
+    Buckets hold two entries. The first prefers depth: it is only replaced
+    by an equal or deeper search, or when it is left over from an earlier
+    search, and what it held is moved to the second. The second is always
+    replaced. The table lives in one preallocated buffer, so it never grows
+    past its budget and can be kept from one move to the next.
+
+    Searches running at once in a shared table pass live, the number of
+    running searches of each age. An entry is then only left over once no
+    search of its age is running, so one game's searches don't push out
+    another's deep entries.
+    """
+    def __init__(self, mb=TABLE_MB, buffer=None, live=None):
+        if buffer is None:
+            buffer = bytearray(table_bytes(mb))
+        self.buffer = buffer
+        self.words = memoryview(buffer).cast('Q')
+        self.buckets = len(self.words) // 4
+        self.age = 0
+        self.live = live
+        # Lookups this search, and how many found their position
+        self.probes = self.hits = 0
+
+    def new_search(self, age=None):
+        """ Starts a new search. Processes sharing a table pass the same age. """
+        self.age = (self.age + 1 if age is None else age) & 63
+        self.probes = self.hits = 0
+
+    def fill(self, sample=1000):
+        """ Share of the entries written by this search, over the first
+        sample buckets """
+        words = self.words
+        sample = min(sample, self.buckets)
+        used = sum(1 for i in range(1, 4 * sample, 2) if words[i] and words[i] >> 58 == self.age)
+        return used / (2 * sample)
+
+    def clear(self):
+        self.words.cast('B')[:] = bytes(self.words.nbytes)
+
+    def probe(self, key, depth, root):
+        """ Returns (lower, upper, move). The bounds are only taken from an
+        entry searched to the same depth, the move from any entry. """
+        words = self.words
+        i = (key % self.buckets) << 2
+        want = min(depth, _MAX_TABLE_DEPTH) << 50 | root << 57
+        move = None
+        hit = False
+        self.probes += 1
+        for i in (i, i + 2):
+            data = words[i + 1]
+            if words[i] ^ data != key:
+                continue
+            hit = True
+            if move is None and data >> 36 & _MOVE_MASK:
+                move = divmod(data >> 36 & _MOVE_MASK, 120)
+            if data & _DEPTH_ROOT_MASK == want:
+                self.hits += 1
+                return ((data & _SCORE_MASK) - _SCORE_OFFSET,
+                        (data >> 18 & _SCORE_MASK) - _SCORE_OFFSET, move)
+        self.hits += hit
+        return -MATE_UPPER, MATE_UPPER, move
+
+    def store(self, key, depth, root, lower, upper, move=None):
+        """ Stores the bounds. A move of None keeps the one already known. """
+        words = self.words
+        i = (key % self.buckets) << 2
+        depth = min(depth, _MAX_TABLE_DEPTH)
+        if move is not None:
+            code = move[0] * 120 + move[1]
+        else:
+            code = 0
+            for j in (i, i + 2):
+                if words[j] ^ words[j + 1] == key:
+                    code = words[j + 1] >> 36 & _MOVE_MASK
+                    if code: break
+        data = (lower + _SCORE_OFFSET | (upper + _SCORE_OFFSET) << 18 | code << 36
+                | depth << 50 | root << 57 | self.age << 58)
+        old = words[i + 1]
+        if self.live is None:
+            stale = old >> 58 != self.age
+        else:
+            stale = not self.live[old >> 58]
+        if depth >= (old >> 50 & _MAX_TABLE_DEPTH) or stale:
+            old_key = words[i] ^ old
+            if old and old_key != key:
+                words[i + 3] = old
+                words[i + 2] = words[i]
+        else:
+            i += 2
+        words[i + 1] = data
+        words[i] = key ^ data
+
+
+class SearchAborted(Exception):
+    """ The search ran out of time or nodes in the middle of a depth """
+
 
 class Searcher:
-    def __init__(self):
-        self.tp_score = {}
-        self.tp_move = {}
+    def __init__(self, table_mb=TABLE_MB, buffer=None, live=None):
+        self.tp = TranspositionTable(table_mb, buffer, live)
         self.history = set()
         self.nodes = 0
+        self.deadline = None
+        self.max_nodes = None
+        self.killers = [[None] * KILLER_SLOTS for _ in range(MAX_KILLER_PLY)]
+        self.move_history = [0] * (120 * 120)
 
-    def bound(self, pos, gamma, depth, root=True):
+    @staticmethod
+    def split_moves(pos, with_quiet=True):
+        """ Splits the moves into (captures and promotions, quiet moves) """
+        squares, ep, kp = pos.squares, pos.ep, pos.kp
+        tactical, quiet = [], set()
+        for move in pos.gen_moves():
+            i, j = move
+            if squares[j] != _EMPTY or kp and abs(j - kp) < 2 \
+                    or squares[i] == _PAWN and (j == ep or j <= H8):
+                tactical.append(move)
+            elif with_quiet:
+                quiet.add(move)
+        return tactical, quiet
+
+    @staticmethod
+    def is_quiet(pos, move):
+        i, j = move
+        squares = pos.squares
+        return squares[j] == _EMPTY and not (pos.kp and abs(j - pos.kp) < 2) \
+            and not (squares[i] == _PAWN and (j == pos.ep or j <= H8))
+
+    @staticmethod
+    def mvv_lva(pos):
+        """ Sort key for captures, by victim then by attacker """
+        squares = pos.squares
+        def key(move):
+            i, j = move
+            victim = _PIECE_VALUE.get(squares[j], 0)
+            if pos.kp and abs(j - pos.kp) < 2:
+                victim = piece['K']
+            elif squares[i] == _PAWN:
+                if j == pos.ep:
+                    victim = piece['P']
+                if A8 <= j <= H8:
+                    victim += piece['Q'] - piece['P']
+            return victim * 8 - _ATTACKER_RANK[squares[i]]
+        return key
+
+    @staticmethod
+    def loses_material(pos, move):
+        """ Whether the static exchange of a capture comes out negative """
+        squares = pos.squares
+        # Taking something worth as much as the attacker can't lose
+        if _PIECE_VALUE.get(squares[move[1]], 0) >= _PIECE_VALUE[squares[move[0]]]:
+            return False
+        return static_exchange(pos, move) < 0
+
+    def record_cutoff(self, move, depth, ply):
+        """ Remembers a quiet move that caused a cutoff """
+        if ply < MAX_KILLER_PLY:
+            killers = self.killers[ply]
+            if killers[0] != move:
+                killers.insert(0, move)
+                killers.pop()
+        self.move_history[move[0]*120 + move[1]] += depth * depth
+
+    def out_of_budget(self):
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            return True
+        deadline = self.deadline() if callable(self.deadline) else self.deadline
+        return deadline is not None and time.time() > deadline
+
+    def bound(self, pos, gamma, depth, root=True, ply=0):
         """ returns r where
                 s(pos) <= r < gamma    if gamma > s(pos)
                 gamma <= r <= s(pos)   if gamma <= s(pos)"""
         self.nodes += 1
+        if not self.nodes & (ABORT_CHECK_NODES - 1) and self.out_of_budget():
+            raise SearchAborted
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for
         # calmness, and from this point on there is no difference in behaviour depending on
@@ -269,55 +793,113 @@ class Searcher:
             if not root and pos in self.history:
                 return 0
 
+        # Endings in the bitbases are decided. Draws end here; wins are still
+        # searched to find the mate, but leaves are scored by the bitbase.
+        decided = None
+        if BITBASES and not root and pos.squares.count(b'.') == 61:
+            decided = BITBASES.probe(pos)
+            if decided == 0 or decided is not None and depth == 0:
+                return decided
+
         # Look in the table if we have already searched this position before.
         # We also need to be sure, that the stored search was over the same
         # nodes as the current search.
-        entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
-        if entry.lower >= gamma and (not root or self.tp_move.get(pos) is not None):
-            return entry.lower
-        if entry.upper < gamma:
-            return entry.upper
+        key = hash(pos) & 0x7FFFFFFFFFFFFFFF
+        lower, upper, killer = self.tp.probe(key, depth, root)
+        if lower >= gamma and (not root or killer is not None):
+            return lower
+        if upper < gamma:
+            return upper
 
         # Here extensions may be added
         # Such as 'if in_check: depth += 1'
+        in_check = depth > 0 and pos.in_check()
+        # Near the leaves, skip what can't matter. Neither is safe in check,
+        # at the root, or when gamma is a mate score.
+        prune = not root and not in_check and abs(gamma) < MATE_LOWER
+
+        # Razoring: far enough below gamma, a position near the leaves isn't
+        # worth a full search; if quiescence agrees it fails low, return that.
+        if prune and 0 < depth <= RAZOR_DEPTH and pos.score + RAZOR_MARGIN < gamma:
+            score = self.bound(pos, gamma, 0, False, ply)
+            if score < gamma:
+                return score
 
         # Generator of moves to search in order.
         # This allows us to define the moves, but only calculate them if needed.
         def moves():
             # First try not moving at all. We only do this if there is at least one major
             # piece left on the board, since otherwise zugzwangs are too dangerous.
-            if depth > 0 and not root and any(c in pos.board for c in 'RBNQ'):
-                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, root=False)
+            # In check, passing just loses the king, so don't spend a search on it.
+            # The bitbase endings are full of zugzwangs, so no passing there.
+            if depth > 0 and not root and any(c in pos.squares for c in b'RBNQ') \
+                    and not in_check and decided is None:
+                yield None, -self.bound(pos.nullmove(), 1-gamma, depth-3, False, ply+1)
             # For QSearch we have a different kind of null-move, namely we can just stop
             # and not capture anythign else.
             if depth == 0:
                 yield None, pos.score
-            # Then killer move. We search it twice, but the tp will fix things for us.
-            # Note, we don't have to check for legality, since we've already done it
-            # before. Also note that in QS the killer must be a capture, otherwise we
-            # will be non deterministic.
-            killer = self.tp_move.get(pos)
+            # Then the move from the table. Note, we don't have to check for legality,
+            # since we've already done it before. Also note that in QS it must be a
+            # capture, otherwise we will be non deterministic.
             if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
-                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, root=False)
-            # Then all the other moves
-            for move in sorted(pos.gen_moves(), key=pos.value, reverse=True):
-            #for val, move in sorted(((pos.value(move), move) for move in pos.gen_moves()), reverse=True):
-                # If depth == 0 we only try moves with high intrinsic score (captures and
-                # promotions). Otherwise we do all moves.
-                if depth > 0 or pos.value(move) >= QS_LIMIT:
-                    yield move, -self.bound(pos.move(move), 1-gamma, depth-1, root=False)
+                yield killer, -self.bound(pos.move(killer), 1-gamma, depth-1, False, ply+1)
+            # Then captures and promotions, most valuable victim first and least
+            # valuable attacker next. If depth == 0 these are all we try, and only
+            # those with a high intrinsic score. No quiet move comes close to QS_LIMIT.
+            # Captures that lose material in the exchange are left for last, or
+            # in QS not tried at all.
+            tactical, quiet = self.split_moves(pos, depth > 0)
+            losing = []
+            for move in sorted(tactical, key=self.mvv_lva(pos), reverse=True):
+                if move != killer and (depth > 0 or pos.value(move) >= QS_LIMIT):
+                    if self.loses_material(pos, move):
+                        losing.append(move)
+                        continue
+                    yield move, -self.bound(pos.move(move), 1-gamma, depth-1, False, ply+1)
+            if depth == 0:
+                return
+            # Then quiet moves that were good enough for a cutoff at this ply
+            # elsewhere in the tree, and the rest by how often they cut off.
+            killers = self.killers[ply] if ply < MAX_KILLER_PLY else ()
+            for move in killers:
+                if move is not None and move != killer and move in quiet:
+                    yield move, -self.bound(pos.move(move), 1-gamma, depth-1, False, ply+1)
+            history = self.move_history
+            quiet = sorted(quiet, key=lambda m: history[m[0]*120 + m[1]], reverse=True)
+            for n, move in enumerate(quiet):
+                if move == killer or move in killers:
+                    continue
+                # Futility: one ply from the leaves, a quiet move that can't
+                # bring the score near gamma only gets its optimistic estimate.
+                if prune and depth == 1:
+                    estimate = pos.score + pos.value(move) + FUTILITY_MARGIN
+                    if estimate < gamma:
+                        yield move, estimate
+                        continue
+                # Late move reductions: quiet moves this far down the order
+                # rarely cut off, so look shallower first and only search them
+                # fully if they do.
+                if depth >= LMR_DEPTH and n >= LMR_MOVES and not in_check:
+                    score = -self.bound(pos.move(move), 1-gamma, depth-2, False, ply+1)
+                    if score < gamma:
+                        yield move, score
+                        continue
+                yield move, -self.bound(pos.move(move), 1-gamma, depth-1, False, ply+1)
+            for move in losing:
+                yield move, -self.bound(pos.move(move), 1-gamma, depth-1, False, ply+1)
 
         # Run through the moves, shortcutting when possible
-        best = -MATE_UPPER
+        best, best_move = -MATE_UPPER, None
         for move, score in moves():
             best = max(best, score)
             if best >= gamma:
-                # Clear before setting, so we always have a value
-                if len(self.tp_move) > TABLE_SIZE: self.tp_move.clear()
-                # Save the move for pv construction and killer heuristic
-                self.tp_move[pos] = move
+                best_move = move
                 break
 
+        if best_move is not None and depth > 0 and self.is_quiet(pos, best_move):
+            self.record_cutoff(best_move, depth, ply)
+
         # Stalemate checking is a bit tricky: Say we failed low, because
         # we can't (legally) move and so the (real) score is -infty.
         # At the next depth we are allowed to just return r, -infty <= r < gamma,
@@ -329,50 +911,69 @@ class Searcher:
         # but only if depth == 1, so that's probably fair enough.
         # (Btw, at depth 1 we can also mate without realizing.)
         if best < gamma and best < 0 and depth > 0:
-            is_dead = lambda pos: any(pos.value(m) >= MATE_LOWER for m in pos.gen_moves())
-            if all(is_dead(pos.move(m)) for m in pos.gen_moves()):
-                in_check = is_dead(pos.nullmove())
-                best = -MATE_UPPER if in_check else 0
-
-        # Clear before setting, so we always have a value
-        if len(self.tp_score) > TABLE_SIZE: self.tp_score.clear()
-        # Table part 2
+            if not any(pos.is_legal(m) for m in pos.gen_moves()):
+                best = -MATE_UPPER if pos.in_check() else 0
+
+        # Table part 2. On a cutoff we also save the move for pv construction
+        # and the killer heuristic.
         if best >= gamma:
-            self.tp_score[pos, depth, root] = Entry(best, entry.upper)
+            self.tp.store(key, depth, root, best, upper, best_move)
         if best < gamma:
-            self.tp_score[pos, depth, root] = Entry(entry.lower, best)
+            self.tp.store(key, depth, root, lower, best)
 
         return best
 
-    def search(self, pos, history=()):
-        """ Iterative deepening MTD-bi search """
+    def search(self, pos, history=(), deadline=None, max_nodes=None, start_depth=1, age=None):
+        """ Iterative deepening MTD-bi search.
+        Stops once the time.time() deadline has passed or max_nodes have
+        been searched, even in the middle of a depth, but never before the
+        first depth is done. The deadline may be a function returning it,
+        if it can change while we search. A search from a later start_depth
+        is a helper filling a shared table and may stop before yielding. """
         self.nodes = 0
+        self.deadline = self.max_nodes = None
+        self.killers = [[None] * KILLER_SLOTS for _ in range(MAX_KILLER_PLY)]
+        # Older cutoffs count for less
+        self.move_history = [h >> 1 for h in self.move_history]
+        if start_depth > 1:
+            self.deadline, self.max_nodes = deadline, max_nodes
+        self.tp.new_search(age)
+        # Repetitions are checked against the history in bound() before the
+        # table is probed, so the table can be kept from one move to the next.
         if DRAW_TEST:
             self.history = set(history)
-            # print('# Clearing table due to new history')
-            self.tp_score.clear()
+        key = hash(pos) & 0x7FFFFFFFFFFFFFFF
 
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
-        for depth in range(1, 1000):
+        for depth in range(start_depth, 1000):
             # The inner loop is a binary search on the score of the position.
             # Inv: lower <= score <= upper
             # 'while lower != upper' would work, but play tests show a margin of 20 plays
             # better.
             lower, upper = -MATE_UPPER, MATE_UPPER
-            while lower < upper - EVAL_ROUGHNESS:
-                gamma = (lower+upper+1)//2
-                score = self.bound(pos, gamma, depth)
-                if score >= gamma:
-                    lower = score
-                if score < gamma:
-                    upper = score
-            # We want to make sure the move to play hasn't been kicked out of the table,
-            # So we make another call that must always fail high and thus produce a move.
-            self.bound(pos, lower, depth)
+            try:
+                while lower < upper - EVAL_ROUGHNESS:
+                    gamma = (lower+upper+1)//2
+                    score = self.bound(pos, gamma, depth)
+                    if score >= gamma:
+                        lower = score
+                    if score < gamma:
+                        upper = score
+                # We want to make sure the move to play hasn't been kicked out of the table,
+                # So we make another call that must always fail high and thus produce a move.
+                self.bound(pos, lower, depth)
+            except SearchAborted:
+                # What the unfinished depth stored is sound, but the last
+                # depth we yielded stands as the result.
+                return
             # If the game hasn't finished we can retrieve our move from the
             # transposition table.
-            yield depth, self.tp_move.get(pos), self.tp_score.get((pos, depth, True)).lower
+            lower, _upper, move = self.tp.probe(key, depth, True)
+            yield depth, move, lower
+            self.deadline, self.max_nodes = deadline, max_nodes
+            if self.out_of_budget():
+                return
 
 
 ###############################################################################
@@ -394,6 +995,102 @@ def render(i):
     return chr(fil + ord('a')) + str(-rank + 1)
 
 
+SAN_RE = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$')
+
+def parse_san(pos, san, black=False):
+    """ Finds the move in pos written in SAN, e.g. Nbd7, exd5, O-O or e8=Q.
+    Black's moves are written from White's side as on a score sheet, while
+    pos is the rotated board sunfish gives Black, so they are flipped.
+    Promotions are always to a queen. Returns None unless exactly one legal
+    move matches. """
+    flip = (lambda sq: 119 - sq) if black else (lambda sq: sq)
+    san = san.rstrip('+#!?')
+    if san in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        rank = '8' if black else '1'
+        san = 'Ke' + rank + ('g' if len(san) == 3 else 'c') + rank
+    match = SAN_RE.match(san)
+    if not match:
+        return None
+    piece, fil, rank, to, _promotion = match.groups()
+    piece, to = piece or 'P', flip(parse(to))
+    candidates = []
+    for move in pos.gen_moves():
+        if move[1] != to or pos.board[move[0]] != piece:
+            continue
+        square = render(flip(move[0]))
+        if (fil and square[0] != fil) or (rank and square[1] != rank):
+            continue
+        candidates.append(move)
+    if len(candidates) > 1:
+        # Disambiguation only counts legal moves, so drop pinned pieces
+        candidates = [m for m in candidates if pos.is_legal(m)]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+def to_san(pos, move, black=False):
+    """ Writes a move in pos as SAN, the way parse_san reads it back """
+    flip = (lambda sq: 119 - sq) if black else (lambda sq: sq)
+    i, j = move
+    piece = pos.board[i]
+    square, to = render(flip(i)), render(flip(j))
+    capture = pos.board[j].islower() or piece == 'P' and j - i in (N+W, N+E)
+    if piece == 'K' and abs(j - i) == 2:
+        san = 'O-O' if to[0] == 'g' else 'O-O-O'
+    elif piece == 'P':
+        san = (square[0] + 'x' if capture else '') + to + ('=Q' if A8 <= j <= H8 else '')
+    else:
+        others = [render(flip(m[0])) for m in pos.legal_moves()
+                  if m[1] == j and m[0] != i and pos.board[m[0]] == piece]
+        if not others:
+            origin = ''
+        elif all(other[0] != square[0] for other in others):
+            origin = square[0]
+        elif all(other[1] != square[1] for other in others):
+            origin = square[1]
+        else:
+            origin = square
+        san = piece + origin + ('x' if capture else '') + to
+    after = pos.move(move)
+    if after.in_check():
+        san += '+' if after.legal_moves() else '#'
+    return san
+
+
+COORDINATE_RE = re.compile(r'([a-h][1-8])([a-h][1-8])[qrbn]?$')
+MOVE_NUMBER_RE = re.compile(r'^\d+\.+')
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+
+def parse_token(pos, token, black):
+    """ Finds the move in pos written in coordinates (g1f3) or SAN """
+    match = COORDINATE_RE.match(token)
+    if match:
+        move = parse(match.group(1)), parse(match.group(2))
+        if black:
+            move = 119 - move[0], 119 - move[1]
+        return move if move in pos.gen_moves() else None
+    return parse_san(pos, token, black)
+
+
+def replay(tokens):
+    """ Plays a move list from the initial position and returns the
+    positions and moves. Raises ValueError at the first move that can't be
+    played. """
+    pos = CompactPosition(initial, 0, (True, True), (True, True), 0, 0)
+    positions, moves = [pos], []
+    for token in tokens:
+        token = MOVE_NUMBER_RE.sub('', token)
+        if not token or token in RESULTS:
+            continue
+        move = parse_token(pos, token, len(moves) % 2 == 1)
+        if move is None or not pos.is_legal(move):
+            raise ValueError(f"Can't play {token} at move {len(moves) // 2 + 1}.")
+        pos = pos.move(move)
+        positions.append(pos)
+        moves.append(move)
+    return positions, moves
+
+
 def print_pos(pos):
     print()
     uni_pieces = {'R':'♜', 'N':'♞', 'B':'♝', 'Q':'♛', 'K':'♚', 'P':'♟',
@@ -433,10 +1130,8 @@ def main():
             break
 
         # Fire up the engine to look for a move.
-        start = time.time()
-        for _depth, move, score in searcher.search(hist[-1], hist):
-            if time.time() - start > 1:
-                break
+        for _depth, move, score in searcher.search(hist[-1], hist, deadline=time.time() + 1):
+            pass
 
         if score == MATE_UPPER:
             print("Checkmate!")
@@ -454,15 +1149,27 @@ if __name__ == '__main__':
 """
 DISCORD
 """
+import io
 import os
+import json
+import functools
+import mmap
 import time
 import math
 import random
+import struct
+import textwrap
 import asyncio
 import requests
+import collections
+import multiprocessing
+from datetime import datetime
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import has_any_role, Cog, group
 
 
@@ -482,31 +1189,26 @@ CHESS_EMOTES = {
     'blank': "<:blank:780986666739433473>", 'blankL': "<:blankL:780986666936565770>", 'blankS': "<:blankS:780986666985979905>"
 }
 
-def get_chess_emote(char, flipped, x, y, last_move=None):
-    if flipped:
-        char = char.swapcase()
-    
-    highlighted = False
-    light = ((x + y) % 2 == 0) # from either side, top left is light square
-
-    if last_move is not None:
-        (lmfy, lmfx), (lmty, lmtx) = last_move
-        highlighted = (7-x == lmfx and y == lmfy) or (7-x == lmtx and y == lmty)
-
+def _emote_name(char, light, highlighted):
     if char == '.':
-        char = 'blank'
-    elif char == '\n':
-        return char
+        name = 'blank'
     elif char.isupper():
-        char = 'w' + (char.lower() if char == 'P' else char)
+        name = 'w' + (char.lower() if char == 'P' else char)
     else:
-        char = 'b' + (char if char == 'p' else char.upper())
-    
-    if highlighted:
-        char += 'S'
-    elif light:
-        char += 'L'
-    return CHESS_EMOTES[char]
+        name = 'b' + (char if char == 'p' else char.upper())
+    return name + ('S' if highlighted else 'L' if light else '')
+
+
+# Emote of each (piece or '.', light square, highlighted) as shown
+SQUARE_EMOTES = {(char, light, highlighted): CHESS_EMOTES[_emote_name(char, light, highlighted)]
+                 for char in 'KQRBNPkqrbnp.' for light in (False, True) for highlighted in (False, True)}
+
+
+@functools.lru_cache(maxsize=4096)
+def rank_emotes(row, light_first, highlighted=()):
+    """ Emotes for a rank of 8 squares as shown, highlighting the given
+    columns. Most ranks look the same from move to move, so they are cached. """
+    return ''.join(SQUARE_EMOTES[c, (j % 2 == 0) == light_first, j in highlighted] for j, c in enumerate(row))
 
 
 NUMBERS = [":one:", ":two:", ":three:", ":four:", ":five:", ":six:", ":seven:", ":eight:"]
@@ -522,16 +1224,932 @@ def flip_move(move):
 opening_moves = ['d2d4'] * 18 + ['e2e4'] * 18 + ['c2c4'] * 15 + ['g1f3'] * 10 + ['b1c3'] * 8 + \
     ['b2b3', 'a2a4', 'h2h4', 'g2g3', 'a2a3', 'h2h3', 'd2d3', 'e2e3']
 
+
+###############################################################################
+# Engine service
+###############################################################################
+
+# The search is pure CPU, so it runs in worker processes instead of on the
+# event loop. Each running job owns a slot in a shared array holding its
+# deadline; the worker polls it between depths, and cancelling a job just
+# zeroes it.
+#
+# All games share one pool. At most ENGINE_MAX_SEARCHES jobs run at once;
+# the rest wait their turn, taken round-robin across games so one busy
+# channel can't starve the others. Ponders only use idle capacity and are
+# stopped when a real search needs their place. A job's deadline is set when
+# it is submitted, so under load moves come back on time, just shallower.
+#
+# A search can also run on several cores (Lazy SMP): next to the main search,
+# helpers search the same position from staggered depths. All workers share
+# one transposition table in shared memory, so the main search finds what the
+# helpers worked out. Entries check themselves against their key, so torn
+# writes from two processes just read as misses and no lock is needed.
+ENGINE_WORKERS = int(os.getenv('CHESS_ENGINE_WORKERS', 1))
+# Processes per search, the main search included
+ENGINE_SEARCH_PROCESSES = max(1, int(os.getenv('CHESS_SEARCH_PROCESSES', 1)))
+ENGINE_MAX_SEARCHES = int(os.getenv('CHESS_MAX_SEARCHES', max(1, ENGINE_WORKERS // ENGINE_SEARCH_PROCESSES)))
+# Size of the shared transposition table, in MB.
+ENGINE_TABLE_MB = float(os.getenv('CHESS_TABLE_MB', TABLE_MB))
+# Seconds a worker may overrun its deadline before the event loop gives up.
+ENGINE_GRACE = 2
+# Largest node-count difficulty, and the seconds such a search may still take
+# at most on a loaded server.
+ENGINE_MAX_NODES = 200000
+ENGINE_NODES_TIME_CAP = 20
+# Post-game analysis has a pool of its own, two processes by default, so a
+# game's positions are searched side by side however few searches the live
+# games may run at once. Its processes run at a lower priority, so live games
+# keep the cores they need, and are shut down once no analysis has run for
+# ANALYSIS_IDLE_SECONDS.
+ANALYSIS_WORKERS = int(os.getenv('CHESS_ANALYSIS_WORKERS', min(2, os.cpu_count() or 1)))
+ANALYSIS_NICE = 10
+ANALYSIS_TABLE_MB = 8
+ANALYSIS_IDLE_SECONDS = 60
+
+# ponder -- the reply the engine expects, to think about on the player's time
+# nodes, seconds -- searched by the main search, helpers aside
+# table_hits -- share of table lookups that found their position
+# table_fill -- share of the table written by this search
+SearchResult = namedtuple('SearchResult', 'depth move score ponder nodes seconds table_hits table_fill')
+
+_worker_table = None
+_worker_searcher = None
+_worker_private_searcher = None
+_worker_deadlines = None
+
+
+def _init_engine_worker(deadlines, live_ages, table_name, size):
+    global _worker_table, _worker_searcher, _worker_deadlines
+    _worker_table = shared_memory.SharedMemory(table_name)
+    _worker_searcher = Searcher(buffer=_worker_table.buf[:size], live=live_ages)
+    _worker_deadlines = deadlines
+
+
+def _engine_search(slot, pos, history, max_nodes=None, age=None, max_depth=None):
+    """ Runs in a worker process. Returns the SearchResult of the last
+    completed depth once the slot's deadline has passed, max_nodes have
+    been searched or max_depth is done. """
+    global _worker_private_searcher
+    depth = move = score = ponder = None
+    deadline = lambda: _worker_deadlines[slot]
+    searcher = _worker_searcher
+    if max_nodes is not None or max_depth is not None:
+        # Search alone from an empty table, so the same position always
+        # gets the same move whatever else the engine searched before.
+        if _worker_private_searcher is None:
+            _worker_private_searcher = Searcher(ENGINE_TABLE_MB)
+        searcher = _worker_private_searcher
+        searcher.tp.clear()
+    start = time.time()
+    for depth, move, score in searcher.search(pos, history, deadline, max_nodes, age=age):
+        if max_depth is not None and depth >= max_depth:
+            break
+    seconds = time.time() - start
+    if move is not None:
+        # The table still holds the best reply to our move
+        reply = pos.move(move)
+        _, _, ponder = searcher.tp.probe(hash(reply) & 0x7FFFFFFFFFFFFFFF, 0, False)
+        if ponder not in reply.gen_moves():
+            ponder = None
+    tp = searcher.tp
+    return SearchResult(depth, move, score, ponder, searcher.nodes, seconds,
+                        tp.hits / tp.probes if tp.probes else 0, tp.fill())
+
+
+def _engine_helper(slot, pos, history, start_depth, age):
+    """ Runs in a worker process. Searches pos from start_depth to fill the
+    shared table until the slot's deadline passes. """
+    if _worker_deadlines[slot] < time.time():
+        # Queued behind other work until the main search was over
+        return
+    deadline = lambda: _worker_deadlines[slot]
+    for _ in _worker_searcher.search(pos, history, deadline, start_depth=start_depth, age=age):
+        pass
+
+
+_analysis_searcher = None
+
+
+def _init_analysis_worker():
+    if hasattr(os, 'nice'):
+        os.nice(ANALYSIS_NICE)
+
+
+def _analysis_search(pos, history, max_depth, time_cap):
+    """ Runs in an analysis process. Returns (score, move) of pos searched
+    from an empty table to max_depth, or as deep as time_cap seconds go. """
+    global _analysis_searcher
+    if _analysis_searcher is None:
+        _analysis_searcher = Searcher(ANALYSIS_TABLE_MB)
+    searcher = _analysis_searcher
+    searcher.tp.clear()
+    move = score = None
+    for depth, move, score in searcher.search(pos, history, time.time() + time_cap):
+        if depth >= max_depth:
+            break
+    return score, move
+
+
+class EngineJob:
+    """ A queued or running engine search. Await `result()` for its
+    SearchResult, which is None if the job was cancelled. A thinking_time
+    of None ponders until `ponderhit()` or `cancel()`. With max_nodes or
+    max_depth the search stops after that many nodes or at that depth, and
+    thinking_time is only a cap. A ponder searches in one process, and
+    starts its helpers on `ponderhit()`. """
+    def __init__(self, engine, pos, history, thinking_time, owner=None, max_nodes=None, max_depth=None):
+        self._engine = engine
+        self._max_nodes = max_nodes
+        self._max_depth = max_depth
+        self._slot = None
+        self._granted = None
+        # (pos, history, age) while the search runs, for starting helpers
+        self._search = None
+        self._helpers = []
+        self._deadline = math.inf if thinking_time is None else time.time() + thinking_time
+        self.owner = owner
+        self.pondering = thinking_time is None
+        self.started = None
+        self.cancelled = False
+        self._task = asyncio.ensure_future(self._run(pos, tuple(history)))
+
+    async def _run(self, pos, history):
+        self._slot = await self._engine._acquire(self)
+        if self._slot is None:
+            return None
+        age = None
+        try:
+            if self.cancelled:
+                return None
+            self.started = time.time()
+            self._engine._deadlines[self._slot] = self._deadline
+            age = self._engine.new_age(self.owner)
+            self._engine._live_ages[age] += 1
+            search = self._engine.submit(_engine_search, self._slot, pos, history, self._max_nodes, age, self._max_depth)
+            self._search = (pos, history, age)
+            if not self.pondering:
+                self._start_helpers()
+            try:
+                result = await self._wait(search)
+            except BrokenProcessPool:
+                # The worker died mid-search; retry once on a fresh pool
+                result = await self._wait(self._engine.submit(_engine_search, self._slot, pos, history, self._max_nodes, age, self._max_depth))
+            return None if self.cancelled else result
+        finally:
+            # Helpers stop with the main search, and must be done with the
+            # slot before it is handed on, but the result needn't wait.
+            self._engine._deadlines[self._slot] = 0
+            self._search = None
+            asyncio.ensure_future(self._release(self._helpers, age))
+
+    def _start_helpers(self):
+        if self._search is None or self._helpers or self._max_nodes is not None or self._max_depth is not None:
+            return
+        pos, history, age = self._search
+        self._helpers = [self._engine.submit(_engine_helper, self._slot, pos, history, depth, age)
+                         for depth in range(2, ENGINE_SEARCH_PROCESSES + 1)]
+
+    async def _release(self, helpers, age):
+        await asyncio.gather(*helpers, return_exceptions=True)
+        if age is not None:
+            self._engine._live_ages[age] -= 1
+        self._engine._release(self)
+        self._slot = None
+
+    async def _wait(self, future):
+        deadlines = self._engine._deadlines
+        while not future.done():
+            if time.time() - deadlines[self._slot] > ENGINE_GRACE:
+                # The search aborts within a few nodes of its deadline once
+                # it has a move. Past that (a worker that was still starting
+                # up, or a ponderhit racing the clock) stop it outright.
+                deadlines[self._slot] = 0
+                break
+            await asyncio.wait({future}, timeout=ENGINE_GRACE)
+        return await future
+
+    async def result(self):
+        return await self._task
+
+    def _set_deadline(self, deadline):
+        self._deadline = deadline
+        if self._slot is not None:
+            self._engine._deadlines[self._slot] = deadline
+
+    def ponderhit(self, thinking_time):
+        """ The predicted move was played. Keep going until the job has
+        thought for thinking_time in total, or stop now if it already has. """
+        now = time.time()
+        self.pondering = False
+        self._engine._promote(self)
+        self._start_helpers()
+        self._set_deadline(now + thinking_time if self.started is None else max(now, self.started + thinking_time))
+
+    def cancel(self):
+        self.cancelled = True
+        self._set_deadline(0)
+        self._engine._withdraw(self)
+
+
+class Engine:
+    """ Pool of worker processes running Searcher.search off the event loop """
+    def __init__(self, workers=ENGINE_WORKERS, max_searches=ENGINE_MAX_SEARCHES, table_mb=ENGINE_TABLE_MB,
+                 analysis_workers=ANALYSIS_WORKERS):
+        self._context = multiprocessing.get_context('spawn')
+        self._deadlines = self._context.RawArray('d', max_searches)
+        self._workers = workers
+        self._free_slots = list(range(max_searches))
+        self._running = set()
+        # owner -> jobs waiting, in the order owners get their next turn
+        self._waiting = collections.OrderedDict()
+        self._waiting_ponders = collections.deque()
+        self._table_size = table_bytes(table_mb)
+        self._table = shared_memory.SharedMemory(create=True, size=self._table_size)
+        self._age = 0
+        # owner -> its table age, and the number of running searches per age
+        self._ages = collections.OrderedDict()
+        self._live_ages = self._context.RawArray('i', 64)
+        self._pool = self._new_pool()
+        self._analysis_workers = analysis_workers
+        # Started on the first analysis, and shut down when idle
+        self._analysis_pool = None
+        self._analysing = 0
+        self._analysis_idle = None
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(
+            self._workers, mp_context=self._context, initializer=_init_engine_worker,
+            initargs=(self._deadlines, self._live_ages, self._table.name, self._table_size))
+
+    def new_age(self, owner=None):
+        """ The table age for a search for owner. A game's searches all get
+        the same one, so its entries from earlier moves stay live. """
+        if owner is not None and owner in self._ages:
+            self._ages.move_to_end(owner)
+            return self._ages[owner]
+        for _ in range(64):
+            self._age = (self._age + 1) & 63
+            if not self._live_ages[self._age]:
+                break
+        if owner is not None:
+            self._ages[owner] = self._age
+            if len(self._ages) > 64:
+                self._ages.popitem(last=False)
+        return self._age
+
+    def submit(self, fn, *args):
+        try:
+            future = self._pool.submit(fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool
+            self._pool = self._new_pool()
+            future = self._pool.submit(fn, *args)
+        return asyncio.wrap_future(future)
+
+    @property
+    def queued(self):
+        return sum(map(len, self._waiting.values()))
+
+    async def _acquire(self, job):
+        """ Waits for the job's turn and returns its slot, or None if it was
+        cancelled while waiting. """
+        if self._free_slots and not self._waiting and not (job.pondering and self._waiting_ponders):
+            return self._grant(job)
+        job._granted = asyncio.get_event_loop().create_future()
+        if job.pondering:
+            self._waiting_ponders.append(job)
+        else:
+            self._waiting.setdefault(job.owner, collections.deque()).append(job)
+            self._preempt_ponder()
+        return await job._granted
+
+    def _preempt_ponder(self):
+        """ Ponders give way to real searches """
+        for running in self._running:
+            if running.pondering:
+                running.cancel()
+                return
+
+    def _promote(self, job):
+        """ A waiting ponder became a real search; queue it as one """
+        if job._granted is None or job._granted.done():
+            return
+        self._waiting_ponders.remove(job)
+        self._waiting.setdefault(job.owner, collections.deque()).append(job)
+        self._preempt_ponder()
+
+    def _grant(self, job):
+        self._running.add(job)
+        return self._free_slots.pop()
+
+    def _release(self, job):
+        self._free_slots.append(job._slot)
+        self._running.discard(job)
+        while self._free_slots:
+            if self._waiting:
+                owner, jobs = next(iter(self._waiting.items()))
+                job = jobs.popleft()
+                # Round-robin: this owner goes to the back of the line
+                del self._waiting[owner]
+                if jobs:
+                    self._waiting[owner] = jobs
+            elif self._waiting_ponders:
+                job = self._waiting_ponders.popleft()
+            else:
+                break
+            job._granted.set_result(self._grant(job))
+
+    def _withdraw(self, job):
+        """ Drops a cancelled job from the queue if it hasn't started """
+        if job._granted is None or job._granted.done():
+            return
+        if job in self._waiting_ponders:
+            self._waiting_ponders.remove(job)
+        else:
+            self._waiting[job.owner].remove(job)
+            if not self._waiting[job.owner]:
+                del self._waiting[job.owner]
+        job._granted.set_result(None)
+
+    def start(self, pos, history, thinking_time, owner=None, max_nodes=None, max_depth=None):
+        return EngineJob(self, pos, history, thinking_time, owner, max_nodes, max_depth)
+
+    def ponder(self, pos, history, owner=None):
+        return EngineJob(self, pos, history, None, owner)
+
+    def _new_analysis_pool(self):
+        return ProcessPoolExecutor(self._analysis_workers, mp_context=self._context,
+                                   initializer=_init_analysis_worker)
+
+    async def analyse(self, pos, history, max_depth, time_cap):
+        """ (score, move) of pos, searched in the analysis pool. Searches
+        queue there, and time_cap counts from when a search starts. """
+        self._analysing += 1
+        if self._analysis_idle is not None:
+            self._analysis_idle.cancel()
+            self._analysis_idle = None
+        try:
+            for attempt in range(2):
+                if self._analysis_pool is None:
+                    self._analysis_pool = self._new_analysis_pool()
+                try:
+                    return await asyncio.wrap_future(
+                        self._analysis_pool.submit(_analysis_search, pos, tuple(history), max_depth, time_cap))
+                except BrokenProcessPool:
+                    # A worker died; try once more on a fresh pool
+                    self._analysis_pool = None
+                    if attempt:
+                        raise
+        finally:
+            self._analysing -= 1
+            if not self._analysing and self._analysis_pool is not None:
+                self._analysis_idle = asyncio.get_running_loop().call_later(
+                    ANALYSIS_IDLE_SECONDS, self._close_analysis_pool)
+
+    def _close_analysis_pool(self):
+        if self._analysis_idle is not None:
+            self._analysis_idle.cancel()
+            self._analysis_idle = None
+        if self._analysis_pool is not None:
+            self._analysis_pool.shutdown(wait=False, cancel_futures=True)
+            self._analysis_pool = None
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._close_analysis_pool()
+        self._table.close()
+        self._table.unlink()
+
+
+###############################################################################
+# Opening book
+###############################################################################
+
+# The book is a header followed by (key, move, weight) records sorted by the
+# Zobrist key of the position. Moves are from the side to move's view, as
+# gen_moves gives them. It is mapped into memory and binary searched, so it
+# costs next to nothing until a position is looked up.
+# Build it with `python -m cogs.chess_book cogs/data/chess/openings.txt`.
+BOOK_PATH = os.path.join(os.path.dirname(__file__), 'data/chess/openings.bin')
+BOOK_MAGIC = b'PZBK'
+BOOK_VERSION = 1
+BOOK_HEADER = struct.Struct('<4sII')  # magic, version, record count
+BOOK_RECORD = struct.Struct('<QHH')   # key, from*120 + to, weight
+
+
+class OpeningBook:
+    def __init__(self, path=BOOK_PATH):
+        self._map = None
+        self._count = 0
+        try:
+            with open(path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            print(f"No opening book at {path}, searching every move.")
+            return
+        magic, version, count = BOOK_HEADER.unpack_from(self._map)
+        if magic != BOOK_MAGIC or version != BOOK_VERSION:
+            print(f"Opening book at {path} is not a version {BOOK_VERSION} book, ignoring it.")
+            self.close()
+            return
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, index):
+        return BOOK_RECORD.unpack_from(self._map, BOOK_HEADER.size + index * BOOK_RECORD.size)
+
+    def moves(self, pos):
+        """ Returns [(move, weight)] for the position, empty once out of book """
+        key = pos.key
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = []
+        for index in range(lo, self._count):
+            record_key, code, weight = self._record(index)
+            if record_key != key:
+                break
+            found.append((divmod(code, 120), weight))
+        # Guard against key collisions with positions outside the book
+        legal = set(pos.gen_moves()) if found else ()
+        return [(move, weight) for move, weight in found if move in legal]
+
+    def choose(self, pos):
+        """ Picks a book move weighted by how often it was played, or None """
+        moves = self.moves(pos)
+        if not moves:
+            return None
+        return random.choices([m for m, _ in moves], weights=[w for _, w in moves])[0]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = None
+        self._count = 0
+
+
+###############################################################################
+# Endgame bitbases
+###############################################################################
+
+# One bit per position of king and pawn, rook or queen against a lone king,
+# set when the side with the piece wins. Positions are seen from the strong
+# side, rotated as sunfish rotates them when the weak side is to move, and
+# indexed by ((weak to move * 64 + strong king) * 64 + weak king) * 64 + piece
+# over 64 squares from a8. The files are mapped into memory, so every worker
+# shares them from the page cache.
+# Build them with `python -m cogs.chess_bitbase`.
+BITBASE_DIR = os.path.join(os.path.dirname(__file__), 'data/chess')
+BITBASE_MAGIC = b'PZBB'
+BITBASE_VERSION = 1
+BITBASE_HEADER = struct.Struct('<4sIc')  # magic, version, piece
+BITBASE_PIECES = b'PRQ'
+BITBASE_SIZE = 2 * 64 * 64 * 64 // 8
+# Won positions score this much, plus a little for progress: pushing the
+# pawn, or the lone king to the edge with the strong king close by.
+BITBASE_WIN = 20000
+
+_SQUARE64 = [(i // 10 - 2) * 8 + i % 10 - 1 for i in range(120)]
+
+
+def bitbase_index(squares):
+    """ (piece, index, weak side to move) for a king and piece against a
+    king, else None. Expects exactly three pieces on the board. """
+    king, other_king = squares.find(b'K'), squares.find(b'k')
+    if king < 0 or other_king < 0:
+        return None
+    for piece in BITBASE_PIECES:
+        i = squares.find(piece)
+        if i >= 0:
+            weak = False
+            break
+        i = squares.find(piece | 0x20)
+        if i >= 0:
+            weak = True
+            king, other_king, i = 119 - other_king, 119 - king, 119 - i
+            break
+    else:
+        return None
+    index = ((weak * 64 + _SQUARE64[king]) * 64 + _SQUARE64[other_king]) * 64 + _SQUARE64[i]
+    return piece, index, weak
+
+
+def _progress(piece, king, other_king, i):
+    """ How far a won position has come, all squares from the strong side """
+    if piece == ord('P'):
+        return 10 * (8 - i // 10)
+    row, col = other_king // 10, other_king % 10
+    edge = max(abs(2 * row - 11), abs(2 * col - 9))
+    distance = max(abs(row - king // 10), abs(col - king % 10))
+    return 100 + 10 * edge - 5 * distance
+
+
+class Bitbases:
+    def __init__(self, directory=BITBASE_DIR):
+        self._maps = {}
+        for piece in BITBASE_PIECES:
+            path = os.path.join(directory, f'k{chr(piece).lower()}k.bin')
+            try:
+                with open(path, 'rb') as f:
+                    bitbase = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                continue
+            magic, version, name = BITBASE_HEADER.unpack_from(bitbase)
+            if magic != BITBASE_MAGIC or version != BITBASE_VERSION or name[0] != piece \
+                    or len(bitbase) != BITBASE_HEADER.size + BITBASE_SIZE:
+                print(f"Bitbase at {path} is not a version {BITBASE_VERSION} bitbase, ignoring it.")
+                bitbase.close()
+                continue
+            self._maps[piece] = bitbase
+
+    def __len__(self):
+        return len(self._maps)
+
+    def probe(self, pos):
+        """ Score of pos for the side to move: 0 for a draw, about
+        BITBASE_WIN for a win or minus that for a loss. None if pos isn't in
+        a bitbase. """
+        squares = pos.squares
+        found = bitbase_index(squares)
+        if found is None or found[0] not in self._maps:
+            return None
+        # The last move left a king in check, which the search punishes
+        # by taking it; the bitbase has nothing to say about that
+        if is_attacked(squares, squares.find(b'k'), _OUR_ATTACKERS):
+            return None
+        piece, index, weak = found
+        bitbase = self._maps[piece]
+        if not bitbase[BITBASE_HEADER.size + (index >> 3)] >> (index & 7) & 1:
+            return 0
+        king, other_king, i = squares.find(b'K'), squares.find(b'k'), squares.find(piece | 0x20 * weak)
+        if weak:
+            king, other_king, i = 119 - other_king, 119 - king, 119 - i
+        score = BITBASE_WIN + _progress(piece, king, other_king, i)
+        return -score if weak else score
+
+    def close(self):
+        for bitbase in self._maps.values():
+            bitbase.close()
+        self._maps = {}
+
+
+BITBASES = Bitbases()
+
+
+###############################################################################
+# Experience
+###############################################################################
+
+# The deepest search result seen for each position, kept in the database so
+# it survives restarts, which empty the transposition table. The store is read
+# into memory when the cog starts, so looking a position up costs nothing.
+# New results are queued and written back in batches.
+# Past EXPERIENCE_MAX_ROWS, the positions used longest ago are dropped.
+EXPERIENCE_MAX_ROWS = 50000
+# Seconds between writes, and the most rows written per statement.
+EXPERIENCE_FLUSH_SECONDS = 60
+EXPERIENCE_BATCH = 500
+# Shallower results are found again too quickly to be worth a row.
+EXPERIENCE_MIN_DEPTH = 5
+
+KnownMove = namedtuple('KnownMove', 'depth move score')
+
+
+class ExperienceStore:
+    """ Position key -> the deepest KnownMove, backed by
+    puzzledb.chess_experience. Nothing is known or written until load()
+    has read the table. """
+    def __init__(self, db):
+        self._db = db
+        # Least recently used first
+        self._known = collections.OrderedDict()
+        self._dirty = set()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._known)
+
+    async def load(self):
+        try:
+            rows = await self._db.fetch(
+                "SELECT poskey, depth, move, score FROM puzzledb.chess_experience ORDER BY lastused DESC LIMIT $1;",
+                EXPERIENCE_MAX_ROWS)
+        except Exception as e:
+            print(f"Couldn't load the chess experience, not using it: {e}")
+            return
+        for key, depth, code, score in reversed(rows):
+            self._known[key] = KnownMove(depth, divmod(code, 120), score)
+        self.loaded = True
+
+    def lookup(self, pos):
+        """ The deepest KnownMove for pos, or None """
+        known = self._known.get(pos.key)
+        # Guard against key collisions, as the book does
+        if known is None or known.move not in pos.legal_moves():
+            return None
+        self._known.move_to_end(pos.key)
+        self._dirty.add(pos.key)
+        return known
+
+    def record(self, pos, result):
+        """ Keeps a SearchResult for pos if it went deeper than what we had """
+        if not self.loaded or result.move is None or result.depth < EXPERIENCE_MIN_DEPTH:
+            return
+        known = self._known.get(pos.key)
+        if known is not None and known.depth >= result.depth:
+            return
+        self._known[pos.key] = KnownMove(result.depth, result.move, result.score)
+        self._known.move_to_end(pos.key)
+        self._dirty.add(pos.key)
+        while len(self._known) > EXPERIENCE_MAX_ROWS:
+            key, _ = self._known.popitem(last=False)
+            self._dirty.discard(key)
+
+    async def flush(self):
+        """ Writes the queued results and trims the table to size """
+        if not self._dirty:
+            return
+        keys, self._dirty = list(self._dirty), set()
+        try:
+            for i in range(0, len(keys), EXPERIENCE_BATCH):
+                rows = [(key, known.depth, known.move[0] * 120 + known.move[1], known.score)
+                        for key in keys[i:i + EXPERIENCE_BATCH]
+                        for known in [self._known.get(key)] if known is not None]
+                if rows:
+                    await self._db.executemany(
+                        "INSERT INTO puzzledb.chess_experience (poskey, depth, move, score, lastused) "
+                        "VALUES ($1, $2, $3, $4, now()) ON CONFLICT (poskey) DO UPDATE SET depth = EXCLUDED.depth,"
+                        " move = EXCLUDED.move, score = EXCLUDED.score, lastused = EXCLUDED.lastused;",
+                        rows, retry=True)
+            await self._db.execute(
+                "DELETE FROM puzzledb.chess_experience WHERE poskey IN "
+                "(SELECT poskey FROM puzzledb.chess_experience ORDER BY lastused DESC OFFSET $1);",
+                EXPERIENCE_MAX_ROWS, retry=True)
+        except Exception as e:
+            # Try again with the next flush
+            print(f"Couldn't write the chess experience: {e}")
+            self._dirty.update(keys)
+
+
+
+###############################################################################
+# Game archive
+###############################################################################
+
+# Games are kept in puzzledb.chess_games with their moves in
+# puzzledb.chess_game_moves, one row per ply. Moves only change the game in
+# memory and mark it dirty; a loop writes the dirty games every
+# ARCHIVE_FLUSH_SECONDS, each in a few statements however many moves it got,
+# so a move never waits on the database. Moves are stored as coordinates
+# from White's side (g1f3), and SAN is worked out again for PGN.
+ARCHIVE_FLUSH_SECONDS = 30
+# Games read per exported PGN file.
+ARCHIVE_EXPORT_GAMES = 50
+
+
+class ArchivedGame:
+    """ A game as the archive keeps it. white and black are the players'
+    names, empty for the computer. result is a PGN result, '*' until the
+    game is decided. synced is how many plies the table already has. """
+    def __init__(self, channel_id, mode, difficulty, white='', black='', game_id=None,
+                 moves=(), result='*', started=None, ended=None):
+        self.id = game_id
+        self.channel_id = channel_id
+        self.mode = mode
+        self.difficulty = difficulty
+        self.white, self.black = white, black
+        self.moves = list(moves)
+        self.result = result
+        self.started = started or datetime.now()
+        self.ended = ended
+        self.synced = len(self.moves)
+
+
+def coordinates(move, black=False):
+    """ A move as g1f3 from White's side of the board """
+    mf, mt = (119 - move[0], 119 - move[1]) if black else move
+    return render(mf) + render(mt)
+
+
+def to_pgn(game, computer='Computer'):
+    positions, moves = replay(game.moves)
+    tags = [
+        ('Event', 'Puzzle Bot chess'),
+        ('Site', 'Discord'),
+        ('Date', game.started.strftime('%Y.%m.%d')),
+        ('Round', '-'),
+        ('White', game.white or computer),
+        ('Black', game.black or computer),
+        ('Result', game.result),
+        ('GameId', str(game.id)),
+        ('Mode', game.mode),
+        ('Difficulty', game.difficulty),
+    ]
+    tokens = []
+    for i, move in enumerate(moves):
+        if i % 2 == 0:
+            tokens.append(f"{i//2 + 1}.")
+        tokens.append(to_san(positions[i], move, i % 2 == 1))
+    tokens.append(game.result)
+    header = ''.join(f'[{name} "{value}"]\n' for name, value in tags)
+    return header + '\n' + textwrap.fill(' '.join(tokens), 79) + '\n'
+
+
+class GameArchive:
+    """ Write-behind store of ArchivedGames """
+    def __init__(self, db):
+        self._db = db
+        # Dirty games, in the order they changed
+        self._dirty = {}
+        # One flush at a time, or a new game could be inserted twice
+        self._flushing = asyncio.Lock()
+
+    def start(self, game):
+        self._dirty[game] = None
+
+    def push(self, game, move):
+        game.moves.append(move)
+        self._dirty[game] = None
+
+    def truncate(self, game, plies):
+        """ Takebacks """
+        del game.moves[plies:]
+        game.synced = min(game.synced, plies)
+        self._dirty[game] = None
+
+    def finish(self, game, result='*'):
+        game.result = result
+        game.ended = datetime.now()
+        self._dirty[game] = None
+
+    async def flush(self):
+        async with self._flushing:
+            games, self._dirty = list(self._dirty), {}
+            for game in games:
+                # Taken before writing, as moves keep coming while we wait
+                moves, synced = game.moves[:], game.synced
+                game.synced = len(moves)
+                try:
+                    await self._write(game, moves, synced)
+                except Exception as e:
+                    print(f"Couldn't archive chess game {game.id}: {e}")
+                    game.synced = min(game.synced, synced)
+                    self._dirty[game] = None
+
+    async def _write(self, game, moves, synced):
+        created = game.id is None
+        if created:
+            game.id = await self._db.fetchval(
+                "INSERT INTO puzzledb.chess_games (channelid, mode, difficulty, white, black, result, starttime, endtime) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING id;",
+                game.channel_id, game.mode, game.difficulty, game.white, game.black,
+                game.result, game.started, game.ended)
+        else:
+            await self._db.execute("UPDATE puzzledb.chess_games SET result = $1, endtime = $2 WHERE id = $3;",
+                                   game.result, game.ended, game.id, retry=True)
+        if not created:
+            # Takebacks leave rows past the moves we have
+            await self._db.execute("DELETE FROM puzzledb.chess_game_moves WHERE gameid = $1 AND ply >= $2;",
+                                   game.id, synced, retry=True)
+        if synced < len(moves):
+            await self._db.executemany(
+                "INSERT INTO puzzledb.chess_game_moves (gameid, ply, move) VALUES ($1, $2, $3);",
+                [(game.id, ply, moves[ply]) for ply in range(synced, len(moves))])
+
+    async def load(self, game_id):
+        """ The ArchivedGame with that id, or None """
+        await self.flush()
+        games = await self._read("g.id = $1", game_id, 1)
+        return games[0] if games else None
+
+    async def export(self, channel_id=None, game_id=None, computer='Computer'):
+        """ PGN of one game, or of the channel's latest games, oldest first """
+        await self.flush()
+        if game_id is not None:
+            games = await self._read("g.id = $1", game_id, 1)
+        else:
+            games = await self._read("g.channelid = $1", channel_id, ARCHIVE_EXPORT_GAMES)
+        return '\n'.join(to_pgn(game, computer) for game in reversed(games))
+
+    async def _read(self, condition, argument, limit):
+        """ The newest games matching the condition, on $1, with their moves
+        in (game, ply) order """
+        rows = await self._db.fetch(
+            "SELECT g.id, g.channelid, g.mode, g.difficulty, g.white, g.black, g.result, g.starttime, g.endtime, m.move "
+            "FROM (SELECT * FROM puzzledb.chess_games g WHERE " + condition + " ORDER BY g.id DESC LIMIT $2) g "
+            "LEFT JOIN puzzledb.chess_game_moves m ON m.gameid = g.id "
+            "ORDER BY g.id DESC, m.ply;",
+            argument, limit)
+        games = []
+        for game_id, channel_id, mode, difficulty, white, black, result, started, ended, move in rows:
+            if not games or games[-1].id != game_id:
+                games.append(ArchivedGame(channel_id, mode, difficulty, white, black, game_id,
+                                          result=result, started=started, ended=ended))
+            if move is not None:
+                games[-1].moves.append(move)
+                games[-1].synced += 1
+        return games
+
+
+###############################################################################
+# Engine telemetry
+###############################################################################
+
+# The last few computer moves are kept in memory for `chess stats`. With
+# CHESS_STATS_LOG set, each is also printed as a line of JSON.
+ENGINE_STATS_WINDOW = 500
+ENGINE_STATS_LOG = bool(os.getenv('CHESS_STATS_LOG'))
+
+# source -- what found the move: 'book', 'experience' for a deeper search
+#   from an earlier game, 'ponder' for a search begun on the player's time,
+#   else 'search'
+# seconds -- from the player's move to the reply, queueing included
+# budget -- the thinking time, None for node-count games
+# depth nodes nps table_hits table_fill -- of the search, None for book moves
+MoveStats = namedtuple('MoveStats', 'time channel source seconds budget depth nodes nps table_hits table_fill')
+
+
+def _percentile(values, fraction):
+    """ Nearest-rank percentile of a sorted list """
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class EngineStats:
+    """ Rolling window of MoveStats """
+    def __init__(self, window=ENGINE_STATS_WINDOW, log=ENGINE_STATS_LOG):
+        self._moves = collections.deque(maxlen=window)
+        self._log = log
+
+    def __len__(self):
+        return len(self._moves)
+
+    def record(self, channel_id, source, seconds, budget=None, result=None):
+        search = (None,) * 5
+        if result is not None:
+            search = (result.depth, result.nodes,
+                      round(result.nodes / result.seconds) if result.seconds else None,
+                      round(result.table_hits, 3), round(result.table_fill, 3))
+        stats = MoveStats(round(time.time(), 3), channel_id, source, round(seconds, 3), budget, *search)
+        self._moves.append(stats)
+        if self._log:
+            print('chess-stats ' + json.dumps(stats._asdict()))
+
+    def summary(self):
+        """ Moves by source, and how the searches went. None before the
+        first move. """
+        if not self._moves:
+            return None
+        searches = [m for m in self._moves if m.depth is not None]
+        timed = [m for m in searches if m.budget]
+        summary = {
+            'moves': len(self._moves),
+            'sources': collections.Counter(m.source for m in self._moves),
+            'searches': len(searches),
+        }
+        if searches:
+            seconds = sorted(m.seconds for m in searches)
+            depths = sorted(m.depth for m in searches)
+            rates = [m.nps for m in searches if m.nps]
+            summary.update(
+                depth=(depths[0], _percentile(depths, 0.5), depths[-1]),
+                nodes=sum(m.nodes for m in searches) // len(searches),
+                nps=sum(rates) // len(rates) if rates else 0,
+                table_hits=sum(m.table_hits for m in searches) / len(searches),
+                table_fill=max(m.table_fill for m in searches),
+                seconds=(_percentile(seconds, 0.5), _percentile(seconds, 0.9), seconds[-1]),
+            )
+        if timed:
+            summary.update(
+                budget_used=sum(m.seconds / m.budget for m in timed) / len(timed),
+                over_budget=sum(m.seconds > m.budget + ENGINE_GRACE for m in timed),
+            )
+        return summary
+
 """
 # TODO
-# Load Game
 # Resign
 # Offer Draw
-# Save games to database
 # Castle
-# Check / Mate / Stalemate
 """
 VERSION_LOG = [
+    "v1.2.7: Each game has one board message, updated as moves are played.",
+    "v1.2.6: Knows who wins with king and pawn, rook or queen against a lone king, and plays it out.",
+    "v1.2.5: Games are saved; continue one with `chess load` or download them with `chess pgn`.",
+    "v1.2.4: Analyzes finished games move by move with `chess analyze`.",
+    "v1.2.3: Remembers how deep it got in positions it has seen before.",
+    "v1.2.2: Knows checkmate, stalemate and check; illegal moves are refused.",
+    "v1.2.1: Stops thinking on time, and difficulty can be set as a number of positions.",
+    "v1.2.0: Games in several channels at once.",
+    "v1.1.9: Thinks on your time while you decide your move.",
+    "v1.1.8: Opening book for every book move, not just the first.",
+    "v1.1.7: Thinking no longer freezes the rest of the bot.",
     "v1.1.6: Fully functional takebacks.",
     "v1.1.4: Current match log and player list.",
     "v1.1.3: Highlighted moves (external emoji).",
@@ -542,18 +2160,73 @@ VERSION_LOG = [
     "v1.0.0: Basic Chess game."
 ]
 
+# Post-game analysis searches every position to ANALYSIS_DEPTH, for at most
+# ANALYSIS_TIME_CAP seconds each, and calls a move that loses at least
+# BLUNDER_SWING a blunder.
+ANALYSIS_DEPTH = 6
+ANALYSIS_TIME_CAP = 10
+BLUNDER_SWING = 200
+# Characters of the eval curve, from Black winning to White winning.
+EVAL_CURVE = '▁▂▃▄▅▆▇█'
+
+class ChessSession:
+    """ The game and settings of one channel """
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.thinking_time = 1
+        self.max_nodes = None
+        self.show_eval_bar = False
+        self.thonking = False
+        self.engine_job = None
+        self.ponder_job = None
+        self.ponder_move = None
+        self.takeback_judge = set()
+        self.analysing = False
+        # (positions, moves) of the last game, for `chess analyze`
+        self.current_game = self.finished_game = None
+        self.reset()
+
+    @property
+    def difficulty(self):
+        if self.max_nodes is not None:
+            return f"{self.max_nodes} nodes"
+        return f"{self.thinking_time}s"
+
+    def cancel_ponder(self):
+        if self.ponder_job is not None:
+            self.ponder_job.cancel()
+        self.ponder_job = self.ponder_move = None
+
+    def reset(self):
+        self.cancel_ponder()
+        if self.current_game and len(self.current_game) > 1:
+            self.finished_game = (self.current_game, self.last_move)
+        self.current_game = None
+        self.archived = None
+        self.board_message = None
+        self.joining_msg = None
+        self.takeback_msg = None
+        self.takeback_accepted = self.takeback_denied = False
+        self.mode = None
+        self.turn_is_white = True
+        self.move_history = []
+        self.last_move = []
+        self.participants = {'Black': set(), 'White': set(), 'Names': {}}
+
+
 class Chess(Cog):
     """
     CHESS
     """
     def __init__(self, bot):
         self.bot = bot
-        self._searcher = Searcher()
-        self._thonking = False
-        self.thinking_time = 1
+        self._engine = Engine()
+        self._book = OpeningBook()
+        self._experience = ExperienceStore(bot.db)
+        self._archive = GameArchive(bot.db)
+        self._stats = EngineStats()
         self._joining_time = 5
-        self._show_eval_bar = False
-        self.reset_game()
+        self._sessions = {}
         self.move_matchers = [
             ('([a-h][1-8])' * 2, 0),
             ('([KkQqRrBbNn]?)([a-h][1-8])', 1),
@@ -563,6 +2236,42 @@ class Chess(Cog):
     @Cog.listener()
     async def on_ready(self):
         print('Cog "Chess" Ready!')
+        if not self._experience.loaded:
+            await self._experience.load()
+        if self._experience.loaded and not self._write_experience.is_running():
+            self._write_experience.start()
+        if not self._write_archive.is_running():
+            self._write_archive.start()
+
+    def cog_unload(self):
+        for session in self._sessions.values():
+            session.cancel_ponder()
+        self._engine.shutdown()
+        self._book.close()
+        self._write_experience.cancel()
+        asyncio.ensure_future(self._experience.flush())
+        self._write_archive.cancel()
+        asyncio.ensure_future(self._archive.flush())
+
+    @tasks.loop(seconds=EXPERIENCE_FLUSH_SECONDS)
+    async def _write_experience(self):
+        await self._experience.flush()
+
+    @tasks.loop(seconds=ARCHIVE_FLUSH_SECONDS)
+    async def _write_archive(self):
+        await self._archive.flush()
+
+    def _finish(self, session, result):
+        """ Archives the game's result and ends it """
+        self._archive.finish(session.archived, result)
+        session.reset()
+
+    def _session(self, ctx):
+        """ Each channel plays its own game """
+        channel_id = ctx.channel.id
+        if channel_id not in self._sessions:
+            self._sessions[channel_id] = ChessSession(channel_id)
+        return self._sessions[channel_id]
 
     #####################
     # DISPLAY FUNCTIONS #
@@ -591,29 +2300,32 @@ class Chess(Cog):
             mf, mt = flip_move(mf), flip_move(mt)
         return ('abcdefgh'.index(mf[0]), '12345678'.index(mf[1])), ('abcdefgh'.index(mt[0]), '12345678'.index(mt[1]))
 
-    async def _send_board(self, ctx, board=None):
+    async def _send_board(self, ctx, board=None, moves=()):
+        """ Shows the board, and the moves just played, by editing the
+        game's board message. The first board of a game, or one whose message
+        is gone, is sent as a new message. """
+        session = self._session(ctx)
         if board is None:
-            board = self._current_game[-1]
+            board = session.current_game[-1]
 
         score = board.score
 
-        if self._last_move:
-            flip = ((not self._turn_is_white and self._mode != "PlayerB") or (self._turn_is_white and self._mode == 'PlayerB')) ^ (self._takeback_accepted)
-            last_move = self.convert_move_to_coord(self._last_move[-1], flip)
-            # print(self._last_move, last_move)
-        else:
-            last_move = None
-        
+        # (file, rank) of the squares to highlight
+        last_move = ()
+        if session.last_move:
+            flip = ((not session.turn_is_white and session.mode != "PlayerB") or (session.turn_is_white and session.mode == 'PlayerB')) ^ (session.takeback_accepted)
+            last_move = self.convert_move_to_coord(session.last_move[-1], flip)
+
 
         flipped = False
-        if self._mode == 'PlayerW':
+        if session.mode == 'PlayerW':
             board = board.board.strip()
-        elif self._mode == 'PlayerB':
+        elif session.mode == 'PlayerB':
             flipped = True
             board = board.board.strip()
             score = -score
         else:
-            if not self._turn_is_white:
+            if not session.turn_is_white:
                 board = board.rotate().board.strip()
                 score = -score
             else:
@@ -621,39 +2333,66 @@ class Chess(Cog):
 
         score_rounded = round(self.sigmoid(score) * 8)
 
-        final_str = (''.join(reversed(RANK_LABELS)) if self._mode == 'PlayerB' else ''.join(RANK_LABELS)) + ':triangular_ruler:' + (" " * 3 + str(score) if self._show_eval_bar else '') + "\n"
+        final_str = (''.join(reversed(RANK_LABELS)) if session.mode == 'PlayerB' else ''.join(RANK_LABELS)) + ':triangular_ruler:' + (" " * 3 + str(score) if session.show_eval_bar else '') + "\n"
         numbers = NUMBERS
-        if self._mode == 'PlayerB':
+        if session.mode == 'PlayerB':
             numbers = list(reversed(numbers))
+        if flipped:
+            board = board.swapcase()
         board = board.split('\n')
         for i in range(8):
-            final_str += ''.join([get_chess_emote(c, flipped, i, j, last_move) for j, c in enumerate(board[i].strip())])
+            highlighted = tuple(sorted(file for file, rank in last_move if 7 - rank == i))
+            final_str += rank_emotes(board[i].strip(), i % 2 == 0, highlighted)
             final_str += numbers[8-i-1]
-            if self._show_eval_bar:
-                if self._mode == 'PlayerB':
+            if session.show_eval_bar:
+                if session.mode == 'PlayerB':
                     final_str += "   " + ("⬛" if i >= score_rounded else "⬜")
                 else:
                     final_str += "   " + ("⬜" if (8-i-1) < score_rounded else "⬛")
             final_str += '\n'
+
+        embed = None
+        if moves:
+            embed = new_embed()
+            embed.set_author(name='   '.join(moves))
+        if session.board_message is not None:
+            try:
+                await session.board_message.edit(content=final_str, embed=embed)
+                return
+            except discord.HTTPException:
+                # Deleted, or too old to edit
+                session.board_message = None
         try:
-            await ctx.send(final_str)
+            session.board_message = await ctx.send(final_str, embed=embed)
         except:
             await ctx.send("Failed to send the board. Please check logs.")
             print(final_str)
         
-    async def _send_reversed_board(self, ctx):
-        await self._send_board(ctx, self._current_game[-1].rotate())
-
-    def reset_game(self):
-        self._current_game = None
-        self._joining_msg = None
-        self._takeback_msg = None
-        self._takeback_accepted = self._takeback_denied = False
-        self._mode = None
-        self._turn_is_white = True
-        self._move_history = []
-        self._last_move = []
-        self._participants = {'Black': set(), 'White': set(), 'Names': {}}
+    async def _send_reversed_board(self, ctx, moves=()):
+        session = self._session(ctx)
+        await self._send_board(ctx, session.current_game[-1].rotate(), moves)
+
+    @staticmethod
+    def _ending(pos):
+        """ 'checkmate' or 'stalemate' if the side to move can't move, else None """
+        if any(pos.is_legal(move) for move in pos.gen_moves()):
+            return None
+        return 'checkmate' if pos.in_check() else 'stalemate'
+
+    @staticmethod
+    def _check_suffix(pos, ending):
+        if ending == 'checkmate':
+            return '#'
+        return '+' if pos.in_check() else ''
+
+    def _start_ponder(self, session, reply):
+        """ Think about the position after the reply we expect, on the player's time """
+        session.cancel_ponder()
+        if reply is None:
+            return
+        game = session.current_game
+        session.ponder_job = self._engine.ponder(game[-1].move(reply), game + [game[-1].move(reply)], session.channel_id)
+        session.ponder_move = reply
 
     @group(name="chess", invoke_without_command=True)
     async def chess(self, ctx):
@@ -664,6 +2403,7 @@ class Chess(Cog):
     ########
 
     async def chess_help(self, ctx):
+        session = self._session(ctx)
         embed = new_embed()
         embed.set_author(name="Puzzle Hunt Commands:")
         embed.add_field(
@@ -680,7 +2420,7 @@ class Chess(Cog):
             inline=True)
         embed.add_field(
             name=f"{self.bot.BOT_PREFIX}chess difficulty <n>",
-            value="Set bot difficulty (n = seconds to think per move)",
+            value="Set bot difficulty (n = seconds to think per move, or `n nodes`)",
             inline=True)
         embed.add_field(
             name=f"{self.bot.BOT_PREFIX}chess evalbar",
@@ -690,11 +2430,23 @@ class Chess(Cog):
             name=f"{self.bot.BOT_PREFIX}chess log",
             value="Move log of the current match",
             inline=True)
+        embed.add_field(
+            name=f"{self.bot.BOT_PREFIX}chess analyze [moves]",
+            value="Analyze the last game, or one given as a move list",
+            inline=True)
+        embed.add_field(
+            name=f"{self.bot.BOT_PREFIX}chess load <id>",
+            value="Continue a saved game",
+            inline=True)
+        embed.add_field(
+            name=f"{self.bot.BOT_PREFIX}chess pgn [id]",
+            value="Download a game, or this channel's latest games, as PGN",
+            inline=True)
         embed.add_field(
             name=f"{self.bot.BOT_PREFIX}takeback",
             value="Take back your last move",
             inline=True)
-        embed.set_footer(text=f"Note: This bot doesn\'t understand checkmate; you have to take the king.\nCurrent difficulty: {self.thinking_time}.\nEval bar: {('OFF', 'ON')[self._show_eval_bar]}")
+        embed.set_footer(text=f"Current difficulty: {session.difficulty}.\nEval bar: {('OFF', 'ON')[session.show_eval_bar]}")
         await ctx.send(embed=embed)
 
 
@@ -706,25 +2458,226 @@ class Chess(Cog):
             await self._send_as_embed(ctx, VERSION_LOG[0])
 
 
+    @has_any_role("Bot Maintainer")
+    @chess.command(name="stats")
+    async def engine_stats(self, ctx):
+        summary = self._stats.summary()
+        if summary is None:
+            await self._send_as_embed(ctx, "The computer hasn't moved yet!")
+            return
+        embed = new_embed()
+        embed.set_author(name=f"Engine, last {summary['moves']} computer moves")
+        embed.add_field(
+            name="Moves from",
+            value="\n".join(f"{source}: {n}" for source, n in summary['sources'].most_common()),
+            inline=True)
+        if summary['searches']:
+            embed.add_field(
+                name=f"{summary['searches']} searches",
+                value=f"depth {'/'.join(map(str, summary['depth']))} (min/median/max)\n"
+                      f"{summary['nodes']} nodes, {summary['nps']} nodes/s\n"
+                      f"table hits {summary['table_hits']:.0%}, fill up to {summary['table_fill']:.0%}",
+                inline=True)
+            embed.add_field(
+                name="Reply time",
+                value="{:.1f}s/{:.1f}s/{:.1f}s (median/90%/max)".format(*summary['seconds'])
+                      + (f"\n{summary['budget_used']:.0%} of the thinking time on average"
+                         f"\n{summary['over_budget']} over time" if 'budget_used' in summary else ""),
+                inline=False)
+        embed.set_footer(text=f"Workers: {ENGINE_WORKERS}, table: {ENGINE_TABLE_MB:g} MB, queued: {self._engine.queued}")
+        await ctx.send(embed=embed)
+
+
     @chess.command(name="history", aliases=['log'])
     async def view_match_history(self, ctx, *_):
-        if not self._current_game:
+        session = self._session(ctx)
+        if not session.current_game:
             await self._send_as_embed(ctx, 'No match currently happening!')
             return
-        log = self._move_history
+        log = session.move_history
         await self._send_as_embed(
             ctx, "Current match log:",
             "\n".join(f"{i//2 + 1}.\t{log[i]}\t{log[i+1] if i+1 < len(log) else '--'}" for i in range(0, len(log), 2)) if len(log) else "1.\t--"
         )
 
+    @staticmethod
+    def _move_name(pos, move, black):
+        """ e.g. Ng1f3, from White's side of the board """
+        return pos.board[move[0]].upper().replace('P', '') + coordinates(move, black)
+
+    @staticmethod
+    def _format_score(score):
+        if abs(score) >= MATE_LOWER:
+            return '+M' if score > 0 else '-M'
+        return f"{score / 100:+.2f}"
+
+    async def _evaluate(self, positions):
+        """ Searches all positions of a game at once, to ANALYSIS_DEPTH, on
+        the engine's analysis pool. Returns (score, best move) for each,
+        with the score for the side to move. """
+        async def evaluate(i, pos):
+            ending = self._ending(pos)
+            if ending:
+                return (-MATE_UPPER if ending == 'checkmate' else 0), None
+            return await self._engine.analyse(pos, positions[:i + 1], ANALYSIS_DEPTH, ANALYSIS_TIME_CAP)
+        return await asyncio.gather(*(evaluate(i, pos) for i, pos in enumerate(positions)))
+
+    @chess.command(name="analyze", aliases=['analyse'])
+    async def analyze_game(self, ctx, *moves):
+        session = self._session(ctx)
+        if moves:
+            try:
+                positions, played = replay(moves)
+            except ValueError as e:
+                await self._send_as_embed(ctx, "Couldn't read that game.", str(e))
+                return
+        elif session.finished_game is not None:
+            positions, played = session.finished_game
+        else:
+            await self._send_as_embed(ctx, "No finished game to analyze!", f"Give the moves instead, e.g. {self.bot.BOT_PREFIX}chess analyze e4 e5 Nf3 Nc6")
+            return
+        if not played:
+            await self._send_as_embed(ctx, "There are no moves to analyze!")
+            return
+        if session.analysing:
+            await self._send_as_embed(ctx, "I'm already analyzing a game here!")
+            return
+
+        session.analysing = True
+        try:
+            async with ctx.typing():
+                evaluations = await self._evaluate(positions)
+        finally:
+            session.analysing = False
+
+        # Scores from White's side, as the eval bar shows them
+        white_scores = [None if score is None else score if i % 2 == 0 else -score
+                        for i, (score, _) in enumerate(evaluations)]
+        curve = ''.join(' ' if score is None else EVAL_CURVE[min(int(self.sigmoid(score) * len(EVAL_CURVE)), len(EVAL_CURVE) - 1)]
+                        for score in white_scores[1:])
+        lines, blunders = [], []
+        for i, move in enumerate(played):
+            black = i % 2 == 1
+            number = f"{i//2 + 1}{'...' if black else '.'}"
+            name = self._move_name(positions[i], move, black)
+            before, best = evaluations[i]
+            after = evaluations[i + 1][0]
+            # What the move cost the player, as both scores are for the side to move
+            swing = before + after if before is not None and after is not None else 0
+            line = f"{number:<5} {name:<7}{'??' if swing >= BLUNDER_SWING else '  '}"
+            if white_scores[i + 1] is not None:
+                line += f" {self._format_score(white_scores[i + 1]):>7}"
+            if best is not None and best != move:
+                line += f"  best {self._move_name(positions[i], best, black)}"
+            lines.append(line)
+            if swing >= BLUNDER_SWING:
+                blunders.append(f"{number} {name}?? ({self._format_score(white_scores[i])} → {self._format_score(white_scores[i + 1])})"
+                                + (f", best was {self._move_name(positions[i], best, black)}" if best not in (None, move) else ""))
+
+        embed = new_embed()
+        embed.set_author(name=f"Analysis of {len(played)} plies at depth {ANALYSIS_DEPTH}")
+        embed.add_field(name="Eval", value=f"`{curve[:1000]}`", inline=False)
+        embed.add_field(
+            name=f"Blunders ({len(blunders)})",
+            value='\n'.join(blunders[:10]) + ('\n...' if len(blunders) > 10 else '') if blunders else "None!",
+            inline=False)
+        embed.set_footer(text="Every move with the eval after it and the move I'd have played is attached.")
+        report = io.BytesIO('\n'.join(lines).encode('utf-8'))
+        await ctx.send(embed=embed, file=discord.File(report, filename='analysis.txt'))
+
+    @chess.command(name="pgn")
+    async def export_pgn(self, ctx, game_id=None):
+        session = self._session(ctx)
+        if game_id is not None and not game_id.isnumeric():
+            await self._send_as_embed(ctx, f"Use {self.bot.BOT_PREFIX}chess pgn <game id>, or no id for this channel's latest games.")
+            return
+        async with ctx.typing():
+            pgn = await self._archive.export(session.channel_id, game_id and int(game_id), self.bot.BOT_NAME)
+        if not pgn:
+            await self._send_as_embed(ctx, "No games found!")
+            return
+        name = f"game-{game_id}.pgn" if game_id else "games.pgn"
+        await ctx.send(file=discord.File(io.BytesIO(pgn.encode('utf-8')), filename=name))
+
+    @chess.command(name="load")
+    async def load_game(self, ctx, game_id=None):
+        session = self._session(ctx)
+        if game_id is None or not game_id.isnumeric():
+            await self._send_as_embed(ctx, f"Use {self.bot.BOT_PREFIX}chess load <game id> to continue a game.")
+            return
+        if session.current_game is not None:
+            await self._send_as_embed(ctx, "A game is already in progress!")
+            return
+        archived = await self._archive.load(int(game_id))
+        if archived is None:
+            await self._send_as_embed(ctx, "No game with that id!")
+            return
+        try:
+            positions, moves = replay(archived.moves)
+        except ValueError as e:
+            await self._send_as_embed(ctx, "That game can't be replayed.", str(e))
+            return
+        if archived.result != '*' or self._ending(positions[-1]):
+            session.finished_game = (positions, moves)
+            await self._send_as_embed(ctx, f"Game {archived.id} is over ({archived.result}).",
+                                      f"Use {self.bot.BOT_PREFIX}chess analyze to go over it, or {self.bot.BOT_PREFIX}chess pgn {archived.id}.")
+            return
+        computer_to_move = (archived.mode == 'PlayerW' and len(moves) % 2 == 1
+                            or archived.mode == 'PlayerB' and len(moves) % 2 == 0)
+        if computer_to_move:
+            if not moves:
+                await self._send_as_embed(ctx, "That game hasn't started yet!")
+                return
+            # Stopped while the computer thought; the player moves again
+            positions, moves = positions[:-1], moves[:-1]
+            self._archive.truncate(archived, len(moves))
+
+        session.reset()
+        session.current_game = positions
+        session.last_move = moves
+        session.move_history = [
+            self._move_name(positions[i], move, i % 2 == 1)
+            + self._check_suffix(positions[i + 1], self._ending(positions[i + 1]))
+            for i, move in enumerate(moves)]
+        session.mode = archived.mode
+        session.turn_is_white = len(moves) % 2 == 0
+        # Whoever loads the game takes over the players' sides
+        sides = {'PlayerW': ['White'], 'PlayerB': ['Black']}.get(archived.mode, ['White', 'Black'])
+        for side in sides:
+            session.participants[side].add(ctx.author.id)
+        session.participants['Names'][ctx.author.id] = ctx.author.display_name
+        archived.result, archived.ended = '*', None
+        session.archived = archived
+
+        await self._send_as_embed(ctx, f"Continuing game {archived.id}, {'White' if session.turn_is_white else 'Black'} to move.")
+        # Shown as it was right after the last move
+        session.turn_is_white = not session.turn_is_white
+        if session.mode == 'PvP':
+            await self._send_reversed_board(ctx)
+        else:
+            await self._send_board(ctx)
+        session.turn_is_white = not session.turn_is_white
+
     ############
     # SETTINGS #
     ############
 
     @chess.command(name="difficulty")
-    async def set_difficulty(self, ctx, value=None):
+    async def set_difficulty(self, ctx, value=None, unit=None):
+        session = self._session(ctx)
         if not value:
-            await self._send_as_embed(ctx, "Set difficulty of the chess bot, by allowing it to think longer.", f"Current difficulty: {self.thinking_time}.\nFor example, {self.bot.BOT_PREFIX}chess difficulty 5 gives the bot 5 seconds to think per move.")
+            await self._send_as_embed(ctx, "Set difficulty of the chess bot, by allowing it to think longer.", f"Current difficulty: {session.difficulty}.\nFor example, {self.bot.BOT_PREFIX}chess difficulty 5 gives the bot 5 seconds to think per move, and {self.bot.BOT_PREFIX}chess difficulty 20000 nodes has it search 20000 positions, however busy the bot is.")
+            return
+        if unit is not None:
+            if unit.lower() not in ('node', 'nodes') or not value.isnumeric() or int(value) <= 0:
+                await self._send_as_embed(ctx, "Use e.g. 20000 nodes to set the difficulty as a number of positions to search.")
+                return
+            if int(value) > ENGINE_MAX_NODES:
+                await self._send_as_embed(ctx, "That's too long to think.")
+                return
+            session.max_nodes = int(value)
+            session.cancel_ponder()
+            await self._send_as_embed(ctx, f"I will now search {session.max_nodes} positions per move.")
             return
         if not value.isnumeric():
             await self._send_as_embed(ctx, "Argument for difficulty must be a number i.e. the time in seconds the bot gets to think per move.")
@@ -736,13 +2689,15 @@ class Chess(Cog):
         if value > 10:
             await self._send_as_embed(ctx, "That's too long to think.")
             return
-        self.thinking_time = value
+        session.thinking_time = value
+        session.max_nodes = None
         await self._send_as_embed(ctx, f"I will now think {value} seconds per move.")
 
     @chess.command(name="evalbar")
     async def toggle_evalbar(self, ctx, value=None):
-        self._show_eval_bar = not self._show_eval_bar
-        await self._send_as_embed(ctx, f"Eval bar is {'ON' if self._show_eval_bar else 'OFF'}.")
+        session = self._session(ctx)
+        session.show_eval_bar = not session.show_eval_bar
+        await self._send_as_embed(ctx, f"Eval bar is {'ON' if session.show_eval_bar else 'OFF'}.")
     
     @has_any_role("Bot Maintainer")
     @chess.command(name="joiningtime")
@@ -766,10 +2721,11 @@ class Chess(Cog):
 
     @chess.command(name="play")
     async def play_chess(self, ctx):
-        if self._joining_msg is not None:
+        session = self._session(ctx)
+        if session.joining_msg is not None:
             return
-        if self._current_game is None:
-            self.reset_game()
+        if session.current_game is None:
+            session.reset()
             embed = new_embed()
             embed.add_field(
                 name=f"Starting a game in {self._joining_time}s...",
@@ -780,7 +2736,7 @@ class Chess(Cog):
             await msg.add_reaction(CHESS_EMOTES['wK']) # "⬜")
             await msg.add_reaction(CHESS_EMOTES['bK']) # "⬛")
             
-            self._joining_msg = msg
+            session.joining_msg = msg
             for i in range(self._joining_time-1, 0, -1):
                 embed = new_embed()
                 embed.add_field(
@@ -789,42 +2745,54 @@ class Chess(Cog):
                 )
                 await msg.edit(embed=embed)
                 await asyncio.sleep(0.5)
-            self._joining_msg = None
+            session.joining_msg = None
 
-            w_players = self._participants['White']
-            b_players = self._participants['Black']
+            w_players = session.participants['White']
+            b_players = session.participants['Black']
 
             match_start_embed = new_embed()
             
             if len(w_players) == 0 and len(b_players) == 0:
-                self._participants['White'].add(game_starter)
-                self._participants['Names'][game_starter] = ctx.author.display_name
-                w_players = self._participants['White']
+                session.participants['White'].add(game_starter)
+                session.participants['Names'][game_starter] = ctx.author.display_name
+                w_players = session.participants['White']
             
-            w_player_list = '\n'.join([self._participants['Names'][mem] for mem in w_players])
-            b_player_list = '\n'.join([self._participants['Names'][mem] for mem in b_players])
+            w_player_list = '\n'.join([session.participants['Names'][mem] for mem in w_players])
+            b_player_list = '\n'.join([session.participants['Names'][mem] for mem in b_players])
+
+            # Archived before the game's first await, as moves and stops can come from then on
+            session.archived = ArchivedGame(session.channel_id,
+                                            'PlayerW' if len(b_players) == 0 else 'PlayerB' if len(w_players) == 0 else 'PvP',
+                                            session.difficulty,
+                                            ', '.join(session.participants['Names'][mem] for mem in w_players),
+                                            ', '.join(session.participants['Names'][mem] for mem in b_players))
+            self._archive.start(session.archived)
 
             if len(b_players) == 0:
-                self._current_game = [Position(initial, 0, (True,True), (True,True), 0, 0)]
-                self._mode = 'PlayerW'
+                session.current_game = [CompactPosition(initial, 0, (True,True), (True,True), 0, 0)]
+                session.mode = 'PlayerW'
                 match_start_embed.set_author(name="You are playing as White against Computer!")
                 
             elif len(w_players) == 0:
-                self._current_game = [Position(initial, 0, (True,True), (True,True), 0, 0)]
-                self._mode = 'PlayerB'
+                session.current_game = [CompactPosition(initial, 0, (True,True), (True,True), 0, 0)]
+                session.mode = 'PlayerB'
                 async with ctx.typing():
-                    self._thonking = True
-                    opening = random.choice(opening_moves)
-                    move = (parse(opening[:2]), parse(opening[2:]))
-                    self._current_game.append(
-                        self._current_game[-1].move(move)
+                    session.thonking = True
+                    move = self._book.choose(session.current_game[-1])
+                    if move is None:
+                        opening = random.choice(opening_moves)
+                        move = (parse(opening[:2]), parse(opening[2:]))
+                    opening = render(move[0]) + render(move[1])
+                    session.current_game.append(
+                        session.current_game[-1].move(move)
                     )
-                    self._last_move.append(move)
-                    self._thonking = False
+                    session.last_move.append(move)
+                    self._archive.push(session.archived, coordinates(move))
+                    session.thonking = False
                     match_start_embed.set_author(name="You are playing as Black against Computer!")
             else:
-                self._current_game = [Position(initial, 0, (True,True), (True,True), 0, 0)]
-                self._mode = 'PvP'
+                session.current_game = [CompactPosition(initial, 0, (True,True), (True,True), 0, 0)]
+                session.mode = 'PvP'
                 match_start_embed.set_author(name="This is a player vs player game! White's turn.")
             match_start_embed.add_field(
                 name='White',
@@ -839,13 +2807,13 @@ class Chess(Cog):
             await ctx.send(embed=match_start_embed)
             
             await self._send_board(ctx)
-            if self._mode == 'PlayerB':
+            if session.mode == 'PlayerB':
                 # Show First move
-                self._turn_is_white = False
+                session.turn_is_white = False
                 await self._send_as_embed(ctx, "White: " + opening)
                 if opening in ['g1f3', 'b1c3']:
                     opening = 'N' + opening
-                self._move_history.append(opening)
+                session.move_history.append(opening)
                 pass
             await self._send_as_embed(ctx, f"Make your first move with `{self.bot.BOT_PREFIX}m`!")
         else:
@@ -855,37 +2823,50 @@ class Chess(Cog):
     @Cog.listener()
     async def on_raw_reaction_add(self, *payload):
         payload = payload[0]
-        if self._joining_msg and payload.message_id == self._joining_msg.id and payload.user_id != self.bot.user.id:
+        session = self._sessions.get(payload.channel_id)
+        if session is None:
+            return
+        if session.joining_msg and payload.message_id == session.joining_msg.id and payload.user_id != self.bot.user.id:
             emote = payload.emoji.name
             # print(emote)
             if emote == 'wK':# '⬜': #
                 # White
-                self._participants['White'].add(payload.user_id)
-                self._participants['Names'][payload.user_id] = payload.member.display_name
+                session.participants['White'].add(payload.user_id)
+                session.participants['Names'][payload.user_id] = payload.member.display_name
             elif emote == 'bK': # '⬛':  #
                 # Black
-                self._participants['Black'].add(payload.user_id)
-                self._participants['Names'][payload.user_id] = payload.member.display_name
-        elif self._takeback_msg and payload.message_id == self._takeback_msg.id and payload.user_id != self.bot.user.id:
-            if payload.user_id not in self._takeback_judge:
+                session.participants['Black'].add(payload.user_id)
+                session.participants['Names'][payload.user_id] = payload.member.display_name
+        elif session.takeback_msg and payload.message_id == session.takeback_msg.id and payload.user_id != self.bot.user.id:
+            if payload.user_id not in session.takeback_judge:
                 return
             emote = payload.emoji.name
             if emote == '🇾':
                 # Accept
-                self._takeback_accepted = True
+                session.takeback_accepted = True
             elif emote == '🇳':
                 # Refuse
-                self._takeback_denied = True
+                session.takeback_denied = True
 
 
     @chess.command(name="stop")
     async def stop_chess(self, ctx):
-        if self._current_game is None:
+        session = self._session(ctx)
+        if session.current_game is None:
             await self._send_as_embed(ctx, "No game is currently in progress! Use play to start one.")
             return
         else:
-            self.reset_game()
-            await self._send_as_embed(ctx, "Game has been stopped.")
+            if session.engine_job is not None:
+                session.engine_job.cancel()
+                session.thonking = False
+            archived = session.archived
+            self._finish(session, '*')
+            # Not a move, so it can wait for the id to tell the players
+            await self._archive.flush()
+            if archived.id is None:
+                await self._send_as_embed(ctx, "Game has been stopped.")
+            else:
+                await self._send_as_embed(ctx, "Game has been stopped.", f"Continue it later with `{self.bot.BOT_PREFIX}chess load {archived.id}`.")
             return
 
     async def invalid_move(self, ctx):
@@ -896,29 +2877,30 @@ class Chess(Cog):
 
     @commands.command(name="move", aliases=["m"])
     async def chess_move(self, ctx, *move):
-        if not self._current_game:
+        session = self._session(ctx)
+        if not session.current_game:
             await self._send_as_embed(ctx, "No current match!")
             return
-        if ctx.author.id not in self._participants['White'] and ctx.author.id not in self._participants['Black']:
+        if ctx.author.id not in session.participants['White'] and ctx.author.id not in session.participants['Black']:
             await self._send_as_embed(ctx, "You are not a participant of this game!", "Please react to the 'play' message for the next match.")
             return
-        if self._turn_is_white and ctx.author.id not in self._participants['White']:
+        if session.turn_is_white and ctx.author.id not in session.participants['White']:
             await self._send_as_embed(ctx, "Opponent's turn!")
             return
-        if not self._turn_is_white and ctx.author.id not in self._participants['Black']:
+        if not session.turn_is_white and ctx.author.id not in session.participants['Black']:
             await self._send_as_embed(ctx, "Opponent's turn!")
             return
-        if self._thonking:
+        if session.thonking:
             await self._send_as_embed(ctx, "I'm still thinking!")
             return
         if not move:
             await self._send_as_embed(ctx, "Use a valid chess move e.g. Qd7 or d2d7.")
             return
-        if not self._current_game:
+        if not session.current_game:
             await self._send_as_embed(ctx, "No game is currently running.")
             return
 
-        self._thonking = True
+        session.thonking = True
 
         move = ''.join(move).replace(' ', '').replace('x', '')
         for matcher, matcher_idx in self.move_matchers:
@@ -927,14 +2909,14 @@ class Chess(Cog):
                 if matcher_idx == 0:
                     movefrom = match.group(1)
                     moveto = match.group(2)
-                    if not self._turn_is_white:
+                    if not session.turn_is_white:
                         movefrom = flip_move(movefrom)
                         moveto = flip_move(moveto)
                     parsed_move = parse(movefrom), parse(moveto)
                     break
                 elif matcher_idx == 1:  # Qd7 format
                     piece, moveto = match.group(1), match.group(2)
-                    if not self._turn_is_white:
+                    if not session.turn_is_white:
                         moveto = flip_move(moveto)
                     piece = piece.upper()
                     if piece in ['K', 'Q', 'R', 'B', 'N', '']:
@@ -942,7 +2924,7 @@ class Chess(Cog):
                 else:
                     movefrom = match.group(2)
                     moveto = match.group(3)
-                    if not self._turn_is_white:
+                    if not session.turn_is_white:
                         movefrom = flip_move(movefrom)
                         moveto = flip_move(moveto)
                     parsed_move = parse(movefrom), parse(moveto)
@@ -950,13 +2932,13 @@ class Chess(Cog):
                     break
         else:
             await self.invalid_move(ctx)
-            self._thonking = False
+            session.thonking = False
             return
 
-        game = self._current_game[-1]
+        game = session.current_game[-1]
         
         # Start with player move.
-        possible_moves = game.gen_moves()
+        possible_moves = game.legal_moves()
         if matcher_idx == 1:
             # if move is in format Qd7 instead of d2d7
             parsed_dir = parse(moveto)
@@ -969,120 +2951,190 @@ class Chess(Cog):
                         parsed_moves.append(move_)
             if len(parsed_moves) == 0:
                 await self.invalid_move(ctx)
-                self._thonking = False
+                session.thonking = False
                 return
             if len(parsed_moves) > 1:
                 await self._send_as_embed(ctx, "Your move is ambiguous! Please use this format: <position moving from> <position moving to> e.g. d2d3 instead.")
-                self._thonking = False
+                session.thonking = False
                 return
             parsed_move = parsed_moves[0]
             movefrom = render(parsed_move[0])
             
         elif parsed_move not in possible_moves:
-            await self.invalid_move(ctx)
-            self._thonking = False
+            if parsed_move in game.gen_moves():
+                await self._send_as_embed(ctx, "Illegal move!", "Your king would be in check.")
+            else:
+                await self.invalid_move(ctx)
+            session.thonking = False
             return
 
-        self._current_game.append(game.move(parsed_move))
-        self._last_move.append(parsed_move)
-        playermove = (movefrom + moveto) if self._turn_is_white else (flip_move(movefrom) + flip_move(moveto))
+        session.current_game.append(game.move(parsed_move))
+        session.last_move.append(parsed_move)
+        playermove = (movefrom + moveto) if session.turn_is_white else (flip_move(movefrom) + flip_move(moveto))
+        ending = self._ending(session.current_game[-1])
         # Get the piece name and put it next to the playermove e.g. Qd2d4
-        recorded_move = self._current_game[-2].board[parsed_move[0]].upper().replace('P', '') + playermove
-        self._move_history.append(recorded_move)
-        await self._send_as_embed(ctx, ("White: " if self._turn_is_white else "Black: ..") + recorded_move)
-        await self._send_reversed_board(ctx)
-
-        if self._current_game[-1].score <= -MATE_LOWER:
-            if self._mode == 'PvP':
-                final_str = 'White wins!' if self._turn_is_white else "Black wins!"
+        recorded_move = session.current_game[-2].board[parsed_move[0]].upper().replace('P', '') + playermove \
+            + self._check_suffix(session.current_game[-1], ending)
+        session.move_history.append(recorded_move)
+        self._archive.push(session.archived, coordinates(parsed_move, not session.turn_is_white))
+        moves = [("White: " if session.turn_is_white else "Black: ..") + recorded_move]
+        # Against the computer the board is shown once it has replied too
+        if session.mode == 'PvP' or ending:
+            await self._send_reversed_board(ctx, moves)
+
+        if ending:
+            if ending == 'stalemate':
+                final_str = "Stalemate! It's a draw."
+            elif session.mode == 'PvP':
+                final_str = 'Checkmate! ' + ('White wins!' if session.turn_is_white else "Black wins!")
             else:
-                final_str = 'YOU WIN!'
+                final_str = 'Checkmate! YOU WIN!'
             await self._send_as_embed(ctx, final_str)
-            self.reset_game()
-            self._thonking = False
+            self._finish(session, '1/2-1/2' if ending == 'stalemate' else '1-0' if session.turn_is_white else '0-1')
+            session.thonking = False
             return
 
-        if self._mode != 'PvP':
+        if session.mode != 'PvP':
             # If computer is involved, then make a move in response
             async with ctx.typing():
-                start = time.time()
-                for _depth, move, score in self._searcher.search(self._current_game[-1], self._current_game):
-                    if time.time() - start > self.thinking_time:
-                        break
-                self._current_game.append(self._current_game[-1].move(move))
-                self._last_move.append(move)
-                computer_move = self._current_game[-2].board[move[0]].upper().replace('P', '') + render(move[0]) + render(move[1])
-                self._move_history.append(computer_move)
-                await self._send_as_embed(ctx, ("Black" if self._turn_is_white else "White") + ": " + computer_move)
+                game = session.current_game
+                ponder = None
+                started = time.time()
+                # Book positions are answered instantly, the rest are searched
+                move = self._book.choose(game[-1])
+                source, result = 'book', None
+                # A deeper search from an earlier game beats this one, though
+                # node-count games keep to their own search
+                known = None
+                if move is None and session.max_nodes is None:
+                    known = self._experience.lookup(game[-1])
+                # A ponder may have given way to another channel's search
+                ponder_hit = (move is None and parsed_move == session.ponder_move
+                              and not session.ponder_job.cancelled)
+                if ponder_hit:
+                    # We already have been thinking about this position
+                    session.engine_job, session.ponder_job = session.ponder_job, None
+                    session.engine_job.ponderhit(session.thinking_time)
+                else:
+                    session.cancel_ponder()
+                if move is None:
+                    source = 'ponder' if ponder_hit else 'search'
+                    if not ponder_hit:
+                        if session.max_nodes is not None:
+                            session.engine_job = self._engine.start(game[-1], game, ENGINE_NODES_TIME_CAP, session.channel_id, session.max_nodes)
+                        else:
+                            session.engine_job = self._engine.start(game[-1], game, session.thinking_time, session.channel_id)
+                    result = await session.engine_job.result()
+                    session.engine_job = None
+                    if result is None or game is not session.current_game:
+                        # The game was stopped or the move taken back mid-think
+                        return
+                    move, ponder = result.move, result.ponder
+                    if known is not None and known.depth > (result.depth or 0):
+                        if known.move != move:
+                            ponder = None
+                        move = known.move
+                        source = 'experience'
+                    else:
+                        self._experience.record(game[-1], result)
+                    if move is None or not game[-1].is_legal(move):
+                        # A search too shallow to see it can still walk into check
+                        move, ponder = game[-1].legal_moves()[0], None
+                self._stats.record(session.channel_id, source, time.time() - started,
+                                   session.thinking_time if session.max_nodes is None else None, result)
+                session.current_game.append(session.current_game[-1].move(move))
+                session.last_move.append(move)
+                ending = self._ending(session.current_game[-1])
+                computer_move = session.current_game[-2].board[move[0]].upper().replace('P', '') + render(move[0]) + render(move[1]) \
+                    + self._check_suffix(session.current_game[-1], ending)
+                session.move_history.append(computer_move)
+                self._archive.push(session.archived, coordinates(move, session.turn_is_white))
+                moves.append(("Black: .." if session.turn_is_white else "White: ") + computer_move)
             
-                self._turn_is_white = not self._turn_is_white
-                await self._send_board(ctx)
-                self._turn_is_white = not self._turn_is_white
+                session.turn_is_white = not session.turn_is_white
+                await self._send_board(ctx, moves=moves)
+                session.turn_is_white = not session.turn_is_white
         else:
-            self._turn_is_white = not self._turn_is_white
+            session.turn_is_white = not session.turn_is_white
         
-        if self._current_game[-1].score <= -MATE_LOWER:
-            await self._send_as_embed(ctx, "YOU LOSE!")
-            self.reset_game()
+        if session.mode != 'PvP' and ending:
+            await self._send_as_embed(ctx, "Stalemate! It's a draw." if ending == 'stalemate' else "Checkmate! YOU LOSE!")
+            self._finish(session, '1/2-1/2' if ending == 'stalemate' else '0-1' if session.turn_is_white else '1-0')
+        elif session.mode != 'PvP' and session.max_nodes is None:
+            # Pondering would make node-count games depend on the player's speed
+            self._start_ponder(session, ponder)
         
-        self._thonking = False
+        session.thonking = False
 
     @commands.command(name="takeback")
     async def takeback(self, ctx):
-        if self._current_game is None:
+        session = self._session(ctx)
+        if session.current_game is None:
             await self._send_as_embed(ctx, "No current match!")
             return
-        if self._thonking:
+        if session.thonking and session.engine_job is None:
             await self._send_as_embed(ctx, "I'm still thinking!")
             return
-        if ctx.author.id not in self._participants['White'] and ctx.author.id not in self._participants['Black']:
+        if ctx.author.id not in session.participants['White'] and ctx.author.id not in session.participants['Black']:
             await self._send_as_embed(ctx, "You are not a participant of this game!", "Please react to the 'play' message for the next match.")
             return
         takeback_count = 1
-        if self._turn_is_white and not ctx.author.id in self._participants['Black']:
+        if session.turn_is_white and not ctx.author.id in session.participants['Black']:
             takeback_count = 2
             
-        if not self._turn_is_white and not ctx.author.id in self._participants['White']:
+        if not session.turn_is_white and not ctx.author.id in session.participants['White']:
             takeback_count = 2
-
-        if len(self._current_game) - 1 < takeback_count:
+        turn_flips = takeback_count
+
+        session.cancel_ponder()
+        if session.engine_job is not None:
+            # The computer hasn't replied yet, so only the player's move is undone
+            session.engine_job.cancel()
+            session.engine_job = None
+            session.thonking = False
+            takeback_count = 1
+            # The turn only passes to the computer once it has replied
+            turn_flips = 0
+
+        if len(session.current_game) - 1 < takeback_count:
             await self._send_as_embed(ctx, "Cannot takeback!", "You haven't made enough moves!")
             return
 
-        self._takeback_accepted = self._takeback_denied = False
-        turn_was_white = self._turn_is_white
-        if self._mode == 'PvP':
-            self._takeback_judge = self._participants['Black'] if self._turn_is_white else self._participants['White']
-            self._takeback_msg = await self._send_as_embed(ctx, f"A takeback was requested by {ctx.author.display_name}.", "React to accept or refuse.")
-            await self._takeback_msg.add_reaction('🇾')
-            await self._takeback_msg.add_reaction('🇳')
+        session.takeback_accepted = session.takeback_denied = False
+        turn_was_white = session.turn_is_white
+        if session.mode == 'PvP':
+            session.takeback_judge = session.participants['Black'] if session.turn_is_white else session.participants['White']
+            session.takeback_msg = await self._send_as_embed(ctx, f"A takeback was requested by {ctx.author.display_name}.", "React to accept or refuse.")
+            await session.takeback_msg.add_reaction('🇾')
+            await session.takeback_msg.add_reaction('🇳')
             start = time.time()
             while True:
                 await asyncio.sleep(0.1)
-                if self._takeback_accepted or self._takeback_denied or turn_was_white != self._turn_is_white:
+                if session.takeback_accepted or session.takeback_denied or turn_was_white != session.turn_is_white:
                     break
                 if time.time() - start > 8:
-                    await self._takeback_msg.edit(content="*Takeback request timed out.*", embed=None)
+                    await session.takeback_msg.edit(content="*Takeback request timed out.*", embed=None)
                     break
-            self._takeback_msg = None
+            session.takeback_msg = None
         else: 
-            self._takeback_accepted = True
-
-        if self._takeback_accepted:
-            self._current_game = self._current_game[:-takeback_count]
-            self._move_history = self._move_history[:-takeback_count]
-            self._last_move = self._last_move[:-takeback_count]
-            for i in range(takeback_count):
-                self._turn_is_white = not self._turn_is_white
-            if self._mode == 'PvP':
+            session.takeback_accepted = True
+
+        if session.takeback_accepted:
+            session.current_game = session.current_game[:-takeback_count]
+            session.move_history = session.move_history[:-takeback_count]
+            session.last_move = session.last_move[:-takeback_count]
+            self._archive.truncate(session.archived, len(session.last_move))
+            for i in range(turn_flips):
+                session.turn_is_white = not session.turn_is_white
+            if session.mode == 'PvP':
                 await self._send_as_embed(ctx, "Takeback request accepted!")
             else:
                 await self._send_as_embed(ctx, "Your last move was undone!")
             await self._send_board(ctx)
-            self._takeback_accepted = False
-        elif self._takeback_denied:
+            session.takeback_accepted = False
+        elif session.takeback_denied:
             await self._send_as_embed(ctx, "Takeback request denied!")
-            self._takeback_denied = False
+            session.takeback_denied = False
 
             
 
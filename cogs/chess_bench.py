@@ -0,0 +1,226 @@
+"""
+Benchmarks the chess engine used by the Chess cog.
+
+    python -m cogs.chess_bench
+    python -m cogs.chess_bench --perft-depth 4 --depth 6 --time 2 --json bench.json
+
+Perft counts the legal move paths from a set of standard positions, which
+catches move generation bugs, and times Position.gen_moves/move. The search
+part runs Searcher.search from the same positions to a fixed depth, for a
+fixed time and optionally for a fixed number of nodes, and reports nodes,
+nodes/sec and time-to-depth. With --processes the searches get Lazy SMP
+helpers, to see how time-to-depth scales with cores.
+Results can be written as JSON to compare engine changes.
+"""
+import re
+import sys
+import json
+import time
+import math
+import argparse
+import platform
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from .chess import (Position, CompactPosition, Searcher, pst, parse, table_bytes,
+                    ENGINE_TABLE_MB, _init_engine_worker, _engine_helper)
+
+BOARDS = {'compact': CompactPosition, 'position': Position}
+
+# Name, FEN, known perft counts by depth. Sunfish only promotes to a queen,
+# so the counts stop before the first underpromotion.
+POSITIONS = [
+    ('startpos', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1',
+     [20, 400, 8902, 197281]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     [48, 2039, 97862]),
+    ('endgame', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+     [14, 191, 2812, 43238]),
+    ('middlegame', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     [46, 2079, 89890]),
+]
+
+# Name, FEN. The search positions add some quieter and some sharper ones.
+SEARCH_POSITIONS = [(name, fen) for name, fen, _ in POSITIONS] + [
+    ('italian', 'r2q1rk1/ppp2ppp/2n1bn2/2bpp3/4P3/2PP1N2/PP1NBPPP/R1BQ1RK1 w - - 0 8'),
+    ('scholar', 'r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4'),
+    ('outpost', '2rr2k1/1p2qp1p/1pn1pp2/1N6/3P4/P6P/1P2QPP1/2R2RK1 b - - 0 1'),
+    ('backrank', '6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1'),
+    ('wac001', '2rr3k/pp3pp1/1nnqbN1p/3pN3/2pP4/2P3Q1/PPB4P/R4RK1 w - - 0 1'),
+    ('wac002', '8/7p/5k2/5p2/p1p2P2/Pr1pPK2/1P1R3P/8 b - - 0 1'),
+    ('wac003', '5rk1/1ppb3p/p1pb4/6q1/3P1p1r/2P1R2P/PP1BQ1P1/5RKN w - - 0 1'),
+]
+
+
+def from_fen(fen, board_class=CompactPosition):
+    """ Returns the position in fen, rotated if it is Black to move """
+    placement, color, castling, enpas = fen.split()[:4]
+    board = re.sub(r'\d', lambda m: '.' * int(m.group(0)), placement)
+    board = list(21 * ' ' + '  '.join(board.split('/')) + 21 * ' ')
+    board[9::10] = ['\n'] * 12
+    board = ''.join(board)
+    wc = ('Q' in castling, 'K' in castling)
+    bc = ('k' in castling, 'q' in castling)
+    ep = parse(enpas) if enpas != '-' else 0
+    score = sum(pst[p][i] for i, p in enumerate(board) if p.isupper())
+    score -= sum(pst[p.upper()][119 - i] for i, p in enumerate(board) if p.islower())
+    pos = board_class(board, score, wc, bc, ep, 0)
+    return pos if color == 'w' else pos.rotate()
+
+
+def perft(pos, depth):
+    """ Counts the legal move paths of the given length """
+    moves = pos.legal_moves()
+    if depth == 1:
+        return len(moves)
+    return sum(perft(pos.move(move), depth - 1) for move in moves)
+
+
+def run_perft(board_class, max_depth):
+    results = []
+    for name, fen, expected in POSITIONS:
+        pos = from_fen(fen, board_class)
+        for depth in range(1, min(max_depth, len(expected)) + 1):
+            start = time.perf_counter()
+            nodes = perft(pos, depth)
+            elapsed = time.perf_counter() - start
+            results.append({
+                'position': name, 'depth': depth, 'nodes': nodes,
+                'expected': expected[depth - 1], 'ok': nodes == expected[depth - 1],
+                'seconds': round(elapsed, 4), 'nps': round(nodes / elapsed) if elapsed else None,
+            })
+    return results
+
+
+class Helpers:
+    """ Lazy SMP helper processes sharing a table with searches run here,
+    as the Engine runs them for the bot """
+    def __init__(self, processes, table_mb=ENGINE_TABLE_MB):
+        context = multiprocessing.get_context('spawn')
+        size = table_bytes(table_mb)
+        self.processes = processes
+        self.deadlines = context.RawArray('d', 1)
+        self.live = context.RawArray('i', 64)
+        self.table = shared_memory.SharedMemory(create=True, size=size)
+        self.buffer = self.table.buf[:size]
+        self.age = 0
+        self.pool = ProcessPoolExecutor(
+            processes - 1, mp_context=context, initializer=_init_engine_worker,
+            initargs=(self.deadlines, self.live, self.table.name, size))
+        # Have the workers up before anything is timed
+        for future in [self.pool.submit(time.sleep, 0.1) for _ in range(processes - 1)]:
+            future.result()
+
+    def start(self, pos, deadline):
+        self.age = (self.age + 1) & 63
+        self.live[self.age] += 1
+        self.deadlines[0] = deadline
+        return [self.pool.submit(_engine_helper, 0, pos, (), depth, self.age)
+                for depth in range(2, self.processes + 1)]
+
+    def stop(self, futures):
+        self.deadlines[0] = 0
+        for future in futures:
+            future.result()
+        self.live[self.age] -= 1
+
+    def close(self):
+        self.pool.shutdown()
+        self.buffer.release()
+        self.table.close()
+        self.table.unlink()
+
+
+def run_search(pos, max_depth=None, seconds=None, max_nodes=None, table_mb=None, helpers=None):
+    """ Searches pos with a fresh Searcher until max_depth is completed,
+    seconds have passed or max_nodes are searched, whichever comes first """
+    deadline = time.time() + seconds if seconds is not None else None
+    if helpers is not None:
+        searcher = Searcher(buffer=helpers.buffer, live=helpers.live)
+        searcher.tp.clear()
+        futures = helpers.start(pos, math.inf if deadline is None else deadline)
+        age = helpers.age
+    else:
+        searcher = Searcher() if table_mb is None else Searcher(table_mb)
+        futures, age = [], None
+    depths = []
+    start = time.perf_counter()
+    try:
+        for depth, _move, _score in searcher.search(pos, deadline=deadline, max_nodes=max_nodes, age=age):
+            elapsed = time.perf_counter() - start
+            depths.append({'depth': depth, 'seconds': round(elapsed, 4), 'nodes': searcher.nodes})
+            if max_depth is not None and depth >= max_depth:
+                break
+    finally:
+        if helpers is not None:
+            helpers.stop(futures)
+    elapsed = time.perf_counter() - start
+    nodes = searcher.nodes
+    return {
+        'depth': depths[-1]['depth'], 'nodes': nodes, 'seconds': round(elapsed, 4),
+        'nps': round(nodes / elapsed) if elapsed else None,
+        'time_to_depth': depths,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chess engine.")
+    parser.add_argument('--board', choices=sorted(BOARDS), default='compact', help="position class to benchmark")
+    parser.add_argument('--perft-depth', type=int, default=3, help="deepest perft to run (0 to skip)")
+    parser.add_argument('--depth', type=int, default=5, help="fixed search depth (0 to skip)")
+    parser.add_argument('--time', type=float, default=1, help="seconds per fixed-time search (0 to skip)")
+    parser.add_argument('--nodes', type=int, default=0, help="nodes per fixed-node search (0 to skip)")
+    parser.add_argument('--table-mb', type=float, default=None, help="transposition table size")
+    parser.add_argument('--processes', type=int, default=1, help="processes per search, for Lazy SMP")
+    parser.add_argument('--json', metavar='PATH', help="also write the results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    board_class = BOARDS[args.board]
+    report = {
+        'board': args.board,
+        'processes': args.processes,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'perft': run_perft(board_class, args.perft_depth),
+        'search': [],
+    }
+    out = sys.stderr if args.json == '-' else sys.stdout
+    for r in report['perft']:
+        print(f"perft {r['position']:<10} depth {r['depth']}: {r['nodes']:>8} nodes "
+              f"{r['nps']:>8} n/s  {'ok' if r['ok'] else 'MISMATCH, expected %d' % r['expected']}", file=out)
+
+    modes = [('depth', args.depth), ('time', args.time), ('nodes', args.nodes)]
+    helpers = None
+    if args.processes > 1 and any(limit for _, limit in modes):
+        helpers = Helpers(args.processes, args.table_mb or ENGINE_TABLE_MB)
+    try:
+        for name, fen in SEARCH_POSITIONS:
+            pos = from_fen(fen, board_class)
+            for mode, limit in modes:
+                if not limit:
+                    continue
+                kwargs = {{'depth': 'max_depth', 'time': 'seconds', 'nodes': 'max_nodes'}[mode]: limit}
+                r = dict(position=name, mode=mode, limit=limit,
+                         **run_search(pos, table_mb=args.table_mb, helpers=helpers, **kwargs))
+                report['search'].append(r)
+                print(f"search {name:<10} {mode} {limit:<4}: depth {r['depth']:>2} {r['nodes']:>8} nodes "
+                      f"{r['seconds']:>7.2f}s {r['nps']:>8} n/s", file=out)
+    finally:
+        if helpers is not None:
+            helpers.close()
+
+    if args.json:
+        text = json.dumps(report, indent=2)
+        if args.json == '-':
+            print(text)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(text + '\n')
+    if not all(r['ok'] for r in report['perft']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
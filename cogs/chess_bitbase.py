@@ -0,0 +1,163 @@
+"""
+Generates the endgame bitbases used by the chess engine.
+
+    python -m cogs.chess_bitbase
+    python -m cogs.chess_bitbase --out /tmp/bitbases KQK
+
+Every position of a king and queen, rook or pawn against a lone king is
+worked out by retrograde analysis over sunfish's own moves, so pawns only
+ever promote to queens, as they do in the engine. KQK is built first, as
+KPK positions promote into it. Each file is written in the layout read by
+Bitbases: a header, then one bit per position index, set when the side
+with the piece wins.
+"""
+import os
+import re
+import time
+import argparse
+from array import array
+
+from .chess import (CompactPosition, initial, bitbase_index,
+                    BITBASE_DIR, BITBASE_MAGIC, BITBASE_VERSION, BITBASE_HEADER, BITBASE_SIZE)
+
+ENDINGS = {'KQK': b'Q', 'KRK': b'R', 'KPK': b'P'}
+# Weak side to move, strong king, weak king, piece
+POSITIONS = 2 * 64 * 64 * 64
+STRONG_TO_MOVE = 64 * 64 * 64
+
+_BLANK = bytearray(re.sub('[a-zA-Z]', '.', initial), 'ascii')
+_SQUARE120 = [21 + sq // 8 * 10 + sq % 8 for sq in range(64)]
+
+
+def position(index, piece):
+    """ The position at index, with the side to move uppercase as sunfish
+    has it, or None if the placement can't come up in a game """
+    rest, i = divmod(index, 64)
+    rest, other_king = divmod(rest, 64)
+    weak, king = divmod(rest, 64)
+    if king == other_king or i in (king, other_king):
+        return None
+    if max(abs(king // 8 - other_king // 8), abs(king % 8 - other_king % 8)) <= 1:
+        return None
+    if piece == b'P' and not 8 <= i < 56:
+        return None
+    squares = bytearray(_BLANK)
+    squares[_SQUARE120[king]] = ord('K')
+    squares[_SQUARE120[other_king]] = ord('k')
+    squares[_SQUARE120[i]] = piece[0]
+    # Zobrist keys don't matter here, so skip computing them
+    pos = CompactPosition(squares, 0, (False, False), (False, False), 0, 0, 0, 0)
+    if weak:
+        pos = pos.rotate()
+    # The side that just moved can't have left its king in check
+    if pos.rotate().in_check():
+        return None
+    return pos
+
+
+def generate(piece, promoted=None, log=print):
+    """ Returns the won positions of the ending as a bytearray of bits.
+    promoted is the KQK bitbase, for the pawn ending. """
+    won = bytearray(POSITIONS)
+    # Weak to move: moves not yet known to lose. Positions move to at most
+    # 27 others, so a byte will do.
+    left = bytearray(POSITIONS)
+    parents, children = array('i'), array('i')
+    queue = []
+    start = time.perf_counter()
+    for index in range(POSITIONS):
+        pos = position(index, piece)
+        if pos is None:
+            continue
+        weak = index >= STRONG_TO_MOVE
+        moves = pos.legal_moves()
+        if not moves:
+            # Mate or stalemate, and only the weak side can be mated
+            if weak and pos.in_check():
+                won[index] = 1
+                queue.append(index)
+            continue
+        left[index] = len(moves)
+        for move in moves:
+            child = pos.move(move)
+            found = bitbase_index(child.squares)
+            if found is None:
+                # The piece was taken, a draw
+                continue
+            if found[0] != piece[0]:
+                # The pawn promoted
+                code = found[1]
+                if promoted[code >> 3] >> (code & 7) & 1 and not won[index]:
+                    won[index] = 1
+                    queue.append(index)
+                continue
+            parents.append(index)
+            children.append(found[1])
+    log(f"{len(parents)} moves between positions in {time.perf_counter() - start:.1f}s")
+
+    # Group the moves by the position they lead to
+    first = array('i', bytes(4 * (POSITIONS + 1)))
+    for child in children:
+        first[child + 1] += 1
+    for index in range(POSITIONS):
+        first[index + 1] += first[index]
+    fill = array('i', first)
+    before = array('i', bytes(4 * len(parents)))
+    for parent, child in zip(parents, children):
+        before[fill[child]] = parent
+        fill[child] += 1
+    del parents, children, fill
+
+    # A position is won with the strong side to move if any move wins, and
+    # with the weak side to move if every move loses
+    while queue:
+        child = queue.pop()
+        for parent in before[first[child]:first[child + 1]]:
+            if won[parent]:
+                continue
+            if parent >= STRONG_TO_MOVE:
+                left[parent] -= 1
+                if left[parent]:
+                    continue
+            won[parent] = 1
+            queue.append(parent)
+
+    bits = bytearray(BITBASE_SIZE)
+    for index in range(POSITIONS):
+        if won[index]:
+            bits[index >> 3] |= 1 << (index & 7)
+    log(f"{sum(won)} won positions in {time.perf_counter() - start:.1f}s")
+    return bits
+
+
+def write_bitbase(bits, piece, path):
+    with open(path, 'wb') as f:
+        f.write(BITBASE_HEADER.pack(BITBASE_MAGIC, BITBASE_VERSION, piece))
+        f.write(bits)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the chess endgame bitbases.")
+    parser.add_argument('endings', nargs='*', type=str.upper, default=list(ENDINGS),
+                        help=f"endings to generate, of {', '.join(ENDINGS)} (default all)")
+    parser.add_argument('--out', default=BITBASE_DIR, help="directory to write them to")
+    args = parser.parse_args(argv)
+    unknown = set(args.endings) - set(ENDINGS)
+    if unknown:
+        parser.error(f"no such ending: {', '.join(sorted(unknown))}")
+
+    built = {}
+    for name, piece in ENDINGS.items():
+        needed = name in args.endings or name == 'KQK' and 'KPK' in args.endings
+        if not needed:
+            continue
+        print(f"Generating {name}...")
+        built[piece] = generate(piece, built.get(b'Q'))
+        if name in args.endings:
+            path = os.path.join(args.out, f'{name.lower()}.bin')
+            write_bitbase(built[piece], piece, path)
+            print(f"Wrote {path}.")
+
+
+if __name__ == '__main__':
+    main()
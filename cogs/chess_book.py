@@ -0,0 +1,104 @@
+"""
+Compiles the opening book used by the Chess cog.
+
+    python -m cogs.chess_book cogs/data/chess/openings.txt
+
+The input is either a PGN file (.pgn) or a move list with one opening per
+line. Move lists may use SAN (Nf3) or coordinates (g1f3), '#' starts a
+comment, and a bare number at the start of a line weights that line.
+Every position up to --plies deep is written to the binary book read by
+OpeningBook, with each move weighted by how often it was played.
+"""
+import re
+import sys
+import argparse
+from collections import Counter
+
+from .chess import (CompactPosition, initial, parse_token, MOVE_NUMBER_RE, RESULTS,
+                    BOOK_PATH, BOOK_MAGIC, BOOK_VERSION, BOOK_HEADER, BOOK_RECORD)
+
+
+def read_move_list(text):
+    """ Yields (weight, tokens) for each line of a move list """
+    for line in text.splitlines():
+        tokens = line.split('#')[0].split()
+        if not tokens:
+            continue
+        weight = 1
+        if tokens[0].isdigit():
+            weight = int(tokens.pop(0))
+        yield weight, tokens
+
+
+def read_pgn(text):
+    """ Yields (1, tokens) for the mainline of each game in a PGN file """
+    text = re.sub(r'\{[^}]*\}|;[^\n]*|\$\d+', ' ', text)
+    # Strip variations from the inside out, as they can be nested
+    while True:
+        text, n = re.subn(r'\([^()]*\)', ' ', text)
+        if not n:
+            break
+    tokens = []
+    for line in text.splitlines():
+        if line.startswith('['):
+            if tokens:
+                yield 1, tokens
+            tokens = []
+            continue
+        for token in line.split():
+            if token in RESULTS:
+                if tokens:
+                    yield 1, tokens
+                tokens = []
+            else:
+                tokens.append(token)
+    if tokens:
+        yield 1, tokens
+
+
+def compile_book(lines, plies):
+    """ Counts the weighted (position key, move) pairs over the openings """
+    counts = Counter()
+    for number, (weight, tokens) in enumerate(lines, 1):
+        pos = CompactPosition(initial, 0, (True, True), (True, True), 0, 0)
+        ply = 0
+        for token in tokens:
+            token = MOVE_NUMBER_RE.sub('', token)
+            if not token:
+                continue
+            if ply >= plies:
+                break
+            move = parse_token(pos, token, ply % 2 == 1)
+            if move is None:
+                print(f"Opening {number}: can't play {token!r} at ply {ply + 1}, skipping the rest.", file=sys.stderr)
+                break
+            counts[pos.key, move[0] * 120 + move[1]] += weight
+            pos = pos.move(move)
+            ply += 1
+    return counts
+
+
+def write_book(counts, path):
+    with open(path, 'wb') as f:
+        f.write(BOOK_HEADER.pack(BOOK_MAGIC, BOOK_VERSION, len(counts)))
+        for (key, code), weight in sorted(counts.items()):
+            f.write(BOOK_RECORD.pack(key, code, min(weight, 0xFFFF)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile the chess opening book.")
+    parser.add_argument('source', help="PGN file or move list")
+    parser.add_argument('output', nargs='?', default=BOOK_PATH)
+    parser.add_argument('--plies', type=int, default=16, help="how deep into each opening to go")
+    args = parser.parse_args(argv)
+
+    with open(args.source, 'r', encoding='utf-8') as f:
+        text = f.read()
+    lines = read_pgn(text) if args.source.lower().endswith('.pgn') else read_move_list(text)
+    counts = compile_book(lines, args.plies)
+    write_book(counts, args.output)
+    print(f"Wrote {len(counts)} book moves over {len({key for key, _ in counts})} positions to {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+Plays the chess engine against itself to measure engine changes.
+
+    python -m cogs.chess_selfplay --nodes 20000 --base-set LMR_DEPTH=99
+    git show HEAD~1:cogs/chess.py > /tmp/base.py
+    python -m cogs.chess_selfplay --base /tmp/base.py --time 0.1 --processes 4
+
+Two configurations of the engine, "new" and "base", play pairs of games
+from the same opening with the colours swapped. Each is a copy of
+cogs/chess.py or of another version of it, with module constants such as
+QS_LIMIT optionally overridden. Openings are one of opening_moves followed
+by a few book moves picked at random. Every move is searched for a fixed
+number of nodes or seconds, and the games run in parallel over a process
+pool. A sequential probability ratio test stops the match once it is clear
+that new is at least --elo1 stronger than base, or at most --elo0.
+The report gives the Elo difference of new over base with its 95% error,
+and games/sec. Node budgets play the same games however busy the machine
+is, so prefer them when the pool has more processes than free cores.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import importlib.util
+import multiprocessing
+from ast import literal_eval
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from . import chess
+from .chess import OpeningBook, parse, opening_moves
+
+ENGINES = ('new', 'base')
+# Games still going after this many plies are called a draw.
+MAX_PLIES = 300
+# Pieces that can still mate on their own, with the kings on the board.
+MATING_MATERIAL = frozenset(b'PRQprq')
+
+_engines = {}
+
+
+def load_engine(name, path, overrides):
+    """ Imports the engine module at path under a name of its own, so two
+    configurations of the same file don't share their constants """
+    spec = importlib.util.spec_from_file_location(f'selfplay_{name}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for constant, value in overrides.items():
+        if not hasattr(module, constant):
+            raise ValueError(f"{path} has no {constant} to override")
+        setattr(module, constant, value)
+    return module
+
+
+def _init_selfplay_worker(specs):
+    for name, (path, overrides) in specs.items():
+        _engines[name] = load_engine(name, path, overrides)
+
+
+def start_position(module=chess):
+    return module.CompactPosition(module.initial, 0, (True, True), (True, True), 0, 0)
+
+
+def random_opening(rng, book, plies):
+    """ One of opening_moves, then book moves picked by their weights until
+    the opening is plies long or out of book """
+    pos = start_position()
+    first = rng.choice(opening_moves)
+    moves = [(parse(first[:2]), parse(first[2:]))]
+    pos = pos.move(moves[0])
+    while len(moves) < plies:
+        choices = book.moves(pos)
+        if not choices:
+            break
+        move = rng.choices([m for m, _ in choices], weights=[w for _, w in choices])[0]
+        moves.append(move)
+        pos = pos.move(move)
+    return moves
+
+
+def insufficient_material(pos):
+    """ Kings with at most a single minor piece between them """
+    pieces = [p for p in pos.squares if p in chess._ZOBRIST and p not in b'Kk']
+    return not pieces or len(pieces) == 1 and pieces[0] not in MATING_MATERIAL
+
+
+def play_game(opening, new_white, seconds=None, max_nodes=None, table_mb=8, max_plies=MAX_PLIES):
+    """ Plays out a game after the opening moves.
+    Returns new's score (1, 0.5 or 0), the plies played and the nodes searched.
+    Each side keeps its own positions, as the piece-square tables and so the
+    scores may differ between the two, and this module's position referees. """
+    modules = [_engines[name] for name in (ENGINES if new_white else ENGINES[::-1])]
+    searchers = [module.Searcher(table_mb) for module in modules]
+    histories = [[start_position(module)] for module in modules]
+    referee = start_position()
+    seen = Counter([referee.key])
+    nodes = 0
+    white_score = 0.5
+
+    for ply in range(max_plies):
+        if ply < len(opening):
+            move = opening[ply]
+        else:
+            legal = referee.legal_moves()
+            if not legal:
+                if referee.in_check():
+                    white_score = 0 if ply % 2 == 0 else 1
+                break
+            if seen[referee.key] >= 3 or insufficient_material(referee):
+                break
+            side = ply % 2
+            history = histories[side]
+            deadline = time.time() + seconds if seconds else None
+            move = None
+            for _depth, move, _score in searchers[side].search(
+                    history[-1], history, deadline=deadline, max_nodes=max_nodes):
+                pass
+            nodes += searchers[side].nodes
+            # As in the cog, a search without a legal move plays the first one
+            if move not in legal:
+                move = legal[0]
+        referee = referee.move(move)
+        seen[referee.key] += 1
+        for history in histories:
+            history.append(history[-1].move(move))
+    else:
+        ply = max_plies
+
+    return (white_score if new_white else 1 - white_score), ply, nodes
+
+
+def expected_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def score_elo(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+
+class Sprt:
+    """ The match so far, scored from new's side, and a sequential
+    probability ratio test of elo0 against elo1 on it. The log-likelihood
+    ratio uses the normal approximation of the mean score. """
+    def __init__(self, elo0=0, elo1=10, alpha=0.05, beta=0.05):
+        self.elo0, self.elo1 = elo0, elo1
+        self.score0, self.score1 = expected_score(elo0), expected_score(elo1)
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.results = Counter()
+
+    def add(self, score):
+        self.results[score] += 1
+
+    @property
+    def games(self):
+        return sum(self.results.values())
+
+    def stats(self):
+        """ Mean score and its variance per game """
+        games = self.games
+        mean = sum(score * n for score, n in self.results.items()) / games
+        variance = sum(n * (score - mean) ** 2 for score, n in self.results.items()) / games
+        return mean, variance
+
+    def elo(self):
+        """ Elo difference and the half-width of its 95% interval """
+        mean, variance = self.stats()
+        error = 1.96 * math.sqrt(variance / self.games)
+        return score_elo(mean), (score_elo(mean + error) - score_elo(mean - error)) / 2
+
+    def llr(self):
+        mean, variance = self.stats()
+        if not variance:
+            return 0.0
+        return self.games * (self.score1 - self.score0) * (2 * mean - self.score0 - self.score1) / (2 * variance)
+
+    def verdict(self):
+        """ 'H1' once new is shown to be elo1 better, 'H0' once it is shown
+        not to be, None while it's open """
+        llr = self.llr()
+        if llr >= self.upper:
+            return 'H1'
+        if llr <= self.lower:
+            return 'H0'
+        return None
+
+    def summary(self):
+        elo, error = self.elo()
+        return (f"+{self.results[1]} ={self.results[0.5]} -{self.results[0]}  "
+                f"elo {elo:+.1f} ± {error:.1f}  llr {self.llr():.2f} [{self.lower:.2f}, {self.upper:.2f}]")
+
+
+def parse_overrides(assignments):
+    overrides = {}
+    for assignment in assignments:
+        constant, _, value = assignment.partition('=')
+        try:
+            overrides[constant] = literal_eval(value)
+        except (ValueError, SyntaxError):
+            raise argparse.ArgumentTypeError(f"can't read the value in {assignment!r}")
+    return overrides
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play two configurations of the chess engine against each other.")
+    parser.add_argument('--new', default=chess.__file__, metavar='PATH', help="engine module of the new side")
+    parser.add_argument('--base', default=chess.__file__, metavar='PATH', help="engine module of the base side")
+    parser.add_argument('--new-set', action='append', default=[], metavar='NAME=VALUE',
+                        help="override a module constant for the new side")
+    parser.add_argument('--base-set', action='append', default=[], metavar='NAME=VALUE',
+                        help="override a module constant for the base side")
+    parser.add_argument('--time', type=float, default=None, help="seconds per move")
+    parser.add_argument('--nodes', type=int, default=None, help="nodes per move (default 10000 without --time)")
+    parser.add_argument('--table-mb', type=float, default=8, help="transposition table size of each side")
+    parser.add_argument('--games', type=int, default=1000, help="most games to play")
+    parser.add_argument('--opening-plies', type=int, default=8, help="length of the random openings")
+    parser.add_argument('--max-plies', type=int, default=MAX_PLIES, help="draw games this long")
+    parser.add_argument('--elo0', type=float, default=0, help="SPRT null hypothesis")
+    parser.add_argument('--elo1', type=float, default=10, help="SPRT alternative hypothesis")
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--beta', type=float, default=0.05)
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="games played at once")
+    parser.add_argument('--seed', type=int, default=None, help="seed for picking the openings")
+    parser.add_argument('--json', metavar='PATH', help="also write the results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+    if args.time is None and args.nodes is None:
+        args.nodes = 10000
+
+    specs = {'new': (args.new, parse_overrides(args.new_set)),
+             'base': (args.base, parse_overrides(args.base_set))}
+    # Fail here rather than in every worker
+    for name, (path, overrides) in specs.items():
+        load_engine(name, path, overrides)
+
+    out = sys.stderr if args.json == '-' else sys.stdout
+    rng = random.Random(args.seed)
+    book = OpeningBook()
+    sprt = Sprt(args.elo0, args.elo1, args.alpha, args.beta)
+    plies = nodes = started = 0
+    pending = set()
+    context = multiprocessing.get_context('spawn')
+    pool = ProcessPoolExecutor(args.processes, mp_context=context, initializer=_init_selfplay_worker,
+                               initargs=(specs,))
+    start = time.perf_counter()
+    try:
+        while True:
+            # Keep the pool busy with a few pairs queued, but not so many
+            # that a lot of games are left over once the test is decided
+            while len(pending) < 2 * args.processes and started < args.games:
+                opening = random_opening(rng, book, args.opening_plies)
+                for new_white in (True, False):
+                    pending.add(pool.submit(play_game, opening, new_white, args.time, args.nodes,
+                                            args.table_mb, args.max_plies))
+                started += 2
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                score, game_plies, game_nodes = future.result()
+                sprt.add(score)
+                plies += game_plies
+                nodes += game_nodes
+                print(f"game {sprt.games:>4}: {sprt.summary()}", file=out)
+            if sprt.verdict():
+                break
+    finally:
+        pool.shutdown(cancel_futures=True)
+        book.close()
+    elapsed = time.perf_counter() - start
+
+    elo, error = sprt.elo()
+    verdict = sprt.verdict()
+    report = {
+        'new': {'path': args.new, 'overrides': specs['new'][1]},
+        'base': {'path': args.base, 'overrides': specs['base'][1]},
+        'seconds_per_move': args.time, 'nodes_per_move': args.nodes,
+        'games': sprt.games, 'wins': sprt.results[1], 'draws': sprt.results[0.5], 'losses': sprt.results[0],
+        'elo': round(elo, 1), 'elo_error': round(error, 1),
+        'llr': round(sprt.llr(), 3), 'llr_bounds': [round(sprt.lower, 3), round(sprt.upper, 3)],
+        'elo0': args.elo0, 'elo1': args.elo1, 'verdict': verdict,
+        'seconds': round(elapsed, 2), 'games_per_second': round(sprt.games / elapsed, 3),
+        'average_plies': round(plies / sprt.games, 1) if sprt.games else None,
+        'nps': round(nodes / elapsed),
+    }
+    conclusion = {'H1': f"new is at least {args.elo1:g} Elo stronger",
+                  'H0': f"new is not more than {args.elo0:g} Elo stronger",
+                  None: "inconclusive"}[verdict]
+    print(f"{sprt.games} games in {elapsed:.1f}s ({report['games_per_second']} games/s, "
+          f"{report['nps']} n/s): elo {elo:+.1f} ± {error:.1f}, {conclusion}", file=out)
+
+    if args.json:
+        text = json.dumps(report, indent=2)
+        if args.json == '-':
+            print(text)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -54,16 +54,16 @@ class Core(Cog):
         await self.change_status()
 
     async def get_channels(self):
-        cursor = self.bot.db_execute("select channelid, serverid, channeltype from puzzledb.channels;")
-        for channelid, serverid, channeltype in cursor.fetchall():
+        rows = await self.bot.db.fetch("select channelid, serverid, channeltype from puzzledb.channels;")
+        for channelid, serverid, channeltype in rows:
             serverid = int(serverid)
             self.bot.CHANNELS[serverid] = self.bot.CHANNELS.get(serverid, {})
             self.bot.CHANNELS[serverid].update({channeltype: self.bot.get_channel(channelid)})
         # print(self.bot.CHANNELS)
 
     async def get_statuses(self):
-        cursor = self.bot.db_execute("select status from puzzledb.statuses;")
-        self.RANDOM_STATUSES = cursor.fetchall()
+        rows = await self.bot.db.fetch("select status from puzzledb.statuses;")
+        self.RANDOM_STATUSES = [status for status, in rows]
 
     async def change_status(self):
         wait_time = 0
@@ -1,3 +1,6 @@
+-- Changes to these tables since are numbered migrations in
+-- cogs/data/migrations, which the bot applies when it starts.
+
 CREATE TABLE puzzledb.channels (
     id INTEGER generated by default as identity PRIMARY KEY,
     channelid BIGINT,
@@ -72,6 +75,37 @@ CREATE TABLE puzzledb.puzzlehunt_faqs (
     kind VARCHAR(6)
 );
 
+CREATE TABLE puzzledb.chess_experience (
+    poskey BIGINT PRIMARY KEY,
+    depth SMALLINT,
+    move SMALLINT,
+    score INTEGER,
+    lastused TIMESTAMP
+);
+
+CREATE INDEX chess_experience_lastused ON puzzledb.chess_experience (lastused);
+
+CREATE TABLE puzzledb.chess_games (
+    id INTEGER generated by default as identity PRIMARY KEY,
+    channelid BIGINT,
+    mode VARCHAR(8),
+    difficulty VARCHAR(30),
+    white VARCHAR(500),
+    black VARCHAR(500),
+    result VARCHAR(7),
+    starttime TIMESTAMP,
+    endtime TIMESTAMP
+);
+
+CREATE INDEX chess_games_channelid ON puzzledb.chess_games (channelid, id);
+
+CREATE TABLE puzzledb.chess_game_moves (
+    gameid INTEGER REFERENCES puzzledb.chess_games(id) ON DELETE CASCADE,
+    ply SMALLINT,
+    move VARCHAR(4),
+    PRIMARY KEY (gameid, ply)
+);
+
 
 
 -- To insert --
@@ -0,0 +1,10 @@
+-- Recruiting and joining teams has always used this table, but it was
+-- never written down. Hunts already running have it, hence IF NOT EXISTS.
+CREATE TABLE IF NOT EXISTS puzzledb.puzzlehunt_team_applications (
+    id INTEGER generated by default as identity PRIMARY KEY,
+    huntid VARCHAR(30),
+    teamid INTEGER,
+    solverid BIGINT,
+    recruited BOOLEAN,
+    joined BOOLEAN
+);
@@ -0,0 +1,30 @@
+-- One solve per team and puzzle, one team per solver, one team per name,
+-- one application per solver and team and one puzzle per id, all within a
+-- hunt. Duplicates from before are dropped first, keeping the earliest row,
+-- except teams: a later team of the same name keeps its members and solves
+-- and is renamed to end in its id.
+DELETE FROM puzzledb.puzzlehunt_solves a USING puzzledb.puzzlehunt_solves b
+    WHERE a.huntid = b.huntid AND a.teamid = b.teamid AND a.puzzleid = b.puzzleid AND a.id > b.id;
+ALTER TABLE puzzledb.puzzlehunt_solves
+    ADD CONSTRAINT puzzlehunt_solves_team_puzzle UNIQUE (huntid, teamid, puzzleid);
+
+DELETE FROM puzzledb.puzzlehunt_solvers a USING puzzledb.puzzlehunt_solvers b
+    WHERE a.huntid = b.huntid AND a.id = b.id AND a.uid > b.uid;
+ALTER TABLE puzzledb.puzzlehunt_solvers
+    ADD CONSTRAINT puzzlehunt_solvers_member UNIQUE (huntid, id);
+
+DELETE FROM puzzledb.puzzlehunt_team_applications a USING puzzledb.puzzlehunt_team_applications b
+    WHERE a.huntid = b.huntid AND a.teamid = b.teamid AND a.solverid = b.solverid AND a.id > b.id;
+ALTER TABLE puzzledb.puzzlehunt_team_applications
+    ADD CONSTRAINT puzzlehunt_team_applications_solver UNIQUE (huntid, teamid, solverid);
+
+UPDATE puzzledb.puzzlehunt_teams a SET teamname = LEFT(a.teamname, 29 - LENGTH(a.id::text)) || '-' || a.id
+    FROM puzzledb.puzzlehunt_teams b
+    WHERE a.huntid = b.huntid AND a.teamname = b.teamname AND a.id > b.id;
+ALTER TABLE puzzledb.puzzlehunt_teams
+    ADD CONSTRAINT puzzlehunt_teams_name UNIQUE (huntid, teamname);
+
+DELETE FROM puzzledb.puzzlehunt_puzzles a USING puzzledb.puzzlehunt_puzzles b
+    WHERE a.huntid = b.huntid AND a.puzzleid = b.puzzleid AND a.id > b.id;
+ALTER TABLE puzzledb.puzzlehunt_puzzles
+    ADD CONSTRAINT puzzlehunt_puzzles_puzzle UNIQUE (huntid, puzzleid);
@@ -0,0 +1,6 @@
+-- The lookups the unique constraints don't already cover
+CREATE INDEX IF NOT EXISTS puzzlehunt_solvers_team ON puzzledb.puzzlehunt_solvers (huntid, teamid);
+CREATE INDEX IF NOT EXISTS puzzlehunt_bad_attempts_team_puzzle
+    ON puzzledb.puzzlehunt_bad_attempts (huntid, teamid, puzzleid, solvetime);
+CREATE INDEX IF NOT EXISTS puzzlehunt_puzzles_name ON puzzledb.puzzlehunt_puzzles (huntid, UPPER(name));
+CREATE INDEX IF NOT EXISTS puzzlehunt_faqs_hunt ON puzzledb.puzzlehunt_faqs (huntid);
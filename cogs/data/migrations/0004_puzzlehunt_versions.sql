@@ -0,0 +1,47 @@
+-- A counter per hunt, bumped by every change to the hunt's rows made from
+-- outside the bot, so the bot can tell its cached copy of the hunt is out
+-- of date. The bot's own connections set puzzlebot.hunt_cache and update
+-- the cache as they write, so their changes leave it alone.
+CREATE TABLE IF NOT EXISTS puzzledb.puzzlehunt_versions (
+    huntid VARCHAR(30) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION puzzledb.puzzlehunt_bump_version() RETURNS trigger AS $$
+DECLARE
+    huntids VARCHAR(30)[] := '{}';
+BEGIN
+    IF current_setting('puzzlebot.hunt_cache', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        huntids := huntids || NEW.huntid;
+    END IF;
+    IF TG_OP <> 'INSERT' THEN
+        huntids := huntids || OLD.huntid;
+    END IF;
+    INSERT INTO puzzledb.puzzlehunt_versions AS versions (huntid, version)
+        SELECT DISTINCT huntid, 1 FROM unnest(huntids) AS huntid WHERE huntid IS NOT NULL
+        ON CONFLICT (huntid) DO UPDATE SET version = versions.version + 1;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS puzzlehunts_version ON puzzledb.puzzlehunts;
+CREATE TRIGGER puzzlehunts_version AFTER INSERT OR UPDATE OR DELETE ON puzzledb.puzzlehunts
+    FOR EACH ROW EXECUTE FUNCTION puzzledb.puzzlehunt_bump_version();
+DROP TRIGGER IF EXISTS puzzlehunt_puzzles_version ON puzzledb.puzzlehunt_puzzles;
+CREATE TRIGGER puzzlehunt_puzzles_version AFTER INSERT OR UPDATE OR DELETE ON puzzledb.puzzlehunt_puzzles
+    FOR EACH ROW EXECUTE FUNCTION puzzledb.puzzlehunt_bump_version();
+DROP TRIGGER IF EXISTS puzzlehunt_teams_version ON puzzledb.puzzlehunt_teams;
+CREATE TRIGGER puzzlehunt_teams_version AFTER INSERT OR UPDATE OR DELETE ON puzzledb.puzzlehunt_teams
+    FOR EACH ROW EXECUTE FUNCTION puzzledb.puzzlehunt_bump_version();
+DROP TRIGGER IF EXISTS puzzlehunt_solvers_version ON puzzledb.puzzlehunt_solvers;
+CREATE TRIGGER puzzlehunt_solvers_version AFTER INSERT OR UPDATE OR DELETE ON puzzledb.puzzlehunt_solvers
+    FOR EACH ROW EXECUTE FUNCTION puzzledb.puzzlehunt_bump_version();
+DROP TRIGGER IF EXISTS puzzlehunt_solves_version ON puzzledb.puzzlehunt_solves;
+CREATE TRIGGER puzzlehunt_solves_version AFTER INSERT OR UPDATE OR DELETE ON puzzledb.puzzlehunt_solves
+    FOR EACH ROW EXECUTE FUNCTION puzzledb.puzzlehunt_bump_version();
+DROP TRIGGER IF EXISTS puzzlehunt_bad_attempts_version ON puzzledb.puzzlehunt_bad_attempts;
+CREATE TRIGGER puzzlehunt_bad_attempts_version AFTER INSERT OR UPDATE OR DELETE ON puzzledb.puzzlehunt_bad_attempts
+    FOR EACH ROW EXECUTE FUNCTION puzzledb.puzzlehunt_bump_version();
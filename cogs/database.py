@@ -1,10 +1,332 @@
+import os
+import re
+import time
 import asyncio
 import random
+import json
+import functools
+from bisect import bisect_left
+from collections import namedtuple
 from datetime import datetime
 
+import asyncpg
 import discord
+from discord.ext import tasks
 from discord.ext.commands import Cog, command, has_any_role
 
+from .core import GUILD_ID
+
+# Most connections open at once, and seconds a query may take by default.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_TIMEOUT = float(os.getenv('DB_TIMEOUT', 10))
+# An asyncpg sslmode, e.g. 'disable' for a database on this machine
+DB_SSL = os.getenv('DB_SSL', 'require')
+# Errors that mean the connection went away, rather than the query failing
+CONNECTION_ERRORS = (asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError, ConnectionError)
+
+# Queries run by name, prepared once on each pooled connection. Each
+# connection keeps room for them on top of DB_STATEMENT_CACHE other queries.
+STATEMENTS = {}
+DB_STATEMENT_CACHE = 100
+
+# Numbered SQL files, each applied once in its own transaction and recorded
+# in puzzledb.schema_migrations. The bot applies new ones as it starts.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'data', 'migrations')
+MIGRATION_TIMEOUT = 300
+# Advisory lock held while migrating, so two bots starting don't both try
+MIGRATION_LOCK = 7300451
+# Tables the hot statements shouldn't have to read in full
+INDEXED_TABLES = {'puzzlehunt_solves', 'puzzlehunt_solvers', 'puzzlehunt_bad_attempts', 'puzzlehunt_teams',
+                  'puzzlehunt_puzzles', 'puzzlehunt_team_applications', 'puzzlehunt_faqs'}
+
+_MIGRATION_RE = re.compile(r'(\d+)_(\w+)\.sql$')
+
+# Queries slower than this, or failing, are reported to the LOG channel of
+# the maintainers' guild, gathered up over DB_REPORT_SECONDS so a bad minute
+# is one message. Other guilds never see the bot's queries.
+DB_SLOW_MS = float(os.getenv('DB_SLOW_MS', 500))
+DB_REPORT_GUILD = int(os.getenv('DB_REPORT_GUILD', GUILD_ID['PUZ']))
+DB_REPORT_SECONDS = 60
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|(?<![\w$])-?\d+(?:\.\d+)?\b")
+_LIST_RE = re.compile(r"\(\?(?:, ?\?)+\)")
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query):
+    """ The query with its literals taken out and whitespace squashed, so
+    the same query with different values is counted as one """
+    query = _LITERAL_RE.sub('?', query)
+    query = _LIST_RE.sub('(?)', query)
+    return ' '.join(query.split()).rstrip(';')
+
+
+class Statement(namedtuple('Statement', 'name query')):
+    """ A query registered with statement(). Pass it to bot.db in place of
+    the SQL to run it prepared. """
+
+
+def statement(name, query):
+    """ Registers a query under a name, for the pool to keep prepared on
+    each connection once it has run there """
+    STATEMENTS[name] = Statement(name, query)
+    return STATEMENTS[name]
+
+
+def read_migrations(directory=MIGRATIONS_DIR):
+    """ (version, name, sql) of each migration, in order """
+    migrations = []
+    for filename in os.listdir(directory):
+        match = _MIGRATION_RE.match(filename)
+        if match is None:
+            continue
+        with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+            migrations.append((int(match.group(1)), match.group(2), f.read()))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Two migrations in {directory} have the same number.")
+    return migrations
+
+
+def _seq_scans(plan):
+    """ The tables a JSON query plan reads in full """
+    tables = set()
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.add(plan['Relation Name'])
+    for child in plan.get('Plans', ()):
+        tables |= _seq_scans(child)
+    return tables
+
+
+def _row_count(method, result, args):
+    if method == 'fetch':
+        return len(result)
+    if method == 'executemany':
+        return len(args[0])
+    if method == 'execute':
+        # The status ends with the row count, e.g. 'INSERT 0 3'
+        count = result.rsplit(' ', 1)[-1]
+        return int(count) if count.isdigit() else 0
+    return int(result is not None)
+
+
+class QueryTimings:
+    """ Latency histogram and totals of one query fingerprint """
+    __slots__ = ('calls', 'errors', 'rows', 'total_ms', 'max_ms', 'buckets')
+
+    def __init__(self):
+        self.calls = self.errors = self.rows = 0
+        self.total_ms = self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, ms, rows, failed):
+        self.calls += 1
+        self.errors += failed
+        self.rows += rows
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+    def percentile(self, p):
+        """ The bucket bound under which p of the calls finished """
+        rank = max(1, round(p * self.calls))
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+
+class QueryStats:
+    """ Timings of every query since the bot started, by fingerprint, and
+    the slow or failed ones not yet reported """
+    def __init__(self, slow_ms=DB_SLOW_MS):
+        self.slow_ms = slow_ms
+        self.timings = {}
+        # Fingerprint -> [calls, worst ms, last error]
+        self.pending = {}
+
+    def record(self, query, seconds, rows=0, error=None):
+        key = fingerprint(query)
+        ms = seconds * 1000
+        timings = self.timings.get(key)
+        if timings is None:
+            timings = self.timings[key] = QueryTimings()
+        timings.add(ms, rows, error is not None)
+        if ms >= self.slow_ms or error is not None:
+            slow = self.pending.setdefault(key, [0, 0.0, None])
+            slow[0] += 1
+            slow[1] = max(slow[1], ms)
+            if error is not None:
+                slow[2] = f"{type(error).__name__}: {error}"
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def top(self, n, key):
+        """ The n (fingerprint, QueryTimings) pairs highest by key """
+        return sorted(self.timings.items(), key=lambda item: key(item[1]), reverse=True)[:n]
+
+
+class DatabasePool:
+    """
+    The bot's database, as `bot.db`. Queries use $1, $2... placeholders,
+    run on a bounded asyncpg pool and give up after DB_TIMEOUT seconds
+    unless given a timeout of their own. The pool opens on first use.
+    Every query is timed into `stats`.
+
+    A query whose connection couldn't be had is tried once more on a fresh
+    one. If the connection was lost while it ran, it may have been done
+    already, so it is only tried again when it is safe to run twice: a
+    SELECT, or a query passed with retry=True.
+
+    Statements from statement() run through asyncpg's statement cache,
+    which prepares a query on a connection the first time it runs there
+    and runs it by name after that. The cache is made big enough to hold
+    them all and never expires them, so a quiet hour doesn't cost a
+    re-plan. A new connection, after a reconnect or the pool recycling an
+    idle one, starts empty and prepares them again, and asyncpg prepares
+    a statement again by itself when the tables under it change.
+
+    server_settings are set on every connection of the pool.
+    """
+    def __init__(self, dsn, max_size=DB_POOL_SIZE, timeout=DB_TIMEOUT, statement_cache=DB_STATEMENT_CACHE,
+                 ssl=DB_SSL, server_settings=None):
+        self._dsn = dsn
+        self._ssl = ssl
+        self._server_settings = server_settings
+        self._max_size = max_size
+        # None turns the cache off, statements included
+        self._statement_cache = statement_cache
+        self.timeout = timeout
+        self._pool = None
+        self._opening = asyncio.Lock()
+        self.stats = QueryStats()
+
+    async def _connect(self):
+        async with self._opening:
+            if self._pool is None:
+                self._pool = await asyncpg.create_pool(
+                    self._dsn, min_size=1, max_size=self._max_size,
+                    command_timeout=self.timeout, ssl=self._ssl, server_settings=self._server_settings,
+                    statement_cache_size=0 if self._statement_cache is None
+                    else len(STATEMENTS) + self._statement_cache,
+                    max_cached_statement_lifetime=0)
+        return self._pool
+
+    async def _run(self, method, query, args, timeout, retry):
+        pool = self._pool or await self._connect()
+        if timeout is None:
+            timeout = self.timeout
+        # Statements are timed under their name
+        text, key = (query.query, query.name) if isinstance(query, Statement) else (query, query)
+        if retry is None:
+            retry = text.lstrip().upper().startswith('SELECT')
+        started = time.perf_counter()
+        for attempt in range(2):
+            sent = False
+            try:
+                async with pool.acquire(timeout=timeout) as connection:
+                    sent = True
+                    result = await getattr(connection, method)(text, *args, timeout=timeout)
+                break
+            except CONNECTION_ERRORS as e:
+                # The pool replaces the connection when it is released
+                if attempt or sent and not retry:
+                    self.stats.record(key, time.perf_counter() - started, error=e)
+                    raise
+                print(f"Lost the database connection ({e}), trying again.")
+            except Exception as e:
+                self.stats.record(key, time.perf_counter() - started, error=e)
+                raise
+        self.stats.record(key, time.perf_counter() - started, _row_count(method, result, args))
+        return result
+
+    async def fetch(self, query, *args, timeout=None, retry=None):
+        """ All the rows, as asyncpg Records """
+        return await self._run('fetch', query, args, timeout, retry)
+
+    async def fetchrow(self, query, *args, timeout=None, retry=None):
+        """ The first row, or None """
+        return await self._run('fetchrow', query, args, timeout, retry)
+
+    async def fetchval(self, query, *args, timeout=None, retry=None):
+        """ The first column of the first row, or None """
+        return await self._run('fetchval', query, args, timeout, retry)
+
+    async def execute(self, query, *args, timeout=None, retry=None):
+        """ Runs a statement, returning its status, e.g. 'INSERT 0 1' """
+        return await self._run('execute', query, args, timeout, retry)
+
+    async def executemany(self, query, rows, timeout=None, retry=None):
+        """ Runs a statement once per row of arguments """
+        return await self._run('executemany', query, (rows,), timeout, retry)
+
+    async def migrate(self, directory=MIGRATIONS_DIR):
+        """ Applies the migrations not yet recorded, returning their versions """
+        pool = self._pool or await self._connect()
+        applied = []
+        async with pool.acquire(timeout=self.timeout) as connection:
+            await connection.execute("SELECT pg_advisory_lock($1);", MIGRATION_LOCK, timeout=MIGRATION_TIMEOUT)
+            try:
+                await connection.execute(
+                    "CREATE TABLE IF NOT EXISTS puzzledb.schema_migrations "
+                    "(version INTEGER PRIMARY KEY, name VARCHAR(128), appliedtime TIMESTAMP);")
+                done = {version for version, in await connection.fetch("SELECT version FROM puzzledb.schema_migrations;")}
+                for version, name, sql in read_migrations(directory):
+                    if version in done:
+                        continue
+                    async with connection.transaction():
+                        await connection.execute(sql, timeout=MIGRATION_TIMEOUT)
+                        await connection.execute(
+                            "INSERT INTO puzzledb.schema_migrations (version, name, appliedtime) VALUES ($1, $2, now());",
+                            version, name)
+                    print(f"Applied migration {version:04d}_{name}.")
+                    applied.append(version)
+            finally:
+                await connection.execute("SELECT pg_advisory_unlock($1);", MIGRATION_LOCK)
+        return applied
+
+    async def check_indexes(self, statements=None, tables=INDEXED_TABLES):
+        """ Statement name -> the tables it would still read in full, for
+        each registered statement that reads one of tables that way. Plans
+        are generic, as for a prepared statement, with sequential scans
+        made a last resort so small tables don't hide a missing index. """
+        pool = self._pool or await self._connect()
+        unindexed = {}
+        async with pool.acquire(timeout=self.timeout) as connection:
+            for statement in (STATEMENTS.values() if statements is None else statements):
+                prepared = False
+                try:
+                    async with connection.transaction():
+                        await connection.execute("SET LOCAL plan_cache_mode = force_generic_plan;")
+                        await connection.execute("SET LOCAL enable_seqscan = off;")
+                        await connection.execute(f"PREPARE index_check AS {statement.query.rstrip().rstrip(';')};")
+                        prepared = True
+                        count = await connection.fetchval(
+                            "SELECT cardinality(parameter_types) FROM pg_prepared_statements WHERE name = 'index_check';")
+                        arguments = f"({', '.join(['NULL'] * count)})" if count else ""
+                        plan = await connection.fetchval(f"EXPLAIN (FORMAT JSON) EXECUTE index_check{arguments};")
+                finally:
+                    # Prepared statements outlive the transaction
+                    if prepared:
+                        await connection.execute("DEALLOCATE index_check;")
+                scanned = _seq_scans(json.loads(plan)[0]['Plan']) & tables
+                if scanned:
+                    unindexed[statement.name] = scanned
+        return unindexed
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
 class Database(Cog):
     """
     Cog for handling database calls
@@ -12,6 +334,53 @@ class Database(Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    def cog_unload(self):
+        self._report_slow_queries.cancel()
+
+    @tasks.loop(seconds=DB_REPORT_SECONDS)
+    async def _report_slow_queries(self):
+        pending = self.bot.db.stats.take_pending()
+        if not pending:
+            return
+        worst = sorted(pending.items(), key=lambda item: item[1][1], reverse=True)
+        lines = [f"**{sum(calls for calls, _, _ in pending.values())} slow or failed queries "
+                 f"in the last {DB_REPORT_SECONDS}s:**"]
+        for key, (calls, ms, error) in worst[:10]:
+            lines.append(f"`{calls}x, worst {ms:.0f} ms` {key[:150]}" + (f"\n> {error[:200]}" if error else ""))
+        if len(worst) > 10:
+            lines.append(f"...and {len(worst) - 10} more kinds of query.")
+        report = '\n'.join(lines)[:2000]
+        print(report)
+        log_channel = self.bot.CHANNELS.get(DB_REPORT_GUILD, {}).get('LOG')
+        if log_channel is None:
+            return
+        try:
+            await log_channel.send(report)
+        except discord.HTTPException as e:
+            print(f"Couldn't send the slow query report: {e}")
+
+    @has_any_role("Bot Maintainer")
+    @command(name="querystats")
+    async def query_stats(self, ctx, n: int = 5):
+        """ The queries taking the most time in total, and at the 99th percentile """
+        stats = self.bot.db.stats
+        if not stats.timings:
+            await ctx.send("No queries yet.")
+            return
+        embed = discord.Embed(colour=discord.Colour.green())
+        embed.set_author(name=f"Queries since {self.bot.startup_time:%d/%m %H:%M}")
+        for title, rank in [("Total time", lambda t: t.total_ms), ("p99", lambda t: t.percentile(0.99))]:
+            embed.add_field(
+                name=f"Top {n} by {title.lower()}",
+                value="\n".join(
+                    f"`{t.total_ms / 1000:.1f}s total, p50 {t.percentile(0.5):.0f}/p99 {t.percentile(0.99):.0f}"
+                    f"/max {t.max_ms:.0f} ms, {t.calls} calls, {t.rows / t.calls:.1f} rows"
+                    + (f", {t.errors} failed" if t.errors else "") + f"`\n{query[:120]}"
+                    for query, t in stats.top(n, rank))[:1024],
+                inline=False)
+        embed.set_footer(text=f"Slow over {stats.slow_ms:g} ms, {len(stats.timings)} kinds of query")
+        await ctx.send(embed=embed)
+
     @has_any_role("Bot Maintainer")
     @command(name="query")
     async def query(self, ctx, *query):
@@ -23,15 +392,17 @@ class Database(Cog):
             await ctx.send("Nice try.")
             return
         try:
-            res = self.bot.db_execute(query).fetchall()
-            await ctx.send(str(res))
+            res = await self.bot.db.fetch(query)
+            await ctx.send(str([tuple(row) for row in res]))
         except Exception as e:
-            self.bot.db.rollback()
+            await ctx.send(f"Query failed: {e}")
 
     @Cog.listener()
     async def on_ready(self):
         print('Cog "Database" Ready!')
+        if not self._report_slow_queries.is_running():
+            self._report_slow_queries.start()
 
 
 def setup(bot):
-    bot.add_cog(Database(bot))
\ No newline at end of file
+    bot.add_cog(Database(bot))
@@ -0,0 +1,57 @@
+"""
+Applies the database migrations and checks the hot queries can use indexes.
+
+    python -m cogs.db_migrate
+    python -m cogs.db_migrate --check-only --dsn postgresql://localhost/puzzlebot
+
+The bot applies new migrations from cogs/data/migrations as it starts, so
+this is for trying them on a copy of the database first. The check
+EXPLAINs each registered statement as a prepared statement would run it,
+with sequential scans discouraged, and fails if one still has to read a
+whole hunt table.
+"""
+import os
+import sys
+import asyncio
+import argparse
+
+from dotenv import load_dotenv
+
+from .database import DatabasePool, read_migrations, MIGRATIONS_DIR, DB_SSL
+# Registers the hunt statements to check
+from . import puzzlehunt  # noqa: F401
+
+
+async def run(dsn, ssl, directory, check_only):
+    db = DatabasePool(dsn, max_size=1, ssl=ssl)
+    try:
+        if not check_only:
+            applied = await db.migrate(directory)
+            print(f"Applied {len(applied)} of {len(read_migrations(directory))} migrations.")
+        return await db.check_indexes()
+    finally:
+        await db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migrate the database and check the queries use indexes.")
+    parser.add_argument('--dsn', help="database to migrate (default DATABASE_URL)")
+    parser.add_argument('--ssl', default=DB_SSL, help=f"asyncpg sslmode (default {DB_SSL})")
+    parser.add_argument('--dir', default=MIGRATIONS_DIR, help="directory of numbered .sql files")
+    parser.add_argument('--check-only', action='store_true', help="only check the query plans")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    dsn = args.dsn or os.getenv('DATABASE_URL')
+    if not dsn:
+        parser.error("no database given, set DATABASE_URL or use --dsn")
+    unindexed = asyncio.run(run(dsn, args.ssl, args.dir, args.check_only))
+    for name, tables in sorted(unindexed.items()):
+        print(f"{name}: reads all of {', '.join(sorted(tables))}")
+    if unindexed:
+        sys.exit(1)
+    print("Every statement can use an index.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Benchmarks the database queries of the PuzzleHunt cog.
+
+    python -m cogs.hunt_bench
+    python -m cogs.hunt_bench --hunt avatar --member 123456789 --puzzle A1 --runs 200 --json bench.json
+
+Runs the reads `hunt answer` and `hunt leaderboard` made before the bot
+kept the hunt in memory, in the order the commands made them, against
+DATABASE_URL, through a pool with asyncpg's own statement cache settings,
+as the bot had before the statement registry, and then through one set up
+for the registry. Both prepare a query the first time a connection runs
+it, so once warm they differ only in what the registry pins: statements
+asyncpg would drop after 300 idle seconds or push out of its 100 entries.
+Then times loading the
+hunt's HuntState, as `hunt activate` does, and the two commands' lookups
+in it. Reports the latency per command. The answer's INSERT is left out
+so the benchmark writes nothing. The member defaults to the first solver
+of the hunt, and the puzzle to its first puzzle.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+import asyncpg
+from dotenv import load_dotenv
+
+from .database import DatabasePool, statement
+from .puzzlehunt import HUNT_INFO, HuntState
+
+# The queries of the two commands before the HuntState
+SOLVER = statement('bench_hunt_solver', "SELECT * FROM puzzledb.puzzlehunt_solvers WHERE huntid = $1 AND id = $2")
+TEAM_INFO = statement('bench_hunt_team_info', """
+    SELECT teamsolves.teamid AS teamid, teamsolves.teamname AS teamname, MAX(teamsolves.last_solvetime) AS last_solvetime, COALESCE(SUM(puzzles.points), 0) AS total_points, teamsolves.teamchannel AS teamchannel FROM
+        (SELECT teams.id AS teamid, teams.teamname AS teamname, MAX(solves.solvetime) AS last_solvetime, solves.puzzleid as puzzleid, teams.huntid AS huntid, teams.teamchannel AS teamchannel FROM puzzledb.puzzlehunt_teams teams
+        LEFT JOIN puzzledb.puzzlehunt_solves solves
+            ON solves.teamid = teams.id AND solves.huntid = teams.huntid
+            GROUP BY teams.id, solves.puzzleid) teamsolves
+    LEFT JOIN puzzledb.puzzlehunt_puzzles puzzles
+    ON teamsolves.puzzleid = puzzles.puzzleid AND teamsolves.huntid = puzzles.huntid
+    WHERE teamsolves.huntid = $1 and teamsolves.teamid = $2 GROUP BY teamsolves.teamid, teamsolves.teamname, teamsolves.teamchannel;
+""")
+TEAM_SOLVES = statement('bench_hunt_team_solves', "SELECT puzzleid FROM puzzledb.puzzlehunt_solves WHERE huntid = $1 and teamid = $2;")
+BAD_ATTEMPT_TIMES = statement('bench_hunt_bad_attempt_times', "SELECT solvetime FROM puzzledb.puzzlehunt_bad_attempts WHERE huntid = $1 and teamid = $2 and puzzleid = $3;")
+PUZZLE = statement('bench_hunt_puzzle', "SELECT * FROM puzzledb.puzzlehunt_puzzles where huntid = $1 and puzzleid = $2;")
+LEADERBOARD = statement('bench_hunt_leaderboard', """
+    SELECT teamsolves.teamname AS teamname, COALESCE(SUM(puzzles.points), 0) AS total_points, MAX(teamsolves.last_solvetime) AS last_solvetime FROM
+        (SELECT teams.id AS teamid, teams.teamname AS teamname, MAX(solves.solvetime) AS last_solvetime, solves.puzzleid as puzzleid, teams.huntid AS huntid FROM puzzledb.puzzlehunt_teams teams
+        LEFT JOIN puzzledb.puzzlehunt_solves solves
+            ON solves.teamid = teams.id AND solves.huntid = teams.huntid
+            GROUP BY teams.id, solves.puzzleid) teamsolves
+    LEFT JOIN puzzledb.puzzlehunt_puzzles puzzles
+        ON teamsolves.puzzleid = puzzles.puzzleid AND teamsolves.huntid = puzzles.huntid
+        WHERE teamsolves.huntid = $1
+        GROUP BY teamsolves.teamid, teamsolves.teamname
+        ORDER BY total_points DESC, last_solvetime ASC;
+""")
+
+
+class DefaultCachePool(DatabasePool):
+    """ The pool with asyncpg's statement cache defaults, as before the registry """
+    async def _connect(self):
+        async with self._opening:
+            if self._pool is None:
+                self._pool = await asyncpg.create_pool(
+                    self._dsn, min_size=1, max_size=self._max_size,
+                    command_timeout=self.timeout, ssl=self._ssl)
+        return self._pool
+
+
+async def answer(db, huntid, memberid, puzzleid):
+    """ The reads `hunt answer` made before checking the answer """
+    await db.fetchrow(HUNT_INFO, huntid)
+    solver = await db.fetchrow(SOLVER, huntid, memberid)
+    teamid = solver[2]
+    await db.fetchrow(TEAM_INFO, huntid, teamid)
+    await db.fetch(TEAM_SOLVES, huntid, teamid)
+    await db.fetch(BAD_ATTEMPT_TIMES, huntid, teamid, puzzleid)
+    await db.fetchrow(PUZZLE, huntid, puzzleid)
+
+
+async def leaderboard(db, huntid):
+    await db.fetchrow(HUNT_INFO, huntid)
+    await db.fetch(LEADERBOARD, huntid)
+
+
+async def cached_answer(state, memberid, puzzleid):
+    """ The lookups `hunt answer` makes in the HuntState instead """
+    team_info = state.team_info(state.members.get(memberid))
+    puzzleid, _ = state.puzzle(puzzleid)
+    return (puzzleid in state.solves.get(team_info['Team ID'], {}),
+            state.bad_attempts.get((team_info['Team ID'], puzzleid)))
+
+
+async def cached_leaderboard(state):
+    return state.leaderboard()
+
+
+async def time_command(command, runs):
+    # Once untimed, so the prepared runs aren't charged for preparing
+    await command()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await command()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        'runs': runs,
+        'median_ms': round(statistics.median(times), 3),
+        'p90_ms': round(times[int(0.9 * (runs - 1))], 3),
+        'max_ms': round(times[-1], 3),
+    }
+
+
+async def run(dsn, huntid, memberid, puzzleid, runs):
+    pools = {'default-cache': DefaultCachePool(dsn, max_size=1),
+             'registry': DatabasePool(dsn, max_size=1)}
+    try:
+        db = pools['default-cache']
+        if memberid is None:
+            memberid = await db.fetchval(
+                "SELECT id FROM puzzledb.puzzlehunt_solvers WHERE huntid = $1 ORDER BY uid LIMIT 1;", huntid)
+        if puzzleid is None:
+            puzzleid = await db.fetchval(
+                "SELECT puzzleid FROM puzzledb.puzzlehunt_puzzles WHERE huntid = $1 ORDER BY id LIMIT 1;", huntid)
+        if memberid is None or puzzleid is None:
+            raise SystemExit(f"Hunt {huntid!r} needs a solver and a puzzle to benchmark.")
+        results = []
+        for mode, db in pools.items():
+            for name, command in [('hunt answer', lambda: answer(db, huntid, memberid, puzzleid)),
+                                  ('hunt leaderboard', lambda: leaderboard(db, huntid))]:
+                results.append(dict(command=name, mode=mode, **await time_command(command, runs)))
+        db = pools['registry']
+        results.append(dict(command='hunt activate', mode='load',
+                            **await time_command(lambda: HuntState.load(db, huntid), max(1, runs // 10))))
+        state = await HuntState.load(db, huntid)
+        for name, command in [('hunt answer', lambda: cached_answer(state, memberid, puzzleid)),
+                              ('hunt leaderboard', lambda: cached_leaderboard(state))]:
+            results.append(dict(command=name, mode='cached', **await time_command(command, runs)))
+        return results
+    finally:
+        for db in pools.values():
+            await db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the puzzle hunt queries.")
+    parser.add_argument('--dsn', help="database to run against (default DATABASE_URL)")
+    parser.add_argument('--hunt', default='avatar', help="hunt id")
+    parser.add_argument('--member', type=int, help="solver's Discord id (default the hunt's first solver)")
+    parser.add_argument('--puzzle', help="puzzle id to answer (default the hunt's first puzzle)")
+    parser.add_argument('--runs', type=int, default=100, help="timed runs of each command")
+    parser.add_argument('--json', metavar='PATH', help="also write the results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    dsn = args.dsn or os.getenv('DATABASE_URL')
+    if not dsn:
+        parser.error("no database given, set DATABASE_URL or use --dsn")
+    results = asyncio.run(run(dsn, args.hunt, args.member, args.puzzle, args.runs))
+
+    out = sys.stderr if args.json == '-' else sys.stdout
+    for r in results:
+        print(f"{r['command']:<16} {r['mode']:<13}: median {r['median_ms']:>8.2f} ms  "
+              f"p90 {r['p90_ms']:>8.2f} ms  max {r['max_ms']:>8.2f} ms", file=out)
+    if args.json:
+        text = json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'hunt': args.hunt, 'results': results}, indent=2)
+        if args.json == '-':
+            print(text)
+        else:
+            with open(args.json, 'w') as f:
+                f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,13 @@ import asyncio
 import random
 from datetime import datetime
 
+import asyncpg
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands import has_any_role
 
+from .database import statement
+
 bold = lambda s: "**" + s + "**"
 
 EMBED_COLOUR = discord.Colour.dark_red()
@@ -36,6 +39,25 @@ TEXT_STRINGS = {
 DELAY_AFTER_FAILING = 60
 HUNT_ROLE = "Avatar Hunt"
 
+# What the bot's own connections set, so their writes leave the hunt's version alone
+HUNT_CACHE_SETTINGS = {'puzzlebot.hunt_cache': 'on'}
+# How often to look for edits to the running hunt made outside the bot
+HUNT_VERSION_SECONDS = 30
+
+# The writes every answer makes and the version check, prepared once per
+# connection. The writes hand back the hunt's version as they go.
+HUNT_INFO = statement('hunt_info', "SELECT * FROM puzzledb.puzzlehunts WHERE huntid = $1")
+HUNT_VERSION = statement('hunt_version', "SELECT COALESCE(MAX(version), 0) FROM puzzledb.puzzlehunt_versions WHERE huntid = $1;")
+ADD_SOLVE = statement('hunt_add_solve', """
+    INSERT INTO puzzledb.puzzlehunt_solves (huntid, puzzleid, solvetime, teamid) VALUES ($1, $2, $3, $4) ON CONFLICT DO NOTHING
+    RETURNING (SELECT COALESCE(MAX(version), 0) FROM puzzledb.puzzlehunt_versions WHERE huntid = $1);
+""")
+ADD_BAD_ATTEMPT = statement('hunt_add_bad_attempt', """
+    INSERT INTO puzzledb.puzzlehunt_bad_attempts (huntid, puzzleid, solvetime, teamid, attempt) VALUES ($1, $2, $3, $4, $5)
+    RETURNING (SELECT COALESCE(MAX(version), 0) FROM puzzledb.puzzlehunt_versions WHERE huntid = $1);
+""")
+
+
 def strfdelta(tdelta):
     hrs, rem = divmod(tdelta, 3600)
     mins, secs = divmod(rem, 60)
@@ -44,6 +66,143 @@ def strfdelta(tdelta):
         f = "%02d hours, " % (hrs)
     return f + "%02d minutes, %02d seconds" % (mins, secs)
 
+class HuntState:
+    """
+    The running hunt as the bot last saw it: the hunt, its puzzles, teams
+    and members, what each team has solved and when it last got each
+    puzzle wrong. It is loaded whole by load(), and the bot updates it
+    after each of its own writes, so answering a puzzle reads nothing
+    from the database.
+
+    version is the hunt's count of edits made from outside the bot when
+    it was loaded, and a different count turning up means it should be
+    loaded again. Writes from any connection with HUNT_CACHE_SETTINGS
+    don't count, so only one bot should run against a database.
+    """
+    def __init__(self, huntid, version, info):
+        self.huntid = huntid
+        self.version = version
+        self.info = info
+        # puzzleid: (name, relatedlink, points, requiredpoints, answer), in the order they were added
+        self.puzzles = {}
+        # UPPER(name): puzzleid
+        self.puzzle_names = {}
+        # teamid: (teamname, teamchannel)
+        self.teams = {}
+        self.team_names = {}
+        # Member's Discord id: teamid
+        self.members = {}
+        # teamid: {puzzleid: solvetime}
+        self.solves = {}
+        # (teamid, puzzleid): time of the latest wrong answer
+        self.bad_attempts = {}
+
+    @classmethod
+    async def load(cls, db, huntid):
+        """ The hunt's state, or None if there is no such hunt """
+        # Read first, so an edit made while loading turns up as a new version
+        version = await db.fetchval(HUNT_VERSION, huntid)
+        hunt = await db.fetchrow(HUNT_INFO, huntid)
+        if hunt is None:
+            return None
+        _, _, puzzlecount, huntname, theme, past, starttime, endtime = hunt
+        state = cls(huntid, version, {
+            'ID': huntid,
+            'Puzzle count': puzzlecount,
+            'Name': huntname,
+            'Theme': theme,
+            'Past': past,
+            'Start time': starttime,
+            'End time': endtime
+        })
+        puzzles = await db.fetch("SELECT * FROM puzzledb.puzzlehunt_puzzles WHERE huntid = $1 ORDER BY id;", huntid)
+        for _, _, puzzleid, name, relatedlink, points, requiredpoints, answer in puzzles:
+            state.puzzles[puzzleid] = (name, relatedlink, points, requiredpoints, answer)
+            if name is not None:
+                state.puzzle_names.setdefault(name.upper(), puzzleid)
+        for teamid, teamname, teamchannel in await db.fetch(
+                "SELECT id, teamname, teamchannel FROM puzzledb.puzzlehunt_teams WHERE huntid = $1;", huntid):
+            state.add_team(teamid, teamname, teamchannel)
+        for memberid, teamid in await db.fetch(
+                "SELECT id, teamid FROM puzzledb.puzzlehunt_solvers WHERE huntid = $1;", huntid):
+            state.add_member(memberid, teamid)
+        for teamid, puzzleid, solvetime in await db.fetch(
+                "SELECT teamid, puzzleid, solvetime FROM puzzledb.puzzlehunt_solves WHERE huntid = $1;", huntid):
+            state.add_solve(teamid, puzzleid, solvetime)
+        for teamid, puzzleid, solvetime in await db.fetch(
+                "SELECT teamid, puzzleid, MAX(solvetime) FROM puzzledb.puzzlehunt_bad_attempts "
+                "WHERE huntid = $1 GROUP BY teamid, puzzleid;", huntid):
+            state.add_bad_attempt(teamid, puzzleid, solvetime)
+        return state
+
+    def puzzle(self, puzid):
+        """ (puzzleid, puzzle) of the puzzle with puzid as its id or name, or None """
+        if puzid not in self.puzzles:
+            puzid = self.puzzle_names.get(puzid.upper())
+            if puzid is None:
+                return None
+        return puzid, self.puzzles[puzid]
+
+    def team_info(self, teamid):
+        if teamid not in self.teams:
+            return None
+        teamname, teamchannel = self.teams[teamid]
+        solves = self.solves.get(teamid, {})
+        solvetimes = [solvetime for solvetime in solves.values() if solvetime is not None]
+        return {
+            'Team ID': teamid,
+            'Team Name': teamname,
+            'Channel ID': teamchannel,
+            'Points': self._points(solves),
+            'Latest Solve Time': max(solvetimes) if solvetimes else None
+        }
+
+    def team_members(self, teamid):
+        return [memberid for memberid, team in self.members.items() if team == teamid]
+
+    def leaderboard(self):
+        """ (teamname, total points, last solve time) of every team, best first """
+        teams = []
+        for teamid, (teamname, _) in self.teams.items():
+            solves = self.solves.get(teamid, {})
+            solvetimes = [solvetime for solvetime in solves.values() if solvetime is not None]
+            teams.append((teamname, self._points(solves), max(solvetimes) if solvetimes else None))
+        # Teams without a solve time go last among those on the same points
+        return sorted(teams, key=lambda team: (-team[1], team[2] is None, team[2] or datetime.min))
+
+    def _points(self, solves):
+        return sum(self.puzzles[puzzleid][2] or 0 for puzzleid in solves if puzzleid in self.puzzles)
+
+    def add_team(self, teamid, teamname, teamchannel):
+        self.teams[teamid] = (teamname, teamchannel)
+        self.team_names[teamname] = teamid
+
+    def remove_team(self, teamid):
+        if teamid not in self.teams:
+            return
+        teamname, _ = self.teams.pop(teamid)
+        if self.team_names.get(teamname) == teamid:
+            del self.team_names[teamname]
+        self.solves.pop(teamid, None)
+        for memberid in self.team_members(teamid):
+            del self.members[memberid]
+
+    def add_member(self, memberid, teamid):
+        self.members[memberid] = teamid
+
+    def remove_member(self, memberid):
+        self.members.pop(memberid, None)
+
+    def add_solve(self, teamid, puzzleid, solvetime):
+        # The first solve stands, as it does in the table
+        self.solves.setdefault(teamid, {}).setdefault(puzzleid, solvetime)
+
+    def add_bad_attempt(self, teamid, puzzleid, solvetime):
+        last = self.bad_attempts.get((teamid, puzzleid))
+        if last is None or solvetime is not None and solvetime > last:
+            self.bad_attempts[teamid, puzzleid] = solvetime
+
+
 class PuzzleHunt(commands.Cog):
     """
     Cog for puzzle hunt
@@ -59,11 +218,36 @@ class PuzzleHunt(commands.Cog):
         }
 
         self._huntid = 'avatar'
-    
+        # The running hunt's HuntState, loaded on first use
+        self._state = None
+        self._loading = asyncio.Lock()
+        # Changes written while a load is running, to make again on what it loads
+        self._replay = None
+
+    def cog_unload(self):
+        self._check_hunt_version.cancel()
 
     @commands.Cog.listener()
     async def on_ready(self):
         print('Cog "PuzzleHunt" Ready!')
+        if not self._check_hunt_version.is_running():
+            self._check_hunt_version.start()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        # ?query writes through the bot's own connections, which leave the version alone
+        if ctx.command.name == 'query' and self._state is not None:
+            await self._reload_state()
+
+    @tasks.loop(seconds=HUNT_VERSION_SECONDS)
+    async def _check_hunt_version(self):
+        state = self._state
+        if state is None:
+            return
+        try:
+            await self._check_version(await self.bot.db.fetchval(HUNT_VERSION, state.huntid))
+        except Exception as e:
+            print(f"Couldn't check the hunt version: {e}")
 
 
     """
@@ -79,80 +263,71 @@ class PuzzleHunt(commands.Cog):
     BOT FUNCTIONS
     """
 
-    def _get_hunt_info(self, huntid=None):
-        if huntid is None and self._huntid is None:
+    async def _hunt_state(self):
+        """ The running hunt's HuntState, or None if no hunt is running or it doesn't exist """
+        if self._huntid is None:
             return None
-        elif huntid is None:
+        if self._state is None or self._state.huntid != self._huntid:
+            await self._reload_state()
+        return self._state
+
+    async def _reload_state(self, version=None):
+        """ Loads the running hunt's state again, unless another load already got the version """
+        async with self._loading:
+            if version is not None and self._state is not None and self._state.version == version:
+                return
             huntid = self._huntid
-        cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunts WHERE huntid = %s", (huntid,))
-        matching_hunt = cursor.fetchone()
-        if matching_hunt:
-            _, _, puzzlecount, huntname, theme, past, starttime, endtime = matching_hunt
-            # print(starttime)
-            return {
-                'ID': huntid,
-                'Puzzle count': puzzlecount,
-                'Name': huntname,
-                'Theme': theme,
-                'Past': past,
-                'Start time': starttime,
-                'End time': endtime
-            }
-        else:
+            self._replay = []
+            try:
+                state = await HuntState.load(self.bot.db, huntid) if huntid is not None else None
+            finally:
+                replay, self._replay = self._replay, None
+            # The load may have read the tables before these were written
+            if state is not None:
+                for change in replay:
+                    change(state)
+            if huntid == self._huntid:
+                self._state = state
+
+    def _write_through(self, change):
+        """ Makes a change the bot has just written to the database to its state too """
+        if self._state is not None:
+            change(self._state)
+        if self._replay is not None:
+            self._replay.append(change)
+
+    async def _check_version(self, version):
+        """ Loads the state again if the hunt was edited from outside the bot since it was loaded """
+        if self._state is not None and version != self._state.version:
+            print(f"Hunt {self._state.huntid} was edited outside the bot, loading it again.")
+            await self._reload_state(version)
+
+    async def _get_hunt_info(self):
+        state = await self._hunt_state()
+        return state.info if state is not None else None
+
+    async def _get_team_info_from_member(self, memberid):
+        state = await self._hunt_state()
+        if memberid is None or state is None:
             return None
+        return state.team_info(state.members.get(memberid))
 
-    def _get_team_info_from_member(self, memberid):
-        if memberid is None or self._huntid is None:
-            return None
-        cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_solvers WHERE huntid = %s AND id = %s", (self._huntid, memberid))
-        matching_solver = cursor.fetchone()
-        if matching_solver:
-            _, _, teamid, _ = matching_solver
-        else:
+    async def _get_team_info_from_name(self, teamname):
+        state = await self._hunt_state()
+        if state is None:
             return None
-        return self._get_team_info(teamid)
-        
-
-    def _get_team_info_from_name(self, teamname):
-        cursor = self.bot.db_execute("SELECT id FROM puzzledb.puzzlehunt_teams WHERE huntid = %s AND teamname = %s", (self._huntid, teamname))
-        try:
-            teamid = cursor.fetchone()[0]
-        except:
-            return None
-        return self._get_team_info(teamid)
+        return state.team_info(state.team_names.get(teamname))
 
-    def _get_team_info(self, teamid):
-        if teamid is None or self._huntid is None:
+    async def _get_team_info(self, teamid):
+        state = await self._hunt_state()
+        if teamid is None or state is None:
             return None
-        cursor = self.bot.db_execute(
-            """
-            SELECT teamsolves.teamid AS teamid, teamsolves.teamname AS teamname, MAX(teamsolves.last_solvetime) AS last_solvetime, COALESCE(SUM(puzzles.points), 0) AS total_points, teamsolves.teamchannel AS teamchannel FROM
-                (SELECT teams.id AS teamid, teams.teamname AS teamname, MAX(solves.solvetime) AS last_solvetime, solves.puzzleid as puzzleid, teams.huntid AS huntid, teams.teamchannel AS teamchannel FROM puzzledb.puzzlehunt_teams teams
-                LEFT JOIN puzzledb.puzzlehunt_solves solves
-                    ON solves.teamid = teams.id AND solves.huntid = teams.huntid
-                    GROUP BY teams.id, solves.puzzleid) teamsolves
-            LEFT JOIN puzzledb.puzzlehunt_puzzles puzzles
-            ON teamsolves.puzzleid = puzzles.puzzleid AND teamsolves.huntid = puzzles.huntid
-            WHERE teamsolves.huntid = %s and teamsolves.teamid = %s GROUP BY teamsolves.teamid, teamsolves.teamname, teamsolves.teamchannel;
-            """,
-            (self._huntid, teamid)
-        )
-        matching_team = cursor.fetchone()
-        if matching_team:
-            teamid, teamname, last_solve, total_points, teamchannel = matching_team
-
-            return {
-                'Team ID': teamid,
-                'Team Name': teamname,
-                'Channel ID': teamchannel,
-                'Points': total_points,
-                'Latest Solve Time': last_solve
-            }
-        return None
+        return state.team_info(teamid)
 
     async def _add_to_team(self, ctx, memberid, teamid):
-        self.bot.db_execute("INSERT INTO puzzledb.puzzlehunt_solvers (id, huntid, teamid) VALUES (%s, %s, %s)", (memberid, self._huntid, teamid))
-        team_info = self._get_team_info(teamid)
+        await self.bot.db.execute("INSERT INTO puzzledb.puzzlehunt_solvers (id, huntid, teamid) VALUES ($1, $2, $3)", memberid, self._huntid, teamid)
+        self._write_through(lambda state: state.add_member(memberid, teamid))
+        team_info = await self._get_team_info(teamid)
         team_channel = ctx.guild.get_channel(team_info['Channel ID'])
         member = ctx.guild.get_member(memberid)
         role = discord.utils.get(ctx.guild.roles, name=HUNT_ROLE)
@@ -181,8 +356,14 @@ class PuzzleHunt(commands.Cog):
         await channel.set_permissions(ctx.author, read_messages=True,
                                                   send_messages=True,
                                                   read_message_history=True)
-        cursor = self.bot.db_execute("INSERT INTO puzzledb.puzzlehunt_teams (huntid, teamname, teamchannel) VALUES (%s, %s, %s) returning id", (self._huntid, teamname, channel.id))
-        teamid = cursor.fetchone()[0]
+        try:
+            teamid = await self.bot.db.fetchval("INSERT INTO puzzledb.puzzlehunt_teams (huntid, teamname, teamchannel) VALUES ($1, $2, $3) returning id", self._huntid, teamname, channel.id)
+        except asyncpg.UniqueViolationError:
+            # Someone else took the name while the channel was made
+            await channel.delete()
+            await self._send_as_embed(ctx, TEXT_STRINGS['Team Exists'])
+            return
+        self._write_through(lambda state: state.add_team(teamid, teamname, channel.id))
 
         await self._send_as_embed(channel, "Water. Earth. Fire. Air. ... Puzzle.", TEXT_STRINGS['Start Hunt Intro'])
 
@@ -196,7 +377,7 @@ class PuzzleHunt(commands.Cog):
         embed = discord.Embed(colour=EMBED_COLOUR)
         if self._huntid is not None:
             embed.set_author(name="Currently Running Puzzle Hunt:")
-            hunt_info = self._get_hunt_info(self._huntid)
+            hunt_info = await self._get_hunt_info()
             if hunt_info is not None:
                 remaining = (hunt_info['End time'] - datetime.now()).total_seconds()
                 to_go = (hunt_info['Start time'] - datetime.now()).total_seconds()
@@ -295,13 +476,13 @@ class PuzzleHunt(commands.Cog):
             await self._send_as_embed(ctx, TEXT_STRINGS['No Hunt Running'])
             return
         async with ctx.typing(): 
-            hunt_info = self._get_hunt_info()
-            
+            state = await self._hunt_state()
+        hunt_info = state.info
+
         if hunt_info['Start time'] > datetime.now() and not self._VARIABLES['Solving outside hunt duration']:
             await self._send_as_embed(ctx, TEXT_STRINGS['Hunt Not Started'])
             return
-        async with ctx.typing(): 
-            team_info = self._get_team_info_from_member(ctx.author.id)
+        team_info = state.team_info(state.members.get(ctx.author.id))
         if team_info is None:
             await self._send_as_embed(ctx, TEXT_STRINGS['Not in a Team'])
             return
@@ -313,36 +494,25 @@ class PuzzleHunt(commands.Cog):
             await self._send_as_embed(ctx, TEXT_STRINGS['Answer Clarification'])
             return
 
-        async with ctx.typing(): 
-            cursor = self.bot.db_execute("SELECT puzzleid FROM puzzledb.puzzlehunt_solves WHERE huntid = %s and teamid = %s;", (self._huntid, team_info['Team ID']))
-            solves = cursor.fetchall()
-        solved = [solve[0] for solve in solves]
-        if puzid in solved:
+        # A puzzle given by its name is solved under its id
+        puzzle = state.puzzle(puzid)
+        if puzzle is None:
+            await self._send_as_embed(ctx, TEXT_STRINGS['Answer Clarification'])
+            return
+        puzid, (name, relatedlink, points, requiredpoints, answer) = puzzle
+        teamid = team_info['Team ID']
+
+        if puzid in state.solves.get(teamid, {}):
             await self._send_as_embed(ctx, TEXT_STRINGS['Already Solved'])
             return
 
-        async with ctx.typing(): 
-            cursor = self.bot.db_execute("SELECT solvetime FROM puzzledb.puzzlehunt_bad_attempts WHERE huntid = %s and teamid = %s and puzzleid = %s;", (self._huntid, team_info['Team ID'], puzid))
-            solvetimes = cursor.fetchall()
-        if solvetimes:
-            solvetimes = [solvetime[0] for solvetime in solvetimes]
-            last_solvetime = sorted(solvetimes)[-1]
+        last_solvetime = state.bad_attempts.get((teamid, puzid))
+        if last_solvetime is not None:
             time_passed = int((datetime.now() - last_solvetime).total_seconds())
             if time_passed < DELAY_AFTER_FAILING:
                 await self._send_as_embed(ctx, TEXT_STRINGS['Attempting Too Soon'].format(DELAY_AFTER_FAILING - time_passed))
                 return
-            
-        async with ctx.typing(): 
-            cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_puzzles where huntid = %s and puzzleid = %s;", (self._huntid, puzid))
-            puzzle = cursor.fetchone()
-        if not puzzle:
-            async with ctx.typing(): 
-                cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_puzzles where huntid = %s and UPPER(name) = UPPER(%s);", (self._huntid, puzid))
-                puzzle = cursor.fetchone()
-        if not puzzle:
-            await self._send_as_embed(ctx, TEXT_STRINGS['Answer Clarification'])
-            return
-        _, _, _, name, relatedlink, points, requiredpoints, answer = puzzle
+
         attempt = ''.join(attempt).lower().replace(' ', '')
 
         if attempt == answer:
@@ -350,12 +520,19 @@ class PuzzleHunt(commands.Cog):
             await self._send_as_embed(ctx, TEXT_STRINGS['Correct Answer'].format(points))
             if puzid == 'META':
                 await self._send_as_embed(ctx, "Congratulations!", TEXT_STRINGS['Finish Hunt Outro'])
-            self.bot.db_execute("INSERT INTO puzzledb.puzzlehunt_solves (huntid, puzzleid, solvetime, teamid) VALUES (%s, %s, %s, %s);", (self._huntid, puzid, datetime.now(), team_info['Team ID']))
+            solvetime = datetime.now()
+            # None if the team had already solved it, which the state didn't know
+            version = await self.bot.db.fetchval(ADD_SOLVE, self._huntid, puzid, solvetime, teamid)
+            self._write_through(lambda state: state.add_solve(teamid, puzid, solvetime))
+            await self._check_version(version)
         else:
             # Wrong
             await self._send_as_embed(ctx, TEXT_STRINGS['Wrong Answer'])
             if len(attempt) <= 50:
-                self.bot.db_execute("INSERT INTO puzzledb.puzzlehunt_bad_attempts (huntid, puzzleid, solvetime, teamid, attempt) VALUES (%s, %s, %s, %s, %s);", (self._huntid, puzid, datetime.now(), team_info['Team ID'], attempt))
+                solvetime = datetime.now()
+                version = await self.bot.db.fetchval(ADD_BAD_ATTEMPT, self._huntid, puzid, solvetime, teamid, attempt)
+                self._write_through(lambda state: state.add_bad_attempt(teamid, puzid, solvetime))
+                await self._check_version(version)
 
     @hunt.command(name='join')
     async def join(self, ctx, *, teamname=""):
@@ -365,7 +542,7 @@ class PuzzleHunt(commands.Cog):
         if len(teamname) == 0:
             await self._send_as_embed(ctx, TEXT_STRINGS['Register Clarification'])
             return
-        if self._get_team_info_from_member(ctx.author.id) is not None:
+        if await self._get_team_info_from_member(ctx.author.id) is not None:
             await self._send_as_embed(ctx, TEXT_STRINGS['Already in a Team'])
             return
         # teamname = " ".join(teamname).strip()
@@ -378,12 +555,10 @@ class PuzzleHunt(commands.Cog):
         # if "'" in teamname or '"' in teamname:
         #     await self._send_as_embed(ctx, "Illegal character(s) in your team name!")
         #     return
-        cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_teams where huntid = %s and teamname = %s", (self._huntid, teamname))
-        team = cursor.fetchone()
+        team = await self._get_team_info_from_name(teamname)
         if team is not None:
-            teamid = team[0]
-            cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_team_applications where huntid = %s and teamid = %s and solverid = %s", (self._huntid, teamid, ctx.author.id))
-            app = cursor.fetchone()
+            teamid = team['Team ID']
+            app = await self.bot.db.fetchrow("SELECT * FROM puzzledb.puzzlehunt_team_applications where huntid = $1 and teamid = $2 and solverid = $3", self._huntid, teamid, ctx.author.id)
             if app is not None:
                 _, _, _, _, recruited, joined = app
                 if recruited:
@@ -392,7 +567,7 @@ class PuzzleHunt(commands.Cog):
                     await self._send_as_embed(ctx, TEXT_STRINGS['Team Exists'])
             else:
                 await self._send_as_embed(ctx, TEXT_STRINGS['Team Exists'])
-                self.bot.db_execute("INSERT INTO puzzledb.puzzlehunt_team_applications (huntid, teamid, solverid, recruited, joined) VALUES (%s, %s, %s, FALSE, TRUE)", (self._huntid, teamid, ctx.author.id))
+                await self.bot.db.execute("INSERT INTO puzzledb.puzzlehunt_team_applications (huntid, teamid, solverid, recruited, joined) VALUES ($1, $2, $3, FALSE, TRUE)", self._huntid, teamid, ctx.author.id)
         else:
             await self._create_team(ctx, ctx.author.id, teamname)
 
@@ -406,19 +581,18 @@ class PuzzleHunt(commands.Cog):
             await self._send_as_embed(ctx, TEXT_STRINGS['Recruit Clarification'])
             return
 
-        team_info = self._get_team_info_from_member(ctx.author.id)
+        team_info = await self._get_team_info_from_member(ctx.author.id)
         if team_info is None:
             await self._send_as_embed(ctx, TEXT_STRINGS['Not in a Team'])
             return
         teamid = team_info['Team ID']
 
         recruitedid = ctx.message.mentions[0].id
-        existed_in_team = self._get_team_info_from_member(recruitedid)
+        existed_in_team = await self._get_team_info_from_member(recruitedid)
         if existed_in_team is not None:
             await self._send_as_embed(ctx, TEXT_STRINGS["Recruitee in Team"])
 
-        cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_team_applications where huntid = %s and teamid = %s and solverid = %s", (self._huntid, teamid, recruitedid))
-        app = cursor.fetchone()
+        app = await self.bot.db.fetchrow("SELECT * FROM puzzledb.puzzlehunt_team_applications where huntid = $1 and teamid = $2 and solverid = $3", self._huntid, teamid, recruitedid)
         if app:
             _, _, _, _, recruited, joined = app
             if joined:
@@ -427,7 +601,7 @@ class PuzzleHunt(commands.Cog):
                 await self._send_as_embed(ctx, TEXT_STRINGS['Waiting for Recruitee'])
         else:
             await self._send_as_embed(ctx, TEXT_STRINGS['Waiting for Recruitee'])
-            self.bot.db_execute("INSERT INTO puzzledb.puzzlehunt_team_applications (huntid, teamid, solverid, recruited, joined) VALUES (%s, %s, %s, TRUE, FALSE)", (self._huntid, teamid, recruitedid))
+            await self.bot.db.execute("INSERT INTO puzzledb.puzzlehunt_team_applications (huntid, teamid, solverid, recruited, joined) VALUES ($1, $2, $3, TRUE, FALSE)", self._huntid, teamid, recruitedid)
 
 
     @hunt.command(name='leave')
@@ -436,16 +610,16 @@ class PuzzleHunt(commands.Cog):
             await self._send_as_embed(ctx, TEXT_STRINGS['No Hunt Running'])
             return
         async with ctx.typing(): 
-            team_info = self._get_team_info_from_member(ctx.author.id)
+            team_info = await self._get_team_info_from_member(ctx.author.id)
         if team_info is None:
             await self._send_as_embed(ctx, TEXT_STRINGS['Not in a Team'])
             return
         teamid = team_info['Team ID']
         async with ctx.typing(): 
-            cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_solvers WHERE huntid = %s AND teamid = %s", (self._huntid, teamid))
-            members = cursor.fetchall()
+            members = self._state.team_members(teamid)
             
-            self.bot.db_execute("DELETE FROM puzzledb.puzzlehunt_solvers WHERE huntid = %s AND teamid = %s AND id = %s", (self._huntid, teamid, ctx.author.id))
+            await self.bot.db.execute("DELETE FROM puzzledb.puzzlehunt_solvers WHERE huntid = $1 AND teamid = $2 AND id = $3", self._huntid, teamid, ctx.author.id)
+            self._write_through(lambda state: state.remove_member(ctx.author.id))
             team_channelid = team_info['Channel ID']
         channel = ctx.guild.get_channel(team_channelid)
         await channel.set_permissions(
@@ -454,7 +628,8 @@ class PuzzleHunt(commands.Cog):
         if len(members) == 1:
             await self._send_as_embed(ctx, "You are the last member. The team will be deleted.")
             await channel.delete()
-            self.bot.db_execute("DELETE FROM puzzledb.puzzlehunt_teams WHERE huntid = %s AND id = %s", (self._huntid, teamid))
+            await self.bot.db.execute("DELETE FROM puzzledb.puzzlehunt_teams WHERE huntid = $1 AND id = $2", self._huntid, teamid)
+            self._write_through(lambda state: state.remove_team(teamid))
     
     @hunt.command(name="leaderboard")
     async def leaderboard(self, ctx):
@@ -463,23 +638,11 @@ class PuzzleHunt(commands.Cog):
             return
 
         async with ctx.typing(): 
-            hunt_info = self._get_hunt_info()
+            hunt_info = await self._get_hunt_info()
             embed = discord.Embed(colour=EMBED_COLOUR)
             embed.set_author(name=hunt_info['Name'] + " Leaderboard")
 
-            cursor = self.bot.db_execute("""
-            SELECT teamsolves.teamname AS teamname, COALESCE(SUM(puzzles.points), 0) AS total_points, MAX(teamsolves.last_solvetime) AS last_solvetime FROM
-                (SELECT teams.id AS teamid, teams.teamname AS teamname, MAX(solves.solvetime) AS last_solvetime, solves.puzzleid as puzzleid, teams.huntid AS huntid FROM puzzledb.puzzlehunt_teams teams
-                LEFT JOIN puzzledb.puzzlehunt_solves solves
-                    ON solves.teamid = teams.id AND solves.huntid = teams.huntid
-                    GROUP BY teams.id, solves.puzzleid) teamsolves
-            LEFT JOIN puzzledb.puzzlehunt_puzzles puzzles
-                ON teamsolves.puzzleid = puzzles.puzzleid AND teamsolves.huntid = puzzles.huntid
-                WHERE teamsolves.huntid = %s
-                GROUP BY teamsolves.teamid, teamsolves.teamname
-                ORDER BY total_points DESC, last_solvetime ASC;""",
-                (self._huntid,))
-            teams = cursor.fetchall()
+            teams = self._state.leaderboard()
 
         names = [str(i+1) + '. ' + team[0] for i, team in enumerate(teams)]
         if len(names) > 0 and teams[0][1]: names[0] = '🥇**' + names[0][2:] + '**'
@@ -505,8 +668,7 @@ class PuzzleHunt(commands.Cog):
             return
         
         async with ctx.typing():  
-            cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_faqs WHERE huntid = %s;", (self._huntid,))
-            faqs = cursor.fetchall()
+            faqs = await self.bot.db.fetch("SELECT * FROM puzzledb.puzzlehunt_faqs WHERE huntid = $1;", self._huntid)
             
         questions = []
         errata = []
@@ -532,18 +694,14 @@ class PuzzleHunt(commands.Cog):
             await self._send_as_embed(ctx, TEXT_STRINGS['No Hunt Running'])
             return
         async with ctx.typing():
-            team_info = self._get_team_info_from_member(ctx.author.id)
+            team_info = await self._get_team_info_from_member(ctx.author.id)
             if team_info is None:
                 await self._send_as_embed(ctx, TEXT_STRINGS['Not in a Team'])
                 return
 
-            cursor = self.bot.db_execute(
-                "SELECT * FROM puzzledb.puzzlehunt_solvers WHERE huntid = %s and teamid = %s",
-                (self._huntid, team_info['Team ID'])
-            )
+            members = self._state.team_members(team_info['Team ID'])
             
-            members = cursor.fetchall()
-        members = [ctx.guild.get_member(mem[1]).display_name for mem in members]
+        members = [ctx.guild.get_member(memberid).display_name for memberid in members]
 
         embed = discord.Embed(colour=EMBED_COLOUR)
         embed.set_author(name="Your Team:")
@@ -561,7 +719,7 @@ class PuzzleHunt(commands.Cog):
             return
 
         async with ctx.typing():
-            hunt_info = self._get_hunt_info()
+            hunt_info = await self._get_hunt_info()
         
         admin_role = discord.utils.get(ctx.guild.roles, name="Bot Maintainer")
         if hunt_info['Start time'] > datetime.now() and not self._VARIABLES['Solving outside hunt duration'] and not admin_role in ctx.author.roles:
@@ -569,7 +727,7 @@ class PuzzleHunt(commands.Cog):
             return
 
         async with ctx.typing():
-            team_info = self._get_team_info_from_member(ctx.author.id)
+            team_info = await self._get_team_info_from_member(ctx.author.id)
         if team_info is None:
             await self._send_as_embed(ctx, TEXT_STRINGS['Not in a Team'])
             return
@@ -578,21 +736,14 @@ class PuzzleHunt(commands.Cog):
             await self._send_as_embed(ctx, TEXT_STRINGS['Wrong Channel'])
             return
 
-        async with ctx.typing():
-            cursor = self.bot.db_execute("SELECT * FROM puzzledb.puzzlehunt_puzzles WHERE huntid = %s;", (self._huntid,))
-            puzzles = cursor.fetchall()
-            cursor = self.bot.db_execute("SELECT puzzleid FROM puzzledb.puzzlehunt_solves WHERE huntid = %s and teamid = %s;", (self._huntid, team_info['Team ID']))
-            solves = cursor.fetchall()
-            solves = [solve[0] for solve in solves]
+        solves = self._state.solves.get(team_info['Team ID'], {})
 
         puzzleids = []
         names = []
         statuses = []
 
-        puzzles = sorted(puzzles, key=lambda x: x[0])
-
-        for puzzle in puzzles:
-            _, _, puzzleid, name, relatedlink, points, requiredpoints, answer = puzzle
+        for puzzleid, puzzle in self._state.puzzles.items():
+            name, relatedlink, points, requiredpoints, answer = puzzle
             if team_info['Points'] >= requiredpoints:
                 puzzleids.append(puzzleid)
                 names.append("[{}]({}) ({} pts)".format(name, relatedlink, points))
@@ -651,15 +802,23 @@ class PuzzleHunt(commands.Cog):
     @has_any_role("Bot Maintainer")
     async def activate(self, ctx, huntid=None):
         # Activate a hunt
-        if huntid is not None:
-            hunt_info = self._get_hunt_info(huntid)
-            if hunt_info is None:
-                await self._send_as_embed(ctx, "Cannot activate hunt", "`huntid` is not found. If this info is correct, please try again later!")
-                return
-        else:
+        if huntid is None:
             await self._send_as_embed(ctx, "Cannot activate hunt.", "Make sure to include the correct `huntid` as parameter!")
             return
+        previous = self._huntid
         self._huntid = huntid
+        # Loaded like any reload, so answers written meanwhile aren't lost
+        try:
+            async with ctx.typing():
+                await self._reload_state()
+        except Exception:
+            self._huntid = previous
+            raise
+        if self._state is None:
+            # The previous hunt is loaded again when next used
+            self._huntid = previous
+            await self._send_as_embed(ctx, "Cannot activate hunt", "`huntid` is not found. If this info is correct, please try again later!")
+            return
         await self._send_as_embed(ctx, "Hunt activated.")
     
     @hunt.command(name="deactivate")
@@ -669,6 +828,7 @@ class PuzzleHunt(commands.Cog):
         if self._huntid is not None:
             await self._send_as_embed(ctx, "Deactivated running hunt (`{}`).".format(self._huntid,))
             self._huntid = None
+            self._state = None
         else:
             await self._send_as_embed(ctx, TEXT_STRINGS["No Hunt Running"])
     
@@ -683,7 +843,7 @@ class PuzzleHunt(commands.Cog):
             return
         # teamname = ' '.join(teamname)
         async with ctx.typing(): 
-            team_info = self._get_team_info_from_name(teamname)
+            team_info = await self._get_team_info_from_name(teamname)
         if team_info is None:
             await self._send_as_embed(ctx, "No such team!")
             return
@@ -693,10 +853,11 @@ class PuzzleHunt(commands.Cog):
             pass
 
         async with ctx.typing(): 
-            self.bot.db_execute("DELETE FROM puzzledb.puzzlehunt_team_applications WHERE huntid = %s AND teamid = %s", (self._huntid, team_info['Team ID']))
-            self.bot.db_execute("DELETE FROM puzzledb.puzzlehunt_solvers WHERE huntid = %s AND teamid = %s", (self._huntid, team_info['Team ID']))
-            self.bot.db_execute("DELETE FROM puzzledb.puzzlehunt_solves WHERE huntid = %s AND teamid = %s", (self._huntid, team_info['Team ID']))
-            self.bot.db_execute("DELETE FROM puzzledb.puzzlehunt_teams WHERE huntid = %s AND id = %s", (self._huntid, team_info['Team ID']))
+            await self.bot.db.execute("DELETE FROM puzzledb.puzzlehunt_team_applications WHERE huntid = $1 AND teamid = $2", self._huntid, team_info['Team ID'])
+            await self.bot.db.execute("DELETE FROM puzzledb.puzzlehunt_solvers WHERE huntid = $1 AND teamid = $2", self._huntid, team_info['Team ID'])
+            await self.bot.db.execute("DELETE FROM puzzledb.puzzlehunt_solves WHERE huntid = $1 AND teamid = $2", self._huntid, team_info['Team ID'])
+            await self.bot.db.execute("DELETE FROM puzzledb.puzzlehunt_teams WHERE huntid = $1 AND id = $2", self._huntid, team_info['Team ID'])
+            self._write_through(lambda state: state.remove_team(team_info['Team ID']))
         await self._send_as_embed(ctx, "Team has been deleted.")
 
 
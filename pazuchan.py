@@ -3,7 +3,6 @@
 import os
 import random
 import asyncio
-import psycopg2
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 
@@ -11,8 +10,8 @@ import discord
 from discord.ext.commands import Bot, has_permissions, CommandNotFound, has_any_role, command, ExtensionAlreadyLoaded, ExtensionNotFound, ExtensionFailed, ExtensionNotLoaded
 
 from cogs.core import Core
-from cogs.puzzlehunt import PuzzleHunt
-from cogs.database import Database
+from cogs.puzzlehunt import PuzzleHunt, HUNT_CACHE_SETTINGS
+from cogs.database import Database, DatabasePool
 from cogs.trivia import Trivia
 from cogs.triplet import Triplet
 from cogs.layton import Layton
@@ -47,8 +46,7 @@ class PazuChan(Bot):
     """
     def __init__(self):
         super().__init__(command_prefix=PazuChan.BOT_PREFIX, intents=intents)
-        self.db = psycopg2.connect(os.getenv("DATABASE_URL"), sslmode="require")
-        self.db.autocommit = True
+        self.db = DatabasePool(os.getenv("DATABASE_URL"), server_settings=HUNT_CACHE_SETTINGS)
 
         self.startup_time = datetime.now()
         self.last_updated_status = datetime.now()
@@ -96,13 +94,15 @@ class PazuChan(Bot):
             print("No log channel found!!!")
             print(error_str)
 
-    """
-    DATABASE WRAPPER
-    """
-    def db_execute(self, query, arguments=()):
-        cursor = self.db.cursor()
-        cursor.execute(query, arguments)
-        return cursor
+    async def start(self, *args, **kwargs):
+        await self.db.migrate()
+        for name, tables in (await self.db.check_indexes()).items():
+            print(f"Query {name} reads all of {', '.join(sorted(tables))}, add an index for it.")
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await super().close()
+        await self.db.close()
 
 if __name__ == '__main__':
     pazu = PazuChan()